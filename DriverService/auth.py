@@ -1,6 +1,7 @@
 # UserService/auth.py
+import time
 from datetime import datetime, timedelta, timezone
-from typing import Union, Optional 
+from typing import Union, Optional, Dict
 from jose import JWTError, jwt
 from passlib.context import CryptContext
 import os
@@ -10,6 +11,11 @@ SECRET_KEY = os.getenv("SECRET_KEY", "default-secret-key-change-in-production-mi
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", 30))
 
+# Cache token -> claims đã giải mã; không bao giờ giữ quá thời điểm hết hạn của chính token
+TOKEN_CACHE_TTL_SECONDS = int(os.getenv("TOKEN_CACHE_TTL_SECONDS", 300))
+TOKEN_CACHE_MAX_SIZE = int(os.getenv("TOKEN_CACHE_MAX_SIZE", 10000))
+_token_claims_cache: Dict[str, tuple] = {}
+
 # --- Mã hóa mật khẩu ---
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
@@ -31,7 +37,13 @@ def create_access_token(data: dict, expires_delta: Union[timedelta, None] = None
     return encoded_jwt
 
 # --- Xác thực JWT ---
-async def verify_token(token: str) -> Optional[str]:
+def decode_user_token(token: str) -> dict:
+    """Giải mã token người dùng (có cache); claims gồm sub (email) và, với token mới, uid + user_type."""
+    now = time.time()
+    cached = _token_claims_cache.get(token)
+    if cached and cached[0] > now:
+        return cached[1]
+
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -39,9 +51,16 @@ async def verify_token(token: str) -> Optional[str]:
     )
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        email: str = payload.get("sub")
-        if email is None:
-            raise credentials_exception
-        return email
     except JWTError:
-        raise credentials_exception
\ No newline at end of file
+        _token_claims_cache.pop(token, None)
+        raise credentials_exception
+    if payload.get("sub") is None:
+        raise credentials_exception
+
+    if len(_token_claims_cache) >= TOKEN_CACHE_MAX_SIZE:
+        _token_claims_cache.pop(next(iter(_token_claims_cache)), None)
+    _token_claims_cache[token] = (min(now + TOKEN_CACHE_TTL_SECONDS, payload.get("exp", now)), payload)
+    return payload
+
+async def verify_token(token: str) -> Optional[str]:
+    return decode_user_token(token)["sub"]
\ No newline at end of file
@@ -1,10 +1,12 @@
 # DriverService/crud.py
 
 import os
+import time
 import httpx
 from datetime import datetime, timezone
 from typing import Dict, Optional, Any, List
 from bson import ObjectId
+from pymongo.errors import BulkWriteError
 import logging
 import models
 import schemas
@@ -13,6 +15,13 @@ from motor.motor_asyncio import AsyncIOMotorCollection
 
 LOCATION_SERVICE_URL = os.getenv("LOCATION_SERVICE_URL", "http://locationservice:8000")
 USER_SERVICE_URL = os.getenv("USER_SERVICE_URL", "http://userservice:8000")
+TRIP_SERVICE_URL = os.getenv("TRIP_SERVICE_URL", "http://tripservice:8000")
+
+# Cache hồ sơ tài xế cho xác thực (driver_id -> (hết hạn, Driver)) và email -> driver_id cho token cũ
+DRIVER_AUTH_CACHE_TTL_SECONDS = int(os.getenv("DRIVER_AUTH_CACHE_TTL_SECONDS", 60))
+DRIVER_AUTH_CACHE_MAX_SIZE = int(os.getenv("DRIVER_AUTH_CACHE_MAX_SIZE", 10000))
+_driver_auth_cache: Dict[str, tuple] = {}
+_email_driver_id_cache: Dict[str, tuple] = {}
 
 #Helper
 
@@ -26,6 +35,31 @@ def wallet_helper(wallet_data: dict) -> models.DriverWallet:
         wallet_data["id"] = str(wallet_data.pop("_id"))
     return models.DriverWallet(**wallet_data)
 
+def _new_driver_document(driver_create: schemas.DriverCreate, user_id_str: str) -> dict:
+    """Dựng document tài xế mới (OFFLINE) với _id = user_id; ném ValueError nếu dữ liệu không hợp lệ."""
+    driver_oid = ObjectId(user_id_str)
+    if hasattr(driver_create.vehicle, 'model_dump'):
+         vehicle_data = driver_create.vehicle.model_dump()
+    elif isinstance(driver_create.vehicle, dict):
+         vehicle_data = driver_create.vehicle
+    else:
+         raise TypeError("Dữ liệu vehicle không phải dict hoặc Pydantic model")
+
+    vehicle_data.setdefault("license_plate", "Chưa cập nhật")
+    vehicle_data.setdefault("seat_type", 4)
+    vehicle_info_obj = models.VehicleInfo(**vehicle_data)
+    driver_obj = models.Driver(
+        id=user_id_str, 
+        name=driver_create.name,
+        phone=driver_create.phone,
+        email=driver_create.email,
+        vehicle=vehicle_info_obj, 
+        status=models.DriverStatusEnum.OFFLINE
+    )
+    driver_doc = driver_obj.model_dump(by_alias=True, exclude={"id"}, exclude_none=True)
+    driver_doc["_id"] = driver_oid 
+    return driver_doc
+
 async def create_driver_profile(driver_create: schemas.DriverCreate, user_id_str: str) -> Optional[models.Driver]:
     logger = logging.getLogger(__name__)
     if drivers_collection is None:
@@ -41,32 +75,11 @@ async def create_driver_profile(driver_create: schemas.DriverCreate, user_id_str
         logger.info(f"DriverService: Hồ sơ cho {user_id_str} đã tồn tại.")
         return driver_helper(existing)
     try:
-        if hasattr(driver_create.vehicle, 'model_dump'):
-             vehicle_data = driver_create.vehicle.model_dump()
-        elif isinstance(driver_create.vehicle, dict):
-             vehicle_data = driver_create.vehicle
-        else:
-             logger.error(f"Dữ liệu vehicle không hợp lệ: {driver_create.vehicle}")
-             raise TypeError("Dữ liệu vehicle không phải dict hoặc Pydantic model")
-
-        vehicle_data.setdefault("license_plate", "Chưa cập nhật")
-        vehicle_data.setdefault("seat_type", 4)
-        vehicle_info_obj = models.VehicleInfo(**vehicle_data)
-        driver_obj = models.Driver(
-            id=user_id_str, 
-            name=driver_create.name,
-            phone=driver_create.phone,
-            email=driver_create.email,
-            vehicle=vehicle_info_obj, 
-            status=models.DriverStatusEnum.OFFLINE
-        )
+        driver_doc = _new_driver_document(driver_create, user_id_str)
     except (TypeError, ValueError, Exception) as e:
         logger.error(f"Lỗi khi xử lý dữ liệu đầu vào để tạo Driver: {e}", exc_info=True)
         return None
     try:
-        driver_doc = driver_obj.model_dump(by_alias=True, exclude={"id"}, exclude_none=True)
-        driver_doc["_id"] = driver_oid 
-
         await drivers_collection.insert_one(driver_doc)
 
         new_doc = await drivers_collection.find_one({"_id": driver_oid})
@@ -78,6 +91,36 @@ async def create_driver_profile(driver_create: schemas.DriverCreate, user_id_str
     except Exception as e:
         logger.error(f"Lỗi khi lưu tài xế vào database: {e}", exc_info=True)
         return None
+
+async def create_driver_profiles_bulk(items: List[schemas.DriverBulkItem]) -> List[schemas.DriverBulkResult]:
+    """Tạo nhiều hồ sơ bằng một insert_many(ordered=False); lỗi từng dòng không chặn các dòng khác."""
+    results = [schemas.DriverBulkResult(user_id=item.user_id, status="CREATED") for item in items]
+    if drivers_collection is None:
+        for result in results:
+            result.status, result.error = "ERROR", "Database chưa sẵn sàng"
+        return results
+    docs, doc_rows = [], []
+    for row, item in enumerate(items):
+        try:
+            docs.append(_new_driver_document(item, item.user_id))
+            doc_rows.append(row)
+        except Exception as e:
+            results[row].status = "ERROR"
+            results[row].error = f"Dữ liệu không hợp lệ: {e}"
+    if not docs:
+        return results
+    try:
+        await drivers_collection.insert_many(docs, ordered=False)
+    except BulkWriteError as e:
+        for write_error in e.details.get("writeErrors", []):
+            result = results[doc_rows[write_error["index"]]]
+            if write_error.get("code") == 11000 and "_id_" in write_error.get("errmsg", ""):
+                # Hồ sơ đã có (ví dụ job outbox chạy lại): coi như thành công
+                result.status = "EXISTS"
+            else:
+                result.status = "ERROR"
+                result.error = write_error.get("errmsg")
+    return results
     
 async def get_driver_by_id(driver_id_str: str) -> Optional[models.Driver]:
     if drivers_collection is None: return None
@@ -92,6 +135,15 @@ async def get_driver_by_id(driver_id_str: str) -> Optional[models.Driver]:
         return driver_helper(driver_data)
     return None
 
+async def get_drivers_by_ids(driver_id_strs: List[str]) -> List[models.Driver]:
+    """Lấy nhiều tài xế bằng một truy vấn $in (ID không hợp lệ bị bỏ qua)."""
+    if drivers_collection is None: return []
+    driver_oids = [ObjectId(driver_id) for driver_id in driver_id_strs if ObjectId.is_valid(driver_id)]
+    if not driver_oids:
+        return []
+    cursor = drivers_collection.find({"_id": {"$in": driver_oids}})
+    return [driver_helper(driver_data) async for driver_data in cursor]
+
 async def update_driver_profile(driver_id_str: str, update_data: schemas.DriverUpdate) -> Optional[models.Driver]:
     if drivers_collection is None: return None
     try:
@@ -111,6 +163,8 @@ async def update_driver_profile(driver_id_str: str, update_data: schemas.DriverU
     )
     if result.matched_count == 0:
         return None 
+    invalidate_driver_auth_cache(driver_id_str)
+    await notify_trip_service_driver_changed(driver_id_str)
     return await get_driver_by_id(driver_id_str)
 
 async def update_driver_status(driver_id_str: str, new_status: str) -> Optional[models.Driver]:
@@ -138,6 +192,7 @@ async def update_driver_status(driver_id_str: str, new_status: str) -> Optional[
         }
     )
     if update_result.matched_count > 0:
+        invalidate_driver_auth_cache(driver_id_str)
         updated_driver = await get_driver_by_id(driver_id_str)
         return updated_driver 
     print(f"Không tìm thấy tài xế với ID {driver_id_str} để cập nhật trạng thái.")
@@ -172,6 +227,42 @@ async def get_driver_by_email(email: str) -> Optional[models.Driver]:
 
 
 
+def _cache_put(cache: Dict[str, tuple], key: str, value: Any):
+    if len(cache) >= DRIVER_AUTH_CACHE_MAX_SIZE:
+        cache.pop(next(iter(cache)), None)
+    cache[key] = (time.monotonic() + DRIVER_AUTH_CACHE_TTL_SECONDS, value)
+
+def _cache_get(cache: Dict[str, tuple], key: str) -> Any:
+    entry = cache.get(key)
+    if entry is None or entry[0] <= time.monotonic():
+        cache.pop(key, None)
+        return None
+    return entry[1]
+
+def invalidate_driver_auth_cache(driver_id: str):
+    _driver_auth_cache.pop(driver_id, None)
+
+async def get_driver_cached(driver_id: str) -> Optional[models.Driver]:
+    """get_driver_by_id có cache ngắn hạn, dùng cho xác thực mỗi request."""
+    driver = _cache_get(_driver_auth_cache, driver_id)
+    if driver is None:
+        driver = await get_driver_by_id(driver_id)
+        if driver is not None:
+            _cache_put(_driver_auth_cache, driver_id, driver)
+    return driver
+
+async def get_driver_by_email_cached(email: str) -> Optional[models.Driver]:
+    """Cho token cũ chỉ có email: chỉ hỏi UserService lần đầu, sau đó dùng driver_id đã cache."""
+    driver_id = _cache_get(_email_driver_id_cache, email)
+    if driver_id is not None:
+        return await get_driver_cached(driver_id)
+    driver = await get_driver_by_email(email)
+    if driver is not None:
+        _cache_put(_email_driver_id_cache, email, driver.id)
+        _cache_put(_driver_auth_cache, driver.id, driver)
+    return driver
+
+
 async def get_or_create_driver_wallet(driver_id: str) -> Optional[models.DriverWallet]:
     if driver_wallets_collection is None:
         print("Lỗi: driver_wallets_collection chưa được khởi tạo.")
@@ -224,4 +315,16 @@ async def notify_location_service_offline(driver_id: str):
     except httpx.RequestError as e:
         print(f"DriverService: Không thể kết nối đến LocationService để báo offline: {e}")
     except Exception as e:
-        print(f"DriverService: Lỗi không xác định khi báo offline: {e}")
\ No newline at end of file
+        print(f"DriverService: Lỗi không xác định khi báo offline: {e}")
+
+async def notify_trip_service_driver_changed(driver_id: str):
+    """Báo TripService bỏ hồ sơ tài xế đã cache (best-effort, TTL bên TripService là lưới an toàn)."""
+    url = f"{TRIP_SERVICE_URL}/internal/driver-events"
+    try:
+        async with httpx.AsyncClient() as client:
+            response = await client.post(url, json={"driver_id": driver_id, "event": "DRIVER_UPDATED"}, timeout=2.0)
+            response.raise_for_status()
+    except httpx.HTTPStatusError as e:
+        print(f"DriverService: TripService trả lỗi khi nhận sự kiện tài xế (HTTP {e.response.status_code})")
+    except httpx.RequestError as e:
+        print(f"DriverService: Không thể kết nối TripService để báo thay đổi tài xế {driver_id}: {e}")
@@ -1,13 +1,15 @@
 # DriverService/main.py
-from fastapi import FastAPI, HTTPException, status, Depends
+from fastapi import FastAPI, HTTPException, status, Depends, Request
+from pydantic import ValidationError
 from fastapi.security import OAuth2PasswordBearer 
 import crud
 import schemas
 import models
 import auth 
 import logging
-from typing import Optional, Annotated
+from typing import Optional, Annotated, List
 import os 
+import json
 from jose import JWTError, jwt 
 
 app = FastAPI(title="UIT-Go Driver Service")
@@ -56,8 +58,12 @@ async def verify_service_jwt(token: Annotated[str, Depends(oauth2_scheme)]):
 async def get_current_driver(
     token: str = Depends(oauth2_scheme) 
 ) -> models.Driver: 
-    email = await auth.verify_token(token)
-    driver = await crud.get_driver_by_email(email=email) 
+    claims = auth.decode_user_token(token)
+    if claims.get("uid"):
+        # Token mới mang sẵn id + loại user: không cần gọi UserService
+        driver = await crud.get_driver_cached(claims["uid"]) if claims.get("user_type") == "DRIVER" else None
+    else:
+        driver = await crud.get_driver_by_email_cached(claims["sub"])
     
     if driver is None:
         raise HTTPException(
@@ -110,6 +116,9 @@ async def update_my_driver_profile(
     update_data: schemas.DriverUpdate,
     current_driver: models.Driver = Depends(get_current_driver)
 ):
+    updated_driver = await crud.update_driver_profile(current_driver.id, update_data)
+    if not updated_driver:
+        raise HTTPException(status_code=404, detail="Không tìm thấy tài xế để cập nhật")
     return updated_driver
 
 @app.post("/drivers/me/online", response_model=schemas.DriverResponse)
@@ -134,6 +143,59 @@ async def get_my_wallet(current_driver: models.Driver = Depends(get_current_driv
 
 
 
+@app.post(
+    "/drivers/internal/batch",
+    response_model=List[schemas.DriverResponse],
+    dependencies=[Depends(verify_service_jwt)]
+)
+async def get_drivers_internal_batch(request: schemas.DriverBatchRequest):
+    """Lấy hồ sơ nhiều tài xế trong một lần gọi (một truy vấn $in); ID không tồn tại bị bỏ qua."""
+    logger.info(f"Yêu cầu nội bộ (JWT hợp lệ): Lấy thông tin {len(request.driver_ids)} tài xế theo lô")
+    return await crud.get_drivers_by_ids(request.driver_ids)
+
+# Lô do outbox của UserService gửi (DRIVER_PROVISION_BATCH_SIZE dòng): đọc cả body rồi insert một lần
+DRIVER_BULK_MAX_ROWS = int(os.getenv("DRIVER_BULK_MAX_ROWS", 1000))
+
+@app.post(
+    "/drivers/internal/bulk",
+    response_model=schemas.DriverBulkResponse,
+    dependencies=[Depends(verify_service_jwt)]
+)
+async def create_drivers_internal_bulk(request: Request):
+    """Tạo hồ sơ tài xế hàng loạt từ body NDJSON (mỗi dòng một DriverBulkItem) bằng một insert_many."""
+    lines = [(line_no, raw) for line_no, raw in enumerate((await request.body()).splitlines(), 1) if raw.strip()]
+    if len(lines) > DRIVER_BULK_MAX_ROWS:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"Tối đa {DRIVER_BULK_MAX_ROWS} dòng mỗi lần gọi"
+        )
+
+    results: List[schemas.DriverBulkResult] = []
+    items, item_lines = [], []
+    for line_no, raw in lines:
+        try:
+            data = json.loads(raw)
+        except ValueError as e:
+            results.append(schemas.DriverBulkResult(line=line_no, status="ERROR", error=f"JSON không hợp lệ: {e}"))
+            continue
+        try:
+            items.append(schemas.DriverBulkItem.model_validate(data))
+            item_lines.append(line_no)
+        except ValidationError as e:
+            user_id = data.get("user_id") if isinstance(data, dict) else None
+            results.append(schemas.DriverBulkResult(line=line_no, user_id=user_id, status="ERROR", error=str(e)))
+    if items:
+        for line_no, result in zip(item_lines, await crud.create_driver_profiles_bulk(items)):
+            result.line = line_no
+            results.append(result)
+
+    results.sort(key=lambda result: result.line or 0)
+    counts = {status_name: sum(1 for result in results if result.status == status_name) for status_name in ("CREATED", "EXISTS", "ERROR")}
+    logger.info(f"Bulk onboarding tài xế: {counts}")
+    return schemas.DriverBulkResponse(
+        created=counts["CREATED"], existing=counts["EXISTS"], failed=counts["ERROR"], results=results
+    )
+
 @app.get(
     "/drivers/internal/{driver_id}", 
     response_model=schemas.DriverResponse,
@@ -1,7 +1,7 @@
 # DriverService/schemas.py
 from pydantic import BaseModel, Field, ConfigDict
 from datetime import datetime
-from typing import Optional, List
+from typing import Optional, List, Literal
 from models import DriverStatusEnum, VehicleInfo 
 
 
@@ -43,6 +43,26 @@ class DriverResponse(BaseModel):
     model_config = ConfigDict(populate_by_name=True)
 
 
+class DriverBatchRequest(BaseModel):
+    driver_ids: List[str] = Field(..., max_length=200)
+
+class DriverBulkItem(DriverCreate):
+    """Một dòng NDJSON của /drivers/internal/bulk"""
+    user_id: str
+
+class DriverBulkResult(BaseModel):
+    line: Optional[int] = None
+    user_id: Optional[str] = None
+    status: Literal["CREATED", "EXISTS", "ERROR"]
+    error: Optional[str] = None
+
+class DriverBulkResponse(BaseModel):
+    created: int
+    existing: int
+    failed: int
+    results: List[DriverBulkResult]
+
+
 class UpdateBalanceRequest(BaseModel):
     amount: float 
     trip_id: Optional[str] = None
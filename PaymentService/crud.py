@@ -1,21 +1,24 @@
 # PaymentService/crud.py (Đã sửa đổi)
 
 import os
-import hashlib
-import hmac
 import asyncio
 import logging # <-- Thêm logging
-from datetime import datetime, timezone
-from typing import Dict, Optional, Any
+import httpx
+from datetime import datetime, timezone, timedelta
+from typing import Dict, Optional, Any, Tuple
 from urllib.parse import urlencode, quote_plus
 from bson import ObjectId
+from pymongo import ReturnDocument
 
 # Import models và schemas của PaymentService
 import models
 import schemas
+import wallet
+import settlement
+import vnpay_signing
 
 # Import các hàm lấy collection từ database.py
-from database import get_wallets_collection, get_transactions_collection
+from database import get_transactions_collection, get_payment_jobs_collection, get_vnpay_callbacks_collection
 from motor.motor_asyncio import AsyncIOMotorCollection
 
 # --- Cấu hình Logging ---
@@ -28,8 +31,13 @@ VNP_HASH_SECRET = os.getenv("VNP_HASH_SECRET")
 VNP_URL = os.getenv("VNP_URL")
 # Bỏ đọc BASE_URL trực tiếp ở đây
 # DRIVER_SERVICE_URL = os.getenv("DRIVER_SERVICE_URL")
+TRIP_SERVICE_URL = os.getenv("TRIP_SERVICE_URL")
 APP_COMMISSION_RATE = 0.20
 
+# Hàng đợi thanh toán E-Wallet (job do TripService ghi khi hoàn thành chuyến)
+PAYMENT_JOB_MAX_ATTEMPTS = int(os.getenv("PAYMENT_JOB_MAX_ATTEMPTS", 5))
+PAYMENT_JOB_LEASE_SECONDS = int(os.getenv("PAYMENT_JOB_LEASE_SECONDS", 60))
+
 # === [HÀM MỚI] Lấy Base URL linh hoạt ===
 def _get_base_url() -> str:
     """
@@ -98,35 +106,28 @@ async def process_vnpay_payment(request: schemas.ProcessPaymentRequest) -> Dict:
             'vnp_IpnURL': ipn_url # <-- THÊM THAM SỐ IPN
         }
 
-        sorted_params = sorted(vnp_params.items())
-        hash_data_string = "&".join([
-            f"{key}={quote_plus(str(value))}" for key, value in sorted_params
-        ])
-        h = hmac.new(VNP_HASH_SECRET.encode('utf-8'), hash_data_string.encode('utf-8'), hashlib.sha512)
-        secure_hash = h.hexdigest()
-        vnp_params['vnp_SecureHash'] = secure_hash
+        vnp_params['vnp_SecureHash'] = vnpay_signing.signer_for(VNP_HASH_SECRET).sign(vnp_params)
         payment_url = VNP_URL + "?" + urlencode(vnp_params, quote_via=quote_plus)
 
-        # Lưu giao dịch PENDING (Logic cũ giữ nguyên)
+        # Lưu giao dịch PENDING kèm mọi đầu vào quyết toán (tài xế, cước, hoa hồng)
         transactions_coll: Optional[AsyncIOMotorCollection] = await get_transactions_collection()
-        if transactions_coll:
+        if transactions_coll is not None:
             pending_transaction = models.Transaction(
                 transaction_id=order_id,
-                user_id=request.user_id, # Đảm bảo user_id có trong ProcessPaymentRequest
+                user_id=request.user_id,
                 trip_id=request.trip_id,
                 amount=request.amount,
                 transaction_type=models.TransactionType.PAYMENT,
                 payment_method="VNPAY",
                 status=models.TransactionStatus.PENDING,
-                vnpay_txnref=order_id
+                driver_id=request.driver_id,
+                commission_rate=APP_COMMISSION_RATE,
+                driver_earning=request.amount - request.amount * APP_COMMISSION_RATE
             )
-            await transactions_coll.insert_one(pending_transaction.model_dump(by_alias=True, exclude={"id"}))
+            await transactions_coll.insert_one(pending_transaction.model_dump(by_alias=True, exclude_none=True))
             logger.info(f"PaymentService: Đã lưu giao dịch PENDING {order_id} cho chuyến {request.trip_id}")
         else:
              logger.error("Lỗi: Không lấy được transactions_collection để lưu giao dịch PENDING.")
-             # Ném lỗi 503 nếu không lưu được
-             # raise HTTPException(status_code=503, detail="Lỗi lưu trữ giao dịch")
-             # Hoặc chỉ trả về lỗi Failed
              return {"status": "FAILED", "message": "Lỗi hệ thống khi tạo giao dịch."}
 
         return {"status": "PENDING", "payUrl": payment_url, "transaction_id": order_id}
@@ -142,78 +143,64 @@ async def process_vnpay_payment(request: schemas.ProcessPaymentRequest) -> Dict:
 #       và đảm bảo logic cộng tiền, gọi TripService hoạt động đúng.
 
 async def get_or_create_wallet(driver_id: str) -> Optional[Dict[str, Any]]:
-    # ... (Giữ nguyên code của bạn) ...
-    wallets_coll: Optional[AsyncIOMotorCollection] = await get_wallets_collection()
-    if not wallets_coll:
-        logger.error("Lỗi: Không lấy được wallets_collection trong get_or_create_wallet")
+    try:
+        return await wallet.get_or_create_wallet(driver_id)
+    except Exception as e:
+        logger.error(f"Lỗi khi lấy/tạo ví cho tài xế {driver_id}: {e}", exc_info=True)
         return None
-    wallet_data = await wallets_coll.find_one({"driver_id": driver_id})
-    if not wallet_data:
-        logger.info(f"PaymentService: Tạo ví mới cho tài xế {driver_id}")
-        new_wallet = models.DriverWallet(driver_id=driver_id)
-        insert_data = new_wallet.model_dump(by_alias=True, exclude={"id"})
-        await wallets_coll.insert_one(insert_data)
-        wallet_data = await wallets_coll.find_one({"driver_id": driver_id})
-    if wallet_data and "_id" in wallet_data:
-        wallet_data["_id"] = str(wallet_data["_id"])
-    return wallet_data
 
 
 async def top_up_driver_wallet(request: schemas.TopUpRequest) -> Optional[Dict[str, Any]]:
-    # ... (Giữ nguyên code của bạn, chỉ thêm logger) ...
-    wallets_coll: Optional[AsyncIOMotorCollection] = await get_wallets_collection()
-    transactions_coll: Optional[AsyncIOMotorCollection] = await get_transactions_collection()
-    if not wallets_coll or not transactions_coll:
-        logger.error("Lỗi: Không lấy được collection trong top_up_driver_wallet")
-        return None
-    wallet = await get_or_create_wallet(request.driver_id)
-    if not wallet: return None
-    update_result = await wallets_coll.update_one(
-        {"driver_id": request.driver_id},
-        {"$inc": {"balance": request.amount}, "$set": {"updated_at": datetime.now(timezone.utc)}}
-    )
-    if update_result.modified_count == 1:
-        top_up_transaction = models.Transaction(
-            user_id=request.driver_id,
-            transaction_type=models.TransactionType.TOPUP,
-            amount=request.amount,
-            status=models.TransactionStatus.SUCCESS,
-            description=request.note
+    try:
+        result = await wallet.apply_wallet_entry(
+            request.user_id, request.amount, models.TransactionType.TOPUP, description="Nạp tiền vào ví"
         )
-        await transactions_coll.insert_one(top_up_transaction.model_dump(by_alias=True, exclude={"id"}))
-        updated_wallet = await wallets_coll.find_one({"driver_id": request.driver_id})
-        if updated_wallet and "_id" in updated_wallet:
-            updated_wallet["_id"] = str(updated_wallet["_id"])
-        return updated_wallet
-    else:
-        logger.error(f"Lỗi khi cập nhật số dư cho ví của tài xế {request.driver_id}")
+    except Exception as e:
+        logger.error(f"Lỗi khi nạp tiền vào ví của tài xế {request.user_id}: {e}", exc_info=True)
         return None
+    return {"user_id": request.user_id, "balance": result.balance, "updated_at": datetime.now(timezone.utc)}
 
-async def handle_vnpay_return(vnpay_response_data: Dict[str, Any]) -> bool: 
-    transactions_coll: Optional[AsyncIOMotorCollection] = await get_transactions_collection()
-    if not transactions_coll: return False
 
-    # --- [QUAN TRỌNG] KIỂM TRA SECURE HASH ---
-    input_params = {k: v for k, v in vnpay_response_data.items() if k.startswith('vnp_') and k != 'vnp_SecureHash'}
-    received_secure_hash = vnpay_response_data.get('vnp_SecureHash')
-
-    # Sắp xếp lại và tạo chuỗi hash data từ response
-    sorted_params = sorted(input_params.items())
-    hash_data_string = "&".join([
-        f"{key}={quote_plus(str(value))}" for key, value in sorted_params
-    ])
-
-    # Tạo chữ ký từ server side
-    h = hmac.new(VNP_HASH_SECRET.encode('utf-8'), hash_data_string.encode('utf-8'), hashlib.sha512)
-    calculated_secure_hash = h.hexdigest()
+def verify_vnpay_signature(vnpay_response_data: Dict[str, Any]) -> bool:
+    """Kiểm tra vnp_SecureHash của callback VNPay."""
+    if not VNP_HASH_SECRET or not vnpay_response_data.get('vnp_SecureHash'):
+        return False
 
-    if calculated_secure_hash != received_secure_hash:
+    if not vnpay_signing.signer_for(VNP_HASH_SECRET).verify(vnpay_response_data):
         logger.error(f"VNPay Callback: Sai Secure Hash! Giao dịch có thể không hợp lệ. TxnRef: {vnpay_response_data.get('vnp_TxnRef')}")
         return False
-    else:
-        logger.info(f"VNPay Callback: Secure Hash hợp lệ. TxnRef: {vnpay_response_data.get('vnp_TxnRef')}")
-    # --- [HẾT PHẦN KIỂM TRA] ---
+    logger.info(f"VNPay Callback: Secure Hash hợp lệ. TxnRef: {vnpay_response_data.get('vnp_TxnRef')}")
+    return True
+
+
+async def _resolve_settlement_inputs(order_id: str, transaction: Dict[str, Any]) -> Optional[Tuple[str, float]]:
+    """(driver_id, thu nhập tài xế) cho giao dịch VNPay; chỉ gọi TripService với giao dịch cũ chưa lưu driver_id."""
+    trip_id = transaction.get("trip_id")
+    total_fare = transaction.get("amount")
+    if not trip_id or not total_fare:
+        logger.error(f"Thiếu trip_id hoặc amount trong transaction {order_id} để xử lý doanh thu.")
+        return None
+
+    if transaction.get("driver_id") and transaction.get("driver_earning") is not None:
+        logger.info(f"Chuyến {trip_id}: Cước {total_fare}, Tài xế {transaction['driver_id']} nhận {transaction['driver_earning']}")
+        return transaction["driver_id"], transaction["driver_earning"]
+
+    # Giao dịch tạo trước khi lưu đầu vào quyết toán: lấy driver_id và cước thực tế từ TripService
+    trip_details = await get_trip_details(trip_id)
+    if not trip_details or not trip_details.get("driver_id"):
+        # Giao dịch vẫn PENDING: worker callback sẽ thử lại thay vì bỏ mất thu nhập tài xế
+        raise RuntimeError(f"Không thể lấy driver_id hoặc chi tiết cho chuyến {trip_id} để cộng tiền.")
+    driver_id = trip_details["driver_id"]
+    fare_to_process = (trip_details.get("fare") or {}).get("actual") or total_fare
+    commission = fare_to_process * APP_COMMISSION_RATE
+    driver_earning = fare_to_process - commission
+    logger.info(f"Chuyến {trip_id}: Cước {fare_to_process}, Hoa hồng {commission}, Tài xế {driver_id} nhận {driver_earning}")
+    return driver_id, driver_earning
+
 
+async def handle_vnpay_return(vnpay_response_data: Dict[str, Any]) -> bool: 
+    transactions_coll: Optional[AsyncIOMotorCollection] = await get_transactions_collection()
+    if transactions_coll is None: return False
 
     order_id = vnpay_response_data.get('vnp_TxnRef')
     vnp_transaction_no = vnpay_response_data.get('vnp_TransactionNo')
@@ -230,37 +217,14 @@ async def handle_vnpay_return(vnpay_response_data: Dict[str, Any]) -> bool:
     new_status = models.TransactionStatus.FAILED
     if vnp_response_code == '00':
         new_status = models.TransactionStatus.SUCCESS
-        # === [THÊM LOGIC TÍNH TOÁN VÀ CỘNG TIỀN CHO TÀI XẾ] ===
         trip_id = transaction.get("trip_id")
-        # Lấy số tiền gốc khách hàng trả (đã lưu trong transaction)
-        total_fare = transaction.get("amount")
-
-        if trip_id and total_fare:
-            # Gọi TripService lấy chi tiết chuyến đi (để lấy driver_id)
-            trip_details = await get_trip_details(trip_id)
-
-            if trip_details and trip_details.get("driver_id"):
-                driver_id = trip_details["driver_id"]
-                # Lấy cước phí thực tế từ TripService nếu có (chính xác hơn)
-                actual_fare_from_trip = trip_details.get("fare", {}).get("actual")
-                fare_to_process = actual_fare_from_trip if actual_fare_from_trip else total_fare
-
-                # Tính toán hoa hồng và thu nhập tài xế
-                commission = fare_to_process * APP_COMMISSION_RATE
-                driver_earning = fare_to_process - commission
-                logger.info(f"Chuyến {trip_id}: Cước {fare_to_process}, Hoa hồng {commission}, Tài xế {driver_id} nhận {driver_earning}")
-
-                # Gọi hàm cộng tiền vào ví tài xế
-                credit_success = await credit_driver_wallet(driver_id, driver_earning, trip_id)
-                if not credit_success:
-                     logger.error(f"Lỗi nghiêm trọng: Không thể cộng tiền cho tài xế {driver_id} (chuyến {trip_id}) sau khi thanh toán thành công.")
-                     # Cần có cơ chế xử lý lỗi này (ví dụ: retry, báo cáo...)
-            else:
-                 logger.error(f"Không thể lấy driver_id hoặc chi tiết cho chuyến {trip_id} để cộng tiền.")
-        else:
-             logger.error(f"Thiếu trip_id hoặc amount trong transaction {order_id} để xử lý doanh thu.")
-        # === [HẾT PHẦN LOGIC THÊM] ===
-        
+        settlement_inputs = await _resolve_settlement_inputs(order_id, transaction)
+        if settlement_inputs:
+            driver_id, driver_earning = settlement_inputs
+            # Ghi thu nhập chờ quyết toán; settlement worker cộng vào ví theo lô.
+            # Lỗi ở đây phải nổi lên trước khi đổi trạng thái: giao dịch còn PENDING để worker callback thử lại
+            await settlement.record_pending_earning(driver_id, driver_earning, trip_id)
+
     update_result = await transactions_coll.update_one(
         {"transaction_id": order_id, "status": models.TransactionStatus.PENDING}, # Thêm status PENDING vào query
         {"$set": {
@@ -273,7 +237,9 @@ async def handle_vnpay_return(vnpay_response_data: Dict[str, Any]) -> bool:
 
     if update_result.modified_count == 1:
         logger.info(f"PaymentService: Đã cập nhật giao dịch {order_id} thành {new_status}")
-        # Gọi TripService lần nữa nếu là SUCCESS (đã làm ở trên)
+        # Báo trạng thái cuối cùng về TripService (PUT /trips/{trip_id}/payment)
+        if transaction.get("trip_id"):
+            await notify_trip_service_payment_status(transaction["trip_id"], order_id, new_status)
         return True
     else:
         logger.error(f"PaymentService: Lỗi khi cập nhật giao dịch {order_id} (có thể đã được IPN xử lý trước).")
@@ -282,9 +248,8 @@ async def handle_vnpay_return(vnpay_response_data: Dict[str, Any]) -> bool:
         return check_again is not None # Trả về True nếu nó đã Success rồi
 
 # === [THÊM HÀM HELPER GỌI TRIP SERVICE] ===
-async def notify_trip_service_payment_status(trip_id: str, transaction_id: str, status: models.TransactionStatus):
+async def notify_trip_service_payment_status(trip_id: str, transaction_id: Optional[str], status: models.TransactionStatus):
     """Gọi TripService để cập nhật trạng thái thanh toán của chuyến đi."""
-    TRIP_SERVICE_URL = os.getenv("TRIP_SERVICE_URL") # Đọc URL TripService
     if not TRIP_SERVICE_URL:
         logger.error("TRIP_SERVICE_URL chưa được cấu hình. Không thể thông báo trạng thái thanh toán.")
         return
@@ -341,45 +306,158 @@ async def get_trip_details(trip_id: str) -> Optional[Dict[str, Any]]:
     return None
 
 async def credit_driver_wallet(driver_id: str, amount: float, trip_id: str) -> bool:
-    """Cộng tiền vào ví tài xế (do PaymentService quản lý) và ghi log giao dịch."""
-    wallets_coll: Optional[AsyncIOMotorCollection] = await get_wallets_collection()
-    transactions_coll: Optional[AsyncIOMotorCollection] = await get_transactions_collection()
-    if not wallets_coll or not transactions_coll:
-        logger.error(f"Không lấy được collection trong credit_driver_wallet cho driver {driver_id}")
+    """Cộng thu nhập chuyến vào ví tài xế; số dư và ledger được ghi cùng lúc, mỗi chuyến chỉ cộng một lần."""
+    try:
+        result = await wallet.apply_wallet_entry(
+            driver_id,
+            amount,
+            models.TransactionType.EARNING,
+            trip_id=trip_id,
+            description=f"Thu nhập từ chuyến đi {trip_id}",
+            entry_id=wallet.earning_entry_id(trip_id)
+        )
+    except Exception as e:
+        logger.error(f"Lỗi khi cộng tiền vào ví tài xế {driver_id}: {e}", exc_info=True)
         return False
+    if result.applied:
+        logger.info(f"Đã cộng {amount} vào ví tài xế {driver_id} cho chuyến {trip_id} (số dư mới {result.balance}).")
+    return True
+# === [HẾT PHẦN THÊM] ===
 
-    # Lấy hoặc tạo ví
-    wallet = await get_or_create_wallet(driver_id)
-    if not wallet:
-        logger.error(f"Không thể lấy hoặc tạo ví cho driver {driver_id} để cộng tiền.")
-        return False
+# === CALLBACK VNPAY (IPN) XỬ LÝ TRỄ ===
+
+async def record_vnpay_callback(vnpay_response_data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Lưu IPN theo vnp_TxnRef (một upsert); IPN lặp lại trả về bản ghi đã có, không tạo job mới."""
+    callbacks_coll = await get_vnpay_callbacks_collection()
+    now = datetime.now(timezone.utc)
+    return await callbacks_coll.find_one_and_update(
+        {"_id": vnpay_response_data["vnp_TxnRef"]},
+        {"$setOnInsert": {
+            "params": vnpay_response_data,
+            "status": "QUEUED",
+            "attempts": 0,
+            "available_at": now,
+            "received_at": now
+        }},
+        upsert=True,
+        return_document=ReturnDocument.BEFORE
+    )
+
+async def claim_vnpay_callback() -> Optional[Dict[str, Any]]:
+    """Lấy một callback đến hạn (hoặc có lease đã hết hạn) và đánh dấu PROCESSING."""
+    callbacks_coll = await get_vnpay_callbacks_collection()
+    now = datetime.now(timezone.utc)
+    return await callbacks_coll.find_one_and_update(
+        {"$or": [
+            {"status": "QUEUED", "available_at": {"$lte": now}},
+            {"status": "PROCESSING", "locked_until": {"$lte": now}}
+        ]},
+        {
+            "$set": {"status": "PROCESSING", "locked_until": now + timedelta(seconds=PAYMENT_JOB_LEASE_SECONDS)},
+            "$inc": {"attempts": 1}
+        },
+        sort=[("available_at", 1)],
+        return_document=ReturnDocument.AFTER
+    )
 
-    # Thực hiện cộng tiền
+async def process_vnpay_callback(callback: Dict[str, Any]) -> None:
+    """Cập nhật giao dịch/thu nhập cho một IPN đã lưu; lỗi thì thử lại với backoff."""
+    callbacks_coll = await get_vnpay_callbacks_collection()
+    txn_ref = callback["_id"]
     try:
-        update_result = await wallets_coll.update_one(
-            {"driver_id": driver_id},
-            {"$inc": {"balance": amount}, "$set": {"updated_at": datetime.now(timezone.utc)}}
+        ok = await handle_vnpay_return(callback["params"])
+        error_message = None if ok else "Không cập nhật được giao dịch"
+    except Exception as e:
+        error_message = str(e)
+
+    now = datetime.now(timezone.utc)
+    if error_message is None:
+        await callbacks_coll.update_one(
+            {"_id": txn_ref, "status": "PROCESSING"},
+            {"$set": {"status": "DONE", "completed_at": now}, "$unset": {"locked_until": ""}}
+        )
+        return
+    if callback.get("attempts", 0) >= PAYMENT_JOB_MAX_ATTEMPTS:
+        logger.error(f"PaymentService: IPN {txn_ref} xử lý thất bại sau {callback.get('attempts')} lần: {error_message}")
+        await callbacks_coll.update_one(
+            {"_id": txn_ref, "status": "PROCESSING"},
+            {"$set": {"status": "FAILED", "last_error": error_message, "completed_at": now}, "$unset": {"locked_until": ""}}
         )
+        return
+    retry_in = 2 ** callback.get("attempts", 1)
+    logger.warning(f"PaymentService: IPN {txn_ref} lỗi ({error_message}), thử lại sau {retry_in}s.")
+    await callbacks_coll.update_one(
+        {"_id": txn_ref, "status": "PROCESSING"},
+        {"$set": {"status": "QUEUED", "available_at": now + timedelta(seconds=retry_in), "last_error": error_message},
+         "$unset": {"locked_until": ""}}
+    )
 
-        if update_result.modified_count == 1:
-            # Ghi lại giao dịch EARNING (Thu nhập)
-            earning_transaction = models.Transaction(
-                user_id=driver_id, # Giao dịch thuộc về tài xế
-                trip_id=trip_id,
-                transaction_type=models.TransactionType.EARNING, # Loại giao dịch mới
-                amount=amount, # Số tiền tài xế thực nhận
-                status=models.TransactionStatus.SUCCESS,
-                description=f"Thu nhập từ chuyến đi {trip_id}"
-            )
-            await transactions_coll.insert_one(earning_transaction.model_dump(by_alias=True, exclude={"id"}))
-            logger.info(f"Đã cộng {amount} vào ví tài xế {driver_id} cho chuyến {trip_id}.")
-            return True
-        else:
-            logger.error(f"Lỗi không mong muốn: Không thể cập nhật số dư cho ví của tài xế {driver_id} (modified_count=0).")
-            return False
+# === HÀNG ĐỢI THANH TOÁN E-WALLET ===
+
+async def claim_payment_job() -> Optional[Dict[str, Any]]:
+    """Lấy một job đến hạn (hoặc job có lease đã hết hạn) và đánh dấu PROCESSING."""
+    jobs_coll = await get_payment_jobs_collection()
+    now = datetime.now(timezone.utc)
+    return await jobs_coll.find_one_and_update(
+        {"$or": [
+            {"status": "QUEUED", "available_at": {"$lte": now}},
+            # Worker chết giữa chừng: hết lease thì job được lấy lại
+            {"status": "PROCESSING", "locked_until": {"$lte": now}}
+        ]},
+        {
+            "$set": {"status": "PROCESSING", "locked_until": now + timedelta(seconds=PAYMENT_JOB_LEASE_SECONDS)},
+            "$inc": {"attempts": 1}
+        },
+        sort=[("available_at", 1)],
+        return_document=ReturnDocument.AFTER
+    )
+
+async def process_payment_job(job: Dict[str, Any]) -> None:
+    """Tạo giao dịch VNPay cho job rồi báo về TripService; lỗi thì thử lại với backoff."""
+    jobs_coll = await get_payment_jobs_collection()
+    trip_id = job["trip_id"]
+    try:
+        request = schemas.ProcessPaymentRequest(
+            trip_id=trip_id, user_id=job.get("user_id"), driver_id=job.get("driver_id"), amount=job.get("amount")
+        )
+        result = await process_vnpay_payment(request)
     except Exception as e:
-        logger.error(f"Lỗi khi cộng tiền vào ví tài xế {driver_id}: {e}", exc_info=True)
-        return False
-# === [HẾT PHẦN THÊM] ===
+        result = {"status": "FAILED", "message": str(e)}
+
+    now = datetime.now(timezone.utc)
+    if result.get("status") == "PENDING":
+        await jobs_coll.update_one(
+            {"_id": job["_id"], "status": "PROCESSING"},
+            {"$set": {
+                "status": "DONE",
+                "transaction_id": result.get("transaction_id"),
+                "payUrl": result.get("payUrl"),
+                "completed_at": now
+            }, "$unset": {"locked_until": ""}}
+        )
+        # Chuyến đi giữ PENDING kèm transaction_id; IPN sẽ báo SUCCESS/FAILED sau
+        await notify_trip_service_payment_status(trip_id, result.get("transaction_id"), models.TransactionStatus.PENDING)
+        return
 
+    error_message = result.get("message")
+    if job.get("attempts", 0) >= PAYMENT_JOB_MAX_ATTEMPTS:
+        logger.error(f"PaymentService: Job thanh toán chuyến {trip_id} thất bại sau {job.get('attempts')} lần: {error_message}")
+        await jobs_coll.update_one(
+            {"_id": job["_id"], "status": "PROCESSING"},
+            {"$set": {"status": "FAILED", "last_error": error_message, "completed_at": now}, "$unset": {"locked_until": ""}}
+        )
+        await notify_trip_service_payment_status(trip_id, None, models.TransactionStatus.FAILED)
+        return
+
+    retry_in = 2 ** job.get("attempts", 1)
+    logger.warning(f"PaymentService: Job thanh toán chuyến {trip_id} lỗi ({error_message}), thử lại sau {retry_in}s.")
+    await jobs_coll.update_one(
+        {"_id": job["_id"], "status": "PROCESSING"},
+        {"$set": {"status": "QUEUED", "available_at": now + timedelta(seconds=retry_in), "last_error": error_message},
+         "$unset": {"locked_until": ""}}
+    )
 
+async def get_payment_job(trip_id: str) -> Optional[Dict[str, Any]]:
+    """Trạng thái job thanh toán của một chuyến (kèm payUrl khi đã tạo xong)."""
+    jobs_coll = await get_payment_jobs_collection()
+    return await jobs_coll.find_one({"_id": trip_id})
@@ -14,6 +14,10 @@ logger = logging.getLogger(__name__)
 # Đọc URL MongoDB từ biến môi trường
 MONGODB_URL = os.getenv("MONGODB_URL")
 DB_NAME = os.getenv("MONGO_INITDB_DATABASE", "uitgo_payments")
+# Hàng đợi job thanh toán do TripService ghi vào (mặc định nằm chung DB của PaymentService)
+PAYMENT_QUEUE_DATABASE = os.getenv("PAYMENT_QUEUE_DATABASE", DB_NAME)
+# Response lưu theo Idempotency-Key (xem idempotency.py) tự hết hạn sau chừng này giây
+IDEMPOTENCY_TTL_SECONDS = int(os.getenv("IDEMPOTENCY_TTL_SECONDS", 24 * 3600))
 
 if not MONGODB_URL:
     logger.error("PaymentService: Lỗi nghiêm trọng - Không tìm thấy biến môi trường MONGODB_URL.")
@@ -50,6 +54,36 @@ async def get_transactions_collection() -> AsyncIOMotorCollection:
         raise Exception("PaymentService: Database chưa được khởi tạo thành công.")
     return database.get_collection("transactions")
 
+async def get_payment_jobs_collection() -> AsyncIOMotorCollection:
+    """Lấy collection 'payment_jobs' (hàng đợi thanh toán E-Wallet)."""
+    if client is None:
+        raise Exception("PaymentService: Database chưa được khởi tạo thành công.")
+    return client[PAYMENT_QUEUE_DATABASE].get_collection("payment_jobs")
+
+async def get_idempotency_collection() -> AsyncIOMotorCollection:
+    """Lấy collection 'idempotency_keys' (response lưu theo Idempotency-Key)."""
+    if database is None:
+        raise Exception("PaymentService: Database chưa được khởi tạo thành công.")
+    return database.get_collection("idempotency_keys")
+
+async def get_pending_earnings_collection() -> AsyncIOMotorCollection:
+    """Lấy collection 'pending_earnings' (thu nhập tài xế chờ quyết toán theo lô)."""
+    if database is None:
+        raise Exception("PaymentService: Database chưa được khởi tạo thành công.")
+    return database.get_collection("pending_earnings")
+
+async def get_settlement_batches_collection() -> AsyncIOMotorCollection:
+    """Lấy collection 'settlement_batches' (báo cáo đối soát từng lô quyết toán)."""
+    if database is None:
+        raise Exception("PaymentService: Database chưa được khởi tạo thành công.")
+    return database.get_collection("settlement_batches")
+
+async def get_vnpay_callbacks_collection() -> AsyncIOMotorCollection:
+    """Lấy collection 'vnpay_callbacks' (IPN đã xác thực chữ ký, chờ worker xử lý)."""
+    if database is None:
+        raise Exception("PaymentService: Database chưa được khởi tạo thành công.")
+    return database.get_collection("vnpay_callbacks")
+
 # --- HÀM TẠO INDEX (Vẫn cần gọi khi startup) ---
 async def create_payment_indexes():
     """Tạo các index cần thiết (nên gọi khi ứng dụng khởi động)."""
@@ -62,7 +96,23 @@ async def create_payment_indexes():
         
         transactions_coll = await get_transactions_collection()
         await transactions_coll.create_index("trip_id", background=True)
+        # Callback VNPay tra giao dịch theo mã đơn (vnp_TxnRef)
+        await transactions_coll.create_index("transaction_id", sparse=True, background=True)
         # Thêm index khác nếu cần (ví dụ: status, created_at cho transaction)
+
+        jobs_coll = await get_payment_jobs_collection()
+        await jobs_coll.create_index([("status", 1), ("available_at", 1)], background=True)
+
+        idempotency_coll = await get_idempotency_collection()
+        await idempotency_coll.create_index("created_at", expireAfterSeconds=IDEMPOTENCY_TTL_SECONDS, background=True)
+
+        callbacks_coll = await get_vnpay_callbacks_collection()
+        await callbacks_coll.create_index([("status", 1), ("available_at", 1)], background=True)
+
+        pending_coll = await get_pending_earnings_collection()
+        await pending_coll.create_index([("status", 1), ("created_at", 1)], background=True)
+        await pending_coll.create_index("batch_id", background=True)
+        await pending_coll.create_index([("driver_id", 1), ("status", 1)], background=True)
         
         logger.info("PaymentService: Đã tạo/đảm bảo index.")
     except Exception as e:
@@ -0,0 +1,63 @@
+"""Idempotency-Key cho /v1/payment/process: retry cùng key trả lại link đã tạo, không thêm giao dịch PENDING."""
+import hashlib
+import json
+import logging
+import os
+from datetime import datetime, timezone, timedelta
+from typing import Any, Awaitable, Callable, Optional
+
+from fastapi import HTTPException
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from pymongo.errors import DuplicateKeyError
+
+from database import get_idempotency_collection
+
+logger = logging.getLogger(__name__)
+
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+# Request đầu tiên giữ key tối đa chừng này giây; quá hạn thì coi như đã chết và cho retry tiếp quản
+IDEMPOTENCY_LOCK_SECONDS = int(os.getenv("IDEMPOTENCY_LOCK_SECONDS", 60))
+
+def request_fingerprint(payload: Any) -> str:
+    """Hash ổn định của body để phát hiện cùng key nhưng khác request."""
+    canonical = json.dumps(jsonable_encoder(payload), sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+async def run_idempotent(key: Optional[str], scope: str, payload: Any, handler: Callable[[], Awaitable[Any]]) -> Any:
+    """Run handler once per (scope, key); later calls with the same key replay the stored response"""
+    if not key:
+        return await handler()
+
+    keys_coll = await get_idempotency_collection()
+    record_id = f"{scope}:{key}"
+    fingerprint = request_fingerprint(payload)
+    now = datetime.now(timezone.utc)
+    try:
+        await keys_coll.insert_one({"_id": record_id, "fingerprint": fingerprint, "state": "IN_PROGRESS", "created_at": now})
+    except DuplicateKeyError:
+        record = await keys_coll.find_one({"_id": record_id})
+        if record is None:
+            raise HTTPException(status_code=409, detail="Idempotency-Key vừa hết hạn, hãy thử lại.", headers={"Retry-After": "1"})
+        if record.get("fingerprint") != fingerprint:
+            raise HTTPException(status_code=422, detail="Idempotency-Key đã được dùng cho một request khác.")
+        if record.get("state") == "DONE":
+            logger.info(f"Idempotency: phát lại response đã lưu cho {record_id}")
+            return JSONResponse(record["response"], headers={"Idempotent-Replayed": "true"})
+        taken = await keys_coll.find_one_and_update(
+            {"_id": record_id, "state": "IN_PROGRESS", "created_at": {"$lte": now - timedelta(seconds=IDEMPOTENCY_LOCK_SECONDS)}},
+            {"$set": {"created_at": now}}
+        )
+        if taken is None:
+            raise HTTPException(status_code=409, detail="Request với Idempotency-Key này đang được xử lý.", headers={"Retry-After": "1"})
+
+    try:
+        result = await handler()
+    except Exception:
+        # Không lưu lỗi (VNPay/DB lỗi): nhả key để lần retry sau được chạy lại
+        await keys_coll.delete_one({"_id": record_id})
+        raise
+
+    content = jsonable_encoder(result)
+    await keys_coll.update_one({"_id": record_id}, {"$set": {"state": "DONE", "response": content}})
+    return JSONResponse(content)
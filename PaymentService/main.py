@@ -1,34 +1,80 @@
 # PaymentService/main.py (Đã sửa đổi)
 
 import os
-import hashlib
-import hmac
+import asyncio
 import logging
-from fastapi import FastAPI, HTTPException, status, Request, Depends # <-- Thêm Request, Depends
-from typing import List, AsyncGenerator, Dict, Any # <-- Thêm AsyncGenerator, Dict, Any
-from urllib.parse import parse_qsl, quote_plus
+from fastapi import FastAPI, HTTPException, status, Request, Depends, Header # <-- Thêm Request, Depends
+from typing import List, AsyncGenerator, Dict, Any, Optional # <-- Thêm AsyncGenerator, Dict, Any
+from urllib.parse import parse_qsl
 from contextlib import asynccontextmanager # <-- Thêm asynccontextmanager
 
 # Import từ các file khác trong PaymentService
 import crud
+import settlement
+import wallet
+import vnpay_signing
 import schemas
 import models
 # --- Sửa cách import database và thêm hàm tạo index ---
 from database import create_payment_indexes, get_wallets_collection, get_transactions_collection
+from idempotency import IDEMPOTENCY_HEADER, run_idempotent
 
 # --- Cấu hình Logging ---
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+PAYMENT_WORKER_POLL_SECONDS = float(os.getenv("PAYMENT_WORKER_POLL_SECONDS", 1.0))
+SETTLEMENT_INTERVAL_SECONDS = float(os.getenv("SETTLEMENT_INTERVAL_SECONDS", 30.0))
+
+async def _run_payment_worker():
+    """Tiêu thụ hàng đợi thanh toán E-Wallet do TripService ghi khi hoàn thành chuyến."""
+    while True:
+        try:
+            job = await crud.claim_payment_job()
+            if job:
+                await crud.process_payment_job(job)
+                continue
+        except Exception as e:
+            logger.error(f"PaymentService: Lỗi trong payment worker: {e}", exc_info=True)
+        await asyncio.sleep(PAYMENT_WORKER_POLL_SECONDS)
+
+async def _run_vnpay_callback_worker():
+    """Xử lý các IPN đã được ghi nhận (cập nhật giao dịch, thu nhập tài xế, báo TripService)."""
+    while True:
+        try:
+            callback = await crud.claim_vnpay_callback()
+            if callback:
+                await crud.process_vnpay_callback(callback)
+                continue
+        except Exception as e:
+            logger.error(f"PaymentService: Lỗi trong IPN worker: {e}", exc_info=True)
+        await asyncio.sleep(PAYMENT_WORKER_POLL_SECONDS)
+
+async def _run_settlement_worker():
+    """Định kỳ hoàn tất bút toán ví còn PENDING và quyết toán thu nhập tài xế đang chờ theo lô."""
+    while True:
+        await asyncio.sleep(SETTLEMENT_INTERVAL_SECONDS)
+        try:
+            await wallet.finish_pending_entries()
+            await settlement.run_settlement_cycle()
+        except Exception as e:
+            logger.error(f"PaymentService: Lỗi trong settlement worker: {e}", exc_info=True)
+
 # --- LIFESPAN MANAGER (Để tạo Index khi khởi động) ---
 @asynccontextmanager
 async def lifespan(app: FastAPI) -> AsyncGenerator[None, None]:
     logger.info("PaymentService: Đang khởi động...")
     # Gọi hàm tạo index khi startup
     await create_payment_indexes()
+    worker_task = asyncio.create_task(_run_payment_worker())
+    settlement_task = asyncio.create_task(_run_settlement_worker())
+    callback_task = asyncio.create_task(_run_vnpay_callback_worker())
     logger.info("PaymentService: Khởi động hoàn tất.")
     yield # Ứng dụng chạy ở đây
     logger.info("PaymentService: Đang tắt...")
+    worker_task.cancel()
+    settlement_task.cancel()
+    callback_task.cancel()
     # (Không cần đóng kết nối MongoDB rõ ràng với motor)
     logger.info("PaymentService: Tắt hoàn tất.")
 
@@ -64,26 +110,52 @@ async def top_up_driver_wallet_endpoint(request: schemas.TopUpRequest):
         raise HTTPException(status_code=500, detail="Lỗi khi nạp tiền vào ví.")
     return updated_wallet
 
+@app.get("/v1/wallets/{driver_id}/reconciliation", response_model=schemas.WalletReconciliation, tags=["Wallet"])
+async def reconcile_driver_wallet_endpoint(driver_id: str):
+    """Đối soát số dư ví với ledger và thu nhập chưa quyết toán."""
+    return await settlement.reconcile_driver(driver_id)
+
+@app.get("/v1/settlements/batches", response_model=List[schemas.SettlementBatchReport], tags=["Wallet"])
+async def list_settlement_batches_endpoint(limit: int = 20):
+    """Báo cáo các lô quyết toán gần nhất."""
+    return await settlement.list_settlement_batches(min(max(limit, 1), 200))
+
 # === ENDPOINTS CHO THANH TOÁN (PAYMENT) ===
 
 @app.post("/v1/payment/process", response_model=schemas.PaymentLinkResponse, tags=["Payment"])
-async def handle_payment_processing(request: schemas.ProcessPaymentRequest):
+async def handle_payment_processing(
+    request: schemas.ProcessPaymentRequest,
+    idempotency_key: Optional[str] = Header(None, alias=IDEMPOTENCY_HEADER)
+):
     """
     Endpoint chính để TripService gọi khi cần tạo link thanh toán VNPay.
+    Gửi kèm Idempotency-Key để retry không tạo thêm giao dịch PENDING.
     """
     logger.info(f"Nhận yêu cầu xử lý thanh toán cho chuyến đi: {request.trip_id}")
-    # Gọi hàm crud đã sửa (đổi tên cho khớp)
-    result = await crud.process_vnpay_payment(request) # <-- Sửa tên hàm crud
 
-    if result.get("status") == "FAILED":
-        logger.error(f"Lỗi khi tạo link VNPay: {result.get('message')}")
-        raise HTTPException(
-            status_code=500, # Lỗi server vì không tạo được link
-            detail=result.get("message", "Lỗi không xác định khi xử lý thanh toán")
-        )
+    async def _process():
+        # Gọi hàm crud đã sửa (đổi tên cho khớp)
+        result = await crud.process_vnpay_payment(request) # <-- Sửa tên hàm crud
+
+        if result.get("status") == "FAILED":
+            logger.error(f"Lỗi khi tạo link VNPay: {result.get('message')}")
+            raise HTTPException(
+                status_code=500, # Lỗi server vì không tạo được link
+                detail=result.get("message", "Lỗi không xác định khi xử lý thanh toán")
+            )
+
+        # Trả về link thanh toán và transaction_id
+        return schemas.PaymentLinkResponse(**result)
+
+    return await run_idempotent(idempotency_key, "POST /v1/payment/process", request, _process)
 
-    # Trả về link thanh toán và transaction_id
-    return result
+@app.get("/v1/payment/jobs/{trip_id}", response_model=schemas.PaymentJobResponse, tags=["Payment"])
+async def get_payment_job_endpoint(trip_id: str):
+    """Trạng thái thanh toán E-Wallet đang xếp hàng cho chuyến đi (payUrl có khi job xong)."""
+    job = await crud.get_payment_job(trip_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Không tìm thấy job thanh toán cho chuyến đi này.")
+    return job
 
 # === [ENDPOINT MỚI QUAN TRỌNG] XỬ LÝ IPN TỪ VNPAY ===
 @app.get("/v1/payment/vnpay_ipn", tags=["VNPay Callback"])
@@ -97,20 +169,22 @@ async def handle_vnpay_ipn(request: Request):
     vnp_txn_ref = ipn_data.get('vnp_TxnRef')
     logger.info(f"Nhận được IPN callback từ VNPay cho TxnRef: {vnp_txn_ref}. Data: {ipn_data}")
 
-    # Gọi hàm crud để xử lý (hàm này đã có kiểm tra hash và cập nhật DB)
-    success = await crud.handle_vnpay_return(ipn_data)
-
-    # Phản hồi cho VNPAY theo yêu cầu
-    if success:
-        logger.info(f"Xử lý IPN thành công cho TxnRef: {vnp_txn_ref}")
-        return {"RspCode": "00", "Message": "Confirm Success"}
-    else:
-        # Nếu crud.handle_vnpay_return trả về False (lỗi hash, lỗi DB, hoặc giao dịch không hợp lệ)
-        # Vẫn cần trả về lỗi cho VNPAY biết để họ có thể thử gửi lại IPN
-        logger.error(f"Xử lý IPN thất bại cho TxnRef: {vnp_txn_ref}")
-        # Mã lỗi '99' hoặc mã lỗi cụ thể hơn nếu có thể xác định
-        # Quan trọng: KHÔNG trả về 00 nếu xử lý phía bạn lỗi, VNPAY sẽ gửi lại IPN
+    # Chỉ kiểm tra chữ ký và lưu callback rồi phản hồi ngay; worker xử lý phần còn lại
+    if not crud.verify_vnpay_signature(ipn_data):
+        return {"RspCode": "97", "Message": "Invalid Signature"}
+    if not vnp_txn_ref:
+        return {"RspCode": "01", "Message": "Order not found"}
+    try:
+        previous = await crud.record_vnpay_callback(ipn_data)
+    except Exception as e:
+        # Chưa lưu được: KHÔNG trả 00 để VNPAY gửi lại IPN
+        logger.error(f"Không lưu được IPN cho TxnRef {vnp_txn_ref}: {e}", exc_info=True)
         return {"RspCode": "99", "Message": "Unknown error"}
+
+    if previous is not None and previous.get("status") == "DONE":
+        return {"RspCode": "02", "Message": "Order already confirmed"}
+    logger.info(f"Đã ghi nhận IPN cho TxnRef: {vnp_txn_ref}")
+    return {"RspCode": "00", "Message": "Confirm Success"}
 # === [HẾT ENDPOINT IPN] ===
 
 # === [SỬA ĐỔI HOÀN TOÀN ENDPOINT NÀY] ===
@@ -127,21 +201,13 @@ async def handle_vnpay_return_message(request: Request):
     logger.info(f"Nhận được Return callback từ VNPay cho TxnRef: {vnp_txn_ref}. Code: {vnp_response_code}")
 
     # --- Bước 1: Vẫn phải kiểm tra Secure Hash ---
-    vnp_secure_hash = return_data.pop('vnp_SecureHash', None)
     secret_key = os.getenv("VNP_HASH_SECRET")
-    if not secret_key or not vnp_secure_hash:
+    if not secret_key or not return_data.get('vnp_SecureHash'):
          logger.error("Thiếu VNP_HASH_SECRET hoặc vnp_SecureHash trong return data.")
          # Trả về lỗi JSON thay vì HTTPException
          return {"RspCode": "97", "Message": "Invalid Data (Missing Hash)"}
 
-    # Sắp xếp lại các tham số còn lại để tạo hash
-    input_params = {k: v for k, v in return_data.items() if k.startswith('vnp_')}
-    sorted_params = sorted(input_params.items())
-    hash_data_string = "&".join([f"{key}={quote_plus(str(value))}" for key, value in sorted_params])
-    h = hmac.new(secret_key.encode(), hash_data_string.encode(), hashlib.sha512)
-    calculated_hash = h.hexdigest()
-
-    if calculated_hash != vnp_secure_hash:
+    if not vnpay_signing.signer_for(secret_key).verify(return_data):
         logger.error(f"VNPay Return: Sai Secure Hash! TxnRef: {vnp_txn_ref}")
         # Trả về lỗi JSON
         return {"RspCode": "97", "Message": "Invalid Signature"}
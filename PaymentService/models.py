@@ -26,13 +26,22 @@ class Wallet(BaseModel):
 
 class Transaction(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()), alias="_id")
-    wallet_id: str = Field(...)
+    wallet_id: Optional[str] = None  # giao dịch thanh toán VNPay không gắn với ví
+    transaction_id: Optional[str] = None  # mã đơn gửi VNPay (vnp_TxnRef)
+    payment_method: Optional[str] = None
+    user_id: Optional[str] = None
     transaction_type: TransactionType = Field(...)
     amount: float = Field(...)
     trip_id: Optional[str] = None
     status: TransactionStatus = Field(...)
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
     error_message: Optional[str] = None
+    description: Optional[str] = None
+    balance_after: Optional[float] = None  # số dư ví ngay sau bút toán
+    # Đầu vào quyết toán lưu sẵn lúc tạo giao dịch VNPay để callback không phải gọi TripService
+    driver_id: Optional[str] = None
+    commission_rate: Optional[float] = None
+    driver_earning: Optional[float] = None
 
     class Config:
         populate_by_name = True
\ No newline at end of file
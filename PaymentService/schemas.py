@@ -1,5 +1,5 @@
 from pydantic import BaseModel, Field
-from typing import Optional
+from typing import Optional, List
 from datetime import datetime
 # from models import TransactionStatus # Không cần thiết nếu không dùng trực tiếp ở đây
 
@@ -21,3 +21,36 @@ class ProcessPaymentRequest(BaseModel):
 class PaymentLinkResponse(BaseModel):
     status: str
     payUrl: str
+
+class PaymentJobResponse(BaseModel):
+    trip_id: str
+    status: str
+    attempts: int = 0
+    transaction_id: Optional[str] = None
+    payUrl: Optional[str] = None
+    last_error: Optional[str] = None
+
+class SettlementDriverTotal(BaseModel):
+    driver_id: str
+    amount: float
+    entries: int
+
+class SettlementBatchReport(BaseModel):
+    batch_id: str = Field(..., alias="_id", serialization_alias="batch_id")
+    status: str
+    entries: int
+    skipped_duplicates: int
+    drivers: int
+    total_amount: float
+    per_driver: List[SettlementDriverTotal]
+    started_at: datetime
+    finished_at: datetime
+
+class WalletReconciliation(BaseModel):
+    driver_id: str
+    wallet_balance: float
+    ledger_total: float
+    ledger_entries: int
+    difference: float
+    pending_amount: float
+    pending_entries: int
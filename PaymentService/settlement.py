@@ -0,0 +1,217 @@
+"""Quyết toán thu nhập tài xế theo lô: IPN chỉ ghi pending, worker gộp theo tài xế rồi bulk_write $inc."""
+import logging
+import os
+import uuid
+from collections import defaultdict
+from datetime import datetime, timezone, timedelta
+from typing import Any, Dict, List, Optional
+
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+import models
+import wallet
+from database import (
+    get_pending_earnings_collection,
+    get_settlement_batches_collection,
+    get_transactions_collection,
+    get_wallets_collection,
+)
+
+logger = logging.getLogger(__name__)
+
+SETTLEMENT_BATCH_SIZE = int(os.getenv("SETTLEMENT_BATCH_SIZE", 1000))
+# Lô ở trạng thái SETTLING quá lâu (worker chết giữa chừng) sẽ được chạy lại
+SETTLEMENT_LEASE_SECONDS = int(os.getenv("SETTLEMENT_LEASE_SECONDS", 300))
+# Số lô gần nhất lưu trên mỗi ví để $inc không bị áp hai lần khi chạy lại một lô
+SETTLED_BATCHES_KEPT = 50
+_DUPLICATE_KEY = 11000
+
+async def record_pending_earning(driver_id: str, amount: float, trip_id: str) -> bool:
+    """Ghi thu nhập chờ quyết toán (một insert); IPN lặp lại cho cùng chuyến bị bỏ qua."""
+    pending_coll = await get_pending_earnings_collection()
+    try:
+        await pending_coll.insert_one({
+            "_id": wallet.earning_entry_id(trip_id),
+            "driver_id": driver_id,
+            "trip_id": trip_id,
+            "amount": amount,
+            "status": "PENDING",
+            "created_at": datetime.now(timezone.utc),
+        })
+        return True
+    except DuplicateKeyError:
+        logger.info(f"PaymentService: Thu nhập chuyến {trip_id} đã được ghi nhận trước đó.")
+        return False
+
+async def _claim_batch() -> Optional[str]:
+    """Nhận một lô: ưu tiên lô SETTLING đã hết lease, nếu không thì gom tối đa SETTLEMENT_BATCH_SIZE bản ghi PENDING."""
+    pending_coll = await get_pending_earnings_collection()
+    now = datetime.now(timezone.utc)
+    stale = await pending_coll.find_one(
+        {"status": "SETTLING", "settling_since": {"$lte": now - timedelta(seconds=SETTLEMENT_LEASE_SECONDS)}},
+        {"batch_id": 1}
+    )
+    if stale:
+        logger.warning(f"PaymentService: Chạy lại lô quyết toán dang dở {stale['batch_id']}.")
+        await pending_coll.update_many(
+            {"batch_id": stale["batch_id"], "status": "SETTLING"}, {"$set": {"settling_since": now}}
+        )
+        return stale["batch_id"]
+
+    ids = [doc["_id"] async for doc in pending_coll.find({"status": "PENDING"}, {"_id": 1}).sort("created_at", 1).limit(SETTLEMENT_BATCH_SIZE)]
+    if not ids:
+        return None
+    batch_id = f"SB-{now:%Y%m%d%H%M%S}-{uuid.uuid4().hex[:8]}"
+    result = await pending_coll.update_many(
+        {"_id": {"$in": ids}, "status": "PENDING"},
+        {"$set": {"status": "SETTLING", "batch_id": batch_id, "settling_since": now}}
+    )
+    return batch_id if result.modified_count else None
+
+async def _write_ledger(batch_id: str, entries: List[Dict[str, Any]]) -> set:
+    """Ghi ledger EARNING cho từng chuyến; trả về _id các chuyến đã được cộng ở nơi khác (bỏ qua khi $inc)."""
+    transactions_coll = await get_transactions_collection()
+    docs = []
+    for entry in entries:
+        doc = wallet.ledger_document(
+            entry["_id"], None, entry["driver_id"], entry["amount"], models.TransactionType.EARNING,
+            entry["trip_id"], f"Thu nhập từ chuyến đi {entry['trip_id']}", None
+        )
+        doc["settlement_batch_id"] = batch_id
+        docs.append(doc)
+    try:
+        await transactions_coll.insert_many(docs, ordered=False)
+        return set()
+    except BulkWriteError as e:
+        duplicate_ids = [docs[err["index"]]["_id"] for err in e.details.get("writeErrors", []) if err.get("code") == _DUPLICATE_KEY]
+        if len(duplicate_ids) != len(e.details.get("writeErrors", [])):
+            raise
+    # Trùng vì chính lô này đã ghi (chạy lại) thì vẫn phải cộng; trùng với bút toán khác thì bỏ qua
+    return {
+        doc["_id"] async for doc in transactions_coll.find(
+            {"_id": {"$in": duplicate_ids}, "settlement_batch_id": {"$ne": batch_id}}, {"_id": 1}
+        )
+    }
+
+async def _apply_driver_totals(batch_id: str, totals: Dict[str, float]) -> None:
+    """Một bulk_write $inc cho cả lô; mỗi ví nhớ batch_id nên chạy lại lô không cộng hai lần."""
+    wallets_coll = await get_wallets_collection()
+    now = datetime.now(timezone.utc)
+    remaining = dict(totals)
+    for _ in range(3):
+        operations = []
+        for driver_id, amount in remaining.items():
+            update = wallet.wallet_upsert(driver_id, amount, now)
+            update["$push"] = {"settled_batches": {"$each": [batch_id], "$slice": -SETTLED_BATCHES_KEPT}}
+            operations.append(UpdateOne({"driver_id": driver_id, "settled_batches": {"$ne": batch_id}}, update, upsert=True))
+        try:
+            await wallets_coll.bulk_write(operations, ordered=False)
+            return
+        except BulkWriteError as e:
+            errors = e.details.get("writeErrors", [])
+            if any(err.get("code") != _DUPLICATE_KEY for err in errors):
+                raise
+            conflicted = [list(remaining)[err["index"]] for err in errors]
+        # Trùng driver_id: hoặc ví đã nhận lô này (bỏ qua), hoặc ví vừa được tạo song song (thử lại)
+        applied = {
+            doc["driver_id"] async for doc in wallets_coll.find(
+                {"driver_id": {"$in": conflicted}, "settled_batches": batch_id}, {"driver_id": 1}
+            )
+        }
+        remaining = {driver_id: remaining[driver_id] for driver_id in conflicted if driver_id not in applied}
+        if not remaining:
+            return
+    raise RuntimeError(f"Không thể cộng tiền cho {len(remaining)} ví trong lô {batch_id}")
+
+async def settle_batch(batch_id: str) -> Dict[str, Any]:
+    """Quyết toán một lô đã nhận; an toàn khi chạy lại (ledger theo _id, ví theo settled_batches)."""
+    pending_coll = await get_pending_earnings_collection()
+    batches_coll = await get_settlement_batches_collection()
+    started_at = datetime.now(timezone.utc)
+    entries = await pending_coll.find({"batch_id": batch_id, "status": "SETTLING"}).to_list(length=None)
+    if not entries:
+        return {}
+
+    already_credited = await _write_ledger(batch_id, entries)
+    totals: Dict[str, float] = defaultdict(float)
+    entry_counts: Dict[str, int] = defaultdict(int)
+    for entry in entries:
+        if entry["_id"] in already_credited:
+            continue
+        totals[entry["driver_id"]] += entry["amount"]
+        entry_counts[entry["driver_id"]] += 1
+    if totals:
+        await _apply_driver_totals(batch_id, totals)
+
+    finished_at = datetime.now(timezone.utc)
+    await pending_coll.update_many(
+        {"batch_id": batch_id, "status": "SETTLING"},
+        {"$set": {"status": "SETTLED", "settled_at": finished_at}}
+    )
+    report = {
+        "_id": batch_id,
+        "status": "SETTLED",
+        "entries": len(entries),
+        "skipped_duplicates": len(already_credited),
+        "drivers": len(totals),
+        "total_amount": sum(totals.values()),
+        "per_driver": [
+            {"driver_id": driver_id, "amount": amount, "entries": entry_counts[driver_id]}
+            for driver_id, amount in sorted(totals.items())
+        ],
+        "started_at": started_at,
+        "finished_at": finished_at,
+    }
+    await batches_coll.replace_one({"_id": batch_id}, report, upsert=True)
+    logger.info(
+        f"PaymentService: Quyết toán lô {batch_id}: {len(entries)} chuyến, {len(totals)} tài xế, "
+        f"tổng {report['total_amount']}, bỏ qua {len(already_credited)} bút toán trùng."
+    )
+    return report
+
+async def run_settlement_cycle() -> int:
+    """Quyết toán mọi lô đang chờ; trả về số lô đã xử lý."""
+    settled = 0
+    while True:
+        batch_id = await _claim_batch()
+        if batch_id is None:
+            return settled
+        await settle_batch(batch_id)
+        settled += 1
+
+async def list_settlement_batches(limit: int = 20) -> List[Dict[str, Any]]:
+    batches_coll = await get_settlement_batches_collection()
+    return await batches_coll.find().sort("finished_at", -1).limit(limit).to_list(length=limit)
+
+async def reconcile_driver(driver_id: str) -> Dict[str, Any]:
+    """Đối soát: số dư ví so với tổng ledger, kèm thu nhập chưa quyết toán."""
+    wallets_coll = await get_wallets_collection()
+    transactions_coll = await get_transactions_collection()
+    pending_coll = await get_pending_earnings_collection()
+
+    wallet_doc = await wallets_coll.find_one({"driver_id": driver_id}, {"balance": 1})
+    ledger = await transactions_coll.aggregate([
+        {"$match": {
+            "user_id": driver_id,
+            "status": models.TransactionStatus.SUCCESS.value,
+            "transaction_type": {"$in": [models.TransactionType.EARNING.value, models.TransactionType.TOPUP.value]},
+        }},
+        {"$group": {"_id": None, "total": {"$sum": "$amount"}, "count": {"$sum": 1}}},
+    ]).to_list(length=1)
+    pending = await pending_coll.aggregate([
+        {"$match": {"driver_id": driver_id, "status": {"$in": ["PENDING", "SETTLING"]}}},
+        {"$group": {"_id": None, "total": {"$sum": "$amount"}, "count": {"$sum": 1}}},
+    ]).to_list(length=1)
+
+    wallet_balance = wallet_doc["balance"] if wallet_doc else 0.0
+    ledger_total = ledger[0]["total"] if ledger else 0.0
+    return {
+        "driver_id": driver_id,
+        "wallet_balance": wallet_balance,
+        "ledger_total": ledger_total,
+        "ledger_entries": ledger[0]["count"] if ledger else 0,
+        "difference": round(wallet_balance - ledger_total, 2),
+        "pending_amount": pending[0]["total"] if pending else 0.0,
+        "pending_entries": pending[0]["count"] if pending else 0,
+    }
@@ -0,0 +1,45 @@
+"""Ký và kiểm tra chữ ký VNPay (HMAC-SHA512) dùng chung cho tạo link, IPN và Return URL."""
+import hashlib
+import hmac
+from functools import lru_cache
+from typing import Any, Mapping
+from urllib.parse import quote_plus
+
+# Hai trường này không nằm trong chuỗi ký (theo tài liệu VNPay 2.1.0)
+_UNSIGNED_FIELDS = frozenset({"vnp_SecureHash", "vnp_SecureHashType"})
+
+def _encode(value: Any) -> str:
+    text = value if isinstance(value, str) else str(value)
+    # Phần lớn giá trị (số tiền, mã, ngày) là chữ/số ASCII: quote_plus giữ nguyên nên bỏ qua cho nhanh
+    return text if text.isascii() and text.isalnum() else quote_plus(text)
+
+def canonical_query(params: Mapping[str, Any]) -> str:
+    """Chuỗi dữ liệu ký: các tham số vnp_* sắp theo tên, giá trị quote_plus, nối bằng '&'."""
+    return "&".join([
+        f"{key}={_encode(value)}"
+        for key, value in sorted(params.items())
+        if key.startswith("vnp_") and key not in _UNSIGNED_FIELDS
+    ])
+
+class VnpaySigner:
+    """Keeps the keyed HMAC state so each signature only hashes the message (hmac.copy())"""
+
+    def __init__(self, secret: str):
+        self._keyed = hmac.new(secret.encode("utf-8"), digestmod=hashlib.sha512)
+
+    def sign(self, params: Mapping[str, Any]) -> str:
+        h = self._keyed.copy()
+        h.update(canonical_query(params).encode("utf-8"))
+        return h.hexdigest()
+
+    def verify(self, params: Mapping[str, Any]) -> bool:
+        """So sánh vnp_SecureHash nhận được với chữ ký tự tính, thời gian hằng (compare_digest)."""
+        received = params.get("vnp_SecureHash")
+        if not received or not isinstance(received, str):
+            return False
+        return hmac.compare_digest(self.sign(params), received.lower())
+
+@lru_cache(maxsize=4)
+def signer_for(secret: str) -> VnpaySigner:
+    """Một VnpaySigner cho mỗi secret, tạo một lần và dùng lại giữa các request."""
+    return VnpaySigner(secret)
@@ -0,0 +1,193 @@
+"""Wallet engine: cộng/trừ số dư ví và ghi sổ giao dịch (ledger) như một thao tác ghi duy nhất."""
+import logging
+import os
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, NamedTuple, Optional
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError, OperationFailure
+
+import models
+from database import client, get_wallets_collection, get_transactions_collection
+
+logger = logging.getLogger(__name__)
+
+# MongoDB standalone (docker-compose) không hỗ trợ transaction: khi đó ghi ledger trước rồi mới cộng số dư
+WALLET_USE_TRANSACTIONS = os.getenv("WALLET_USE_TRANSACTIONS", "true").lower() == "true"
+# Mã lỗi IllegalOperation: "Transaction numbers are only allowed on a replica set member or mongos"
+_TRANSACTIONS_UNSUPPORTED_CODE = 20
+
+class WalletEntryResult(NamedTuple):
+    balance: float
+    applied: bool  # False nếu bút toán cùng entry_id đã được ghi trước đó
+
+def wallet_upsert(driver_id: str, amount: float, now: datetime) -> Dict[str, Any]:
+    return {
+        "$inc": {"balance": amount},
+        "$set": {"updated_at": now},
+        "$setOnInsert": {"_id": str(uuid.uuid4()), "user_id": driver_id, "created_at": now},
+    }
+
+async def get_or_create_wallet(driver_id: str) -> Optional[Dict[str, Any]]:
+    """Lấy ví, tạo mới (số dư 0) nếu chưa có — một round trip."""
+    wallets_coll = await get_wallets_collection()
+    wallet = await wallets_coll.find_one_and_update(
+        {"driver_id": driver_id},
+        wallet_upsert(driver_id, 0, datetime.now(timezone.utc)),
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    wallet["_id"] = str(wallet["_id"])
+    return wallet
+
+def ledger_document(
+    entry_id: str,
+    wallet_id: Optional[str],
+    driver_id: str,
+    amount: float,
+    transaction_type: models.TransactionType,
+    trip_id: Optional[str],
+    description: Optional[str],
+    balance_after: Optional[float],
+    status: models.TransactionStatus = models.TransactionStatus.SUCCESS
+) -> Dict[str, Any]:
+    entry = models.Transaction(
+        id=entry_id,
+        wallet_id=wallet_id or driver_id,
+        user_id=driver_id,
+        transaction_type=transaction_type,
+        amount=amount,
+        trip_id=trip_id,
+        status=status,
+        description=description,
+        balance_after=balance_after
+    )
+    return entry.model_dump(by_alias=True, exclude_none=True)
+
+async def _apply_in_transaction(driver_id: str, amount: float, entry_id: str, **ledger) -> WalletEntryResult:
+    wallets_coll = await get_wallets_collection()
+    transactions_coll = await get_transactions_collection()
+    now = datetime.now(timezone.utc)
+
+    async def _write(session):
+        wallet = await wallets_coll.find_one_and_update(
+            {"driver_id": driver_id},
+            wallet_upsert(driver_id, amount, now),
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+            session=session
+        )
+        # Trùng entry_id -> DuplicateKeyError -> transaction bị hủy, số dư không đổi
+        await transactions_coll.insert_one(
+            ledger_document(entry_id, str(wallet["_id"]), driver_id, amount, balance_after=wallet["balance"], **ledger),
+            session=session
+        )
+        return wallet
+
+    async with await client.start_session() as session:
+        # with_transaction tự thử lại khi gặp WriteConflict (nhiều bút toán cùng ví đồng thời)
+        wallet = await session.with_transaction(_write)
+    return WalletEntryResult(wallet["balance"], True)
+
+async def _finish_pending_entry(entry: Dict[str, Any]) -> WalletEntryResult:
+    """Cộng số dư cho bút toán ledger còn PENDING rồi đánh dấu SUCCESS; gọi lại nhiều lần vẫn chỉ cộng một lần."""
+    wallets_coll = await get_wallets_collection()
+    transactions_coll = await get_transactions_collection()
+    entry_id, driver_id, amount = entry["_id"], entry["user_id"], entry["amount"]
+    wallet = None
+    for _ in range(2):
+        update = wallet_upsert(driver_id, amount, datetime.now(timezone.utc))
+        # pending_entries giữ entry_id tới khi ledger SUCCESS: lần chạy lại thấy marker thì không $inc nữa
+        update["$push"] = {"pending_entries": entry_id}
+        try:
+            wallet = await wallets_coll.find_one_and_update(
+                {"driver_id": driver_id, "pending_entries": {"$ne": entry_id}},
+                update,
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+            break
+        except DuplicateKeyError:
+            # Ví đã có marker (đã cộng trước khi bị ngắt) hoặc ví vừa được tạo đồng thời -> thử lại
+            wallet = await wallets_coll.find_one({"driver_id": driver_id, "pending_entries": entry_id})
+            if wallet is not None:
+                break
+    if wallet is None:
+        raise RuntimeError(f"PaymentService: Không cộng được bút toán {entry_id} vào ví {driver_id}.")
+    await transactions_coll.update_one(
+        {"_id": entry_id},
+        {"$set": {
+            "status": models.TransactionStatus.SUCCESS,
+            "wallet_id": str(wallet["_id"]),
+            "balance_after": wallet["balance"]
+        }}
+    )
+    # Bỏ marker sau khi ledger đã SUCCESS; nếu bị ngắt ở đây marker thừa cũng vô hại
+    await wallets_coll.update_one({"_id": wallet["_id"]}, {"$pull": {"pending_entries": entry_id}})
+    return WalletEntryResult(wallet["balance"], True)
+
+async def _apply_without_transaction(driver_id: str, amount: float, entry_id: str, **ledger) -> WalletEntryResult:
+    transactions_coll = await get_transactions_collection()
+    # Ghi ledger PENDING trước: entry_id trùng thì dừng; bị ngắt trước khi cộng tiền thì lần sau hoàn tất tiếp
+    entry = ledger_document(
+        entry_id, None, driver_id, amount, balance_after=None, status=models.TransactionStatus.PENDING, **ledger
+    )
+    await transactions_coll.insert_one(entry)
+    return await _finish_pending_entry(entry)
+
+async def finish_pending_entries(older_than_seconds: int = 60) -> int:
+    """Hoàn tất các bút toán ví còn PENDING quá `older_than_seconds` (process bị ngắt giữa chừng)."""
+    transactions_coll = await get_transactions_collection()
+    cutoff = datetime.now(timezone.utc) - timedelta(seconds=older_than_seconds)
+    finished = 0
+    # Giao dịch VNPay (PAYMENT) cũng PENDING nhưng không phải bút toán ví
+    cursor = transactions_coll.find({
+        "status": models.TransactionStatus.PENDING,
+        "transaction_type": {"$ne": models.TransactionType.PAYMENT},
+        "created_at": {"$lte": cutoff}
+    })
+    async for entry in cursor:
+        await _finish_pending_entry(entry)
+        finished += 1
+    if finished:
+        logger.warning(f"PaymentService: Đã hoàn tất {finished} bút toán ví còn PENDING.")
+    return finished
+
+async def apply_wallet_entry(
+    driver_id: str,
+    amount: float,
+    transaction_type: models.TransactionType,
+    trip_id: Optional[str] = None,
+    description: Optional[str] = None,
+    entry_id: Optional[str] = None
+) -> WalletEntryResult:
+    """Cộng `amount` (âm = trừ) vào ví và ghi ledger; entry_id cố định giúp gọi lại không cộng lần hai"""
+    global WALLET_USE_TRANSACTIONS
+    entry_id = entry_id or str(uuid.uuid4())
+    ledger = {"transaction_type": transaction_type, "trip_id": trip_id, "description": description}
+    try:
+        if WALLET_USE_TRANSACTIONS:
+            try:
+                return await _apply_in_transaction(driver_id, amount, entry_id, **ledger)
+            except OperationFailure as e:
+                if e.code != _TRANSACTIONS_UNSUPPORTED_CODE:
+                    raise
+                logger.warning("PaymentService: MongoDB không hỗ trợ transaction, chuyển sang ghi ledger trước rồi cộng số dư.")
+                WALLET_USE_TRANSACTIONS = False
+        return await _apply_without_transaction(driver_id, amount, entry_id, **ledger)
+    except DuplicateKeyError:
+        transactions_coll = await get_transactions_collection()
+        existing = await transactions_coll.find_one({"_id": entry_id})
+        if existing is None:
+            raise  # trùng key ở chỗ khác, không phải bút toán lặp
+        if existing.get("status") == models.TransactionStatus.PENDING:
+            logger.warning(f"PaymentService: Bút toán {entry_id} còn PENDING từ lần trước, hoàn tất tiếp.")
+            return await _finish_pending_entry(existing)
+        logger.info(f"PaymentService: Bút toán {entry_id} đã được ghi trước đó, bỏ qua.")
+        wallet = await get_or_create_wallet(driver_id)
+        return WalletEntryResult(wallet["balance"], False)
+
+def earning_entry_id(trip_id: str) -> str:
+    """Mỗi chuyến chỉ có một bút toán thu nhập cho tài xế."""
+    return f"{models.TransactionType.EARNING.value}:{trip_id}"
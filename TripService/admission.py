@@ -0,0 +1,149 @@
+"""Admission control: giới hạn đồng thời theo route, hàng đợi có hạn thời gian và cắt tải bằng 503."""
+import asyncio
+import math
+import os
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Deque, Dict
+
+from fastapi import HTTPException
+
+# Mức ưu tiên: số nhỏ hơn được ưu tiên hơn khi hệ thống quá tải
+PRIORITY_CRITICAL = 0  # accept / start / complete / cancel: không bao giờ bị brownout
+PRIORITY_NORMAL = 1    # tạo chuyến
+PRIORITY_LOW = 2       # ước tính giá: bị cắt đầu tiên
+
+# Khi tổng số request đang chạy vượt ngưỡng này, route ưu tiên thấp bị từ chối ngay
+ADMISSION_SHED_LOW_PRIORITY_AT = int(os.getenv("ADMISSION_SHED_LOW_PRIORITY_AT", 150))
+
+@dataclass
+class RoutePolicy:
+    limit: int
+    max_queue: int
+    queue_timeout: float  # giây tối đa được chờ slot trước khi bị cắt
+    priority: int = PRIORITY_NORMAL
+
+class Overloaded(Exception):
+    def __init__(self, retry_after: int):
+        super().__init__("overloaded")
+        self.retry_after = retry_after
+
+class RouteLimiter:
+    """Concurrency limit for one route class with a bounded FIFO wait queue"""
+
+    def __init__(self, name: str, policy: RoutePolicy):
+        self.name = name
+        self.policy = policy
+        self.in_flight = 0
+        self._waiters: Deque[asyncio.Future] = deque()
+        self.admitted = 0
+        self.shed = 0
+        self.max_queue_seen = 0
+        self.total_queue_seconds = 0.0
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiters)
+
+    def _retry_after(self) -> int:
+        return max(1, math.ceil(self.policy.queue_timeout))
+
+    def _reject(self):
+        self.shed += 1
+        raise Overloaded(self._retry_after())
+
+    async def acquire(self):
+        if self.in_flight < self.policy.limit and not self._waiters:
+            self.in_flight += 1
+            self.admitted += 1
+            return
+        if len(self._waiters) >= self.policy.max_queue or self.policy.queue_timeout <= 0:
+            self._reject()
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        self.max_queue_seen = max(self.max_queue_seen, len(self._waiters))
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), self.policy.queue_timeout)
+        except asyncio.TimeoutError:
+            if waiter.done() and not waiter.cancelled():
+                # Slot được trao đúng lúc hết hạn: trả lại cho người kế tiếp
+                self.release()
+            else:
+                waiter.cancel()
+                self._waiters.remove(waiter)
+            self._reject()
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            elif waiter in self._waiters:
+                waiter.cancel()
+                self._waiters.remove(waiter)
+            raise
+        self.total_queue_seconds += time.monotonic() - started
+        self.admitted += 1
+
+    def release(self):
+        # Trao slot trực tiếp cho người chờ lâu nhất, in_flight giữ nguyên
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(True)
+                return
+        self.in_flight -= 1
+
+    def snapshot(self) -> dict:
+        return {
+            "priority": self.policy.priority,
+            "limit": self.policy.limit,
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "max_queue_seen": self.max_queue_seen,
+            "admitted": self.admitted,
+            "shed": self.shed,
+            "avg_queue_ms": round(1000 * self.total_queue_seconds / self.admitted, 2) if self.admitted else 0.0,
+        }
+
+class AdmissionController:
+    """Per-route limiters plus a global brownout threshold for low-priority routes"""
+
+    def __init__(self, policies: Dict[str, RoutePolicy], shed_low_priority_at: int = ADMISSION_SHED_LOW_PRIORITY_AT):
+        self.limiters = {name: RouteLimiter(name, policy) for name, policy in policies.items()}
+        self.shed_low_priority_at = shed_low_priority_at
+
+    @property
+    def in_flight(self) -> int:
+        return sum(limiter.in_flight for limiter in self.limiters.values())
+
+    async def acquire(self, name: str) -> RouteLimiter:
+        limiter = self.limiters[name]
+        if limiter.policy.priority >= PRIORITY_LOW and self.in_flight >= self.shed_low_priority_at:
+            limiter._reject()
+        await limiter.acquire()
+        return limiter
+
+    def dependency(self, name: str):
+        """FastAPI dependency giữ slot của route `name` trong suốt request."""
+        async def _admit():
+            try:
+                limiter = await self.acquire(name)
+            except Overloaded as e:
+                raise HTTPException(
+                    status_code=503,
+                    detail="Hệ thống đang quá tải, vui lòng thử lại sau.",
+                    headers={"Retry-After": str(e.retry_after)}
+                )
+            try:
+                yield
+            finally:
+                limiter.release()
+        return _admit
+
+    def snapshot(self) -> dict:
+        return {
+            "in_flight": self.in_flight,
+            "shed_low_priority_at": self.shed_low_priority_at,
+            "routes": {name: limiter.snapshot() for name, limiter in self.limiters.items()},
+        }
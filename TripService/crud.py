@@ -1,13 +1,26 @@
 from typing import List, Optional, Any, Dict
 from bson import ObjectId
-from database import trips_collection, ratings_collection
+from database import (
+    trips_collection, ratings_collection, trip_stats_collection, trip_rollups_collection,
+    trips_archive_collection, trip_routes_collection, payment_jobs_collection, job_leases_collection
+)
+from pymongo import UpdateOne, ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 import models
 import schemas
-from datetime import datetime
 import requests
 import httpx
 import logging
+import asyncio
+import hashlib
+import heapq
+import itertools
+import math
+import socket
+import uuid
 import os
+import resilience
+from service_token import ServiceTokenManager
 from dotenv import load_dotenv
 from datetime import datetime, timezone, timedelta
 # import polyline  # Uncomment if you install polyline package
@@ -24,8 +37,17 @@ USER_SERVICE_URL = os.getenv("USER_SERVICE_URL")
 DRIVER_SERVICE_URL = os.getenv("DRIVER_SERVICE_URL")
 LOCATION_SERVICE_URL = os.getenv("LOCATION_SERVICE_URL")
 
-_service_token_cache: Optional[str] = None
-_token_expiry_time: Optional[datetime] = None
+# Service Token dùng chung cho mọi lời gọi API nội bộ DriverService
+service_token_manager = ServiceTokenManager(
+    f"{USER_SERVICE_URL}/auth/token" if USER_SERVICE_URL else None, MY_CLIENT_ID, MY_CLIENT_SECRET
+)
+
+# Cache hồ sơ tài xế (driver_id -> (hết hạn, hồ sơ)); DriverService báo thay đổi qua /internal/driver-events
+DRIVER_PROFILE_CACHE_TTL_SECONDS = int(os.getenv("DRIVER_PROFILE_CACHE_TTL_SECONDS", 300))
+DRIVER_PROFILE_CACHE_MAX_SIZE = int(os.getenv("DRIVER_PROFILE_CACHE_MAX_SIZE", 10000))
+_driver_profile_cache: Dict[str, tuple] = {}
+# Giữ tham chiếu tới task nền để không bị GC giữa chừng
+_background_tasks: set = set()
 
 
 
@@ -33,32 +55,67 @@ _token_expiry_time: Optional[datetime] = None
 MAPBOX_ACCESS_TOKEN = os.getenv("MAPBOX_ACCESS_TOKEN", "pk.default_token_change_in_production")
 LOCATION_SERVICE_URL = os.getenv("LOCATION_SERVICE_URL", "http://locationservice:8000")
 DRIVER_SERVICE_URL = os.getenv("DRIVER_SERVICE_URL", "http://driverservice:8000")
+
+# Upstream có breaker + hedge: request đọc (GET) nên bắn bản sao khi chậm là an toàn
+mapbox_upstream = resilience.register_upstream(
+    "mapbox", timeout=float(os.getenv("MAPBOX_TIMEOUT_SECONDS", 4.0)), hedge_after=0.8
+)
+location_upstream = resilience.register_upstream(
+    "locationservice", timeout=float(os.getenv("LOCATION_SERVICE_TIMEOUT_SECONDS", 2.0)), hedge_after=0.3
+)
+driver_upstream = resilience.register_upstream(
+    "driverservice", timeout=float(os.getenv("DRIVER_SERVICE_TIMEOUT_SECONDS", 2.0)), hedge_after=0.3
+)
+
+def _raise_for_server_error(response: httpx.Response) -> httpx.Response:
+    """Chỉ lỗi 5xx mới tính là upstream hỏng (4xx là lỗi của request, không mở breaker)."""
+    if response.status_code >= 500:
+        response.raise_for_status()
+    return response
 def convert_objectid(doc):
     """Convert ObjectId to string for Pydantic models"""
     if doc and "_id" in doc:
         doc["_id"] = str(doc["_id"])
     return doc
 
+# Polyline nằm ở trip_routes; bỏ luôn polyline inline của các chuyến cũ khỏi mọi lượt đọc nóng
+TRIP_READ_PROJECTION = {"route_info.geometry": 0}
+
 async def get_trip_by_id(trip_id: str) -> Optional[dict]:
-    """Get trip by ObjectId"""
+    """Get trip by ObjectId (falls through to the archive for old finished trips)"""
     if not ObjectId.is_valid(trip_id):
         return None
-    doc = await trips_collection.find_one({"_id": ObjectId(trip_id)})
+    doc = await trips_collection.find_one({"_id": ObjectId(trip_id)}, TRIP_READ_PROJECTION)
+    if doc is None:
+        doc = await trips_archive_collection.find_one({"_id": ObjectId(trip_id)}, TRIP_READ_PROJECTION)
     return convert_objectid(doc)
 
+def _created_at_key(trip: dict) -> datetime:
+    return _as_utc(trip.get("created_at")) or datetime.min.replace(tzinfo=timezone.utc)
+
+async def _find_trip_page(query: dict, skip: int, limit: int) -> List[dict]:
+    """Newest-first page over hot trips and the archive, merged by created_at"""
+    # Chuyến PENDING/ON_TRIP cũ vẫn ở trips nên thời gian hai bên có thể xen kẽ:
+    # lấy skip+limit chuyến mới nhất mỗi bên rồi trộn theo created_at
+    window = skip + limit
+    hot, archived = await asyncio.gather(
+        trips_collection.find(query, TRIP_READ_PROJECTION).sort("created_at", -1).limit(window).to_list(length=window),
+        trips_archive_collection.find(query, TRIP_READ_PROJECTION).sort("created_at", -1).limit(window).to_list(length=window)
+    )
+    merged = heapq.merge(hot, archived, key=_created_at_key, reverse=True)
+    return list(itertools.islice(merged, skip, window))
+
 async def get_trips_by_passenger(passenger_id: str, skip: int = 0, limit: int = 100) -> List[dict]:
     """Get trips by passenger ID"""
-    cursor = trips_collection.find({"passenger_id": passenger_id}).skip(skip).limit(limit).sort("created_at", -1)
-    return await cursor.to_list(length=limit)
+    return await _find_trip_page({"passenger_id": passenger_id}, skip, limit)
 
 async def get_trips_by_driver(driver_id: str, skip: int = 0, limit: int = 100) -> List[dict]:
     """Get trips by driver ID"""
-    cursor = trips_collection.find({"driver_id": driver_id}).skip(skip).limit(limit).sort("created_at", -1)
-    return await cursor.to_list(length=limit)
+    return await _find_trip_page({"driver_id": driver_id}, skip, limit)
 
 async def get_available_trips(skip: int = 0, limit: int = 100) -> List[dict]:
     """Get available trips (status = PENDING)"""
-    cursor = trips_collection.find({"status": models.TripStatusEnum.PENDING.value}).skip(skip).limit(limit).sort("created_at", -1)
+    cursor = trips_collection.find({"status": models.TripStatusEnum.PENDING.value}, TRIP_READ_PROJECTION).skip(skip).limit(limit).sort("created_at", -1)
     return await cursor.to_list(length=limit)
 
 async def get_trips_near_location(longitude: float, latitude: float, max_distance: int = 5000, limit: int = 50) -> List[dict]:
@@ -74,7 +131,7 @@ async def get_trips_near_location(longitude: float, latitude: float, max_distanc
             }
         },
         "status": models.TripStatusEnum.PENDING.value
-    }).limit(limit)
+    }, TRIP_READ_PROJECTION).limit(limit)
     return await cursor.to_list(length=limit)
 
 async def get_coordinates(location_name: str) -> tuple | None:
@@ -123,12 +180,15 @@ async def get_route_info(pickup_coords: tuple[float, float], dropoff_coords: tup
     
     logger.info(f"Mapbox: Requesting directions from {pickup_coords} to {dropoff_coords}")
     
-    try:
+    async def _fetch_directions() -> httpx.Response:
         # Sử dụng httpx thay vì requests
         async with httpx.AsyncClient() as client:
-            response = await client.get(f"{directions_url}/{coordinates}", params=params)
-            response.raise_for_status()
-            data = response.json()
+            return _raise_for_server_error(await client.get(f"{directions_url}/{coordinates}", params=params))
+
+    try:
+        response = await mapbox_upstream.call(_fetch_directions)
+        response.raise_for_status()
+        data = response.json()
         
         if data.get("routes"):
             route = data["routes"][0]
@@ -140,7 +200,7 @@ async def get_route_info(pickup_coords: tuple[float, float], dropoff_coords: tup
         else:
             logger.warning("Mapbox: No routes found")
             return None
-    except httpx.RequestError as e:
+    except (httpx.RequestError, resilience.UpstreamUnavailable) as e:
         logger.error(f"Mapbox API (Directions) error: {e}")
         raise e # Ném lỗi ra
 
@@ -203,6 +263,49 @@ async def estimate_fare_for_all_vehicles(pickup_coords: tuple[float, float], dro
 
 
 
+async def store_route_geometry(geometry: str) -> str:
+    """Store an encoded polyline once in trip_routes (deduplicated by content hash); returns its id"""
+    geometry_id = hashlib.sha256(geometry.encode("utf-8")).hexdigest()
+    try:
+        await trip_routes_collection.update_one(
+            {"_id": geometry_id},
+            {"$setOnInsert": {"geometry": geometry, "created_at": datetime.now(timezone.utc)}},
+            upsert=True
+        )
+    except DuplicateKeyError:
+        pass  # Hai request cùng upsert một tuyến: bản kia đã ghi xong
+    return geometry_id
+
+async def _build_route_info(route_info_data: dict) -> models.RouteInfo:
+    geometry_id = await store_route_geometry(route_info_data["geometry"])
+    return models.RouteInfo(
+        distance=route_info_data["distance"],
+        duration=route_info_data["duration"],
+        geometry_id=geometry_id
+    )
+
+async def get_trip_route(trip_id: str) -> Optional[dict]:
+    """Load route geometry for map rendering (the only read path that touches polylines)"""
+    if not ObjectId.is_valid(trip_id):
+        return None
+    projection = {"route_info": 1}
+    doc = await trips_collection.find_one({"_id": ObjectId(trip_id)}, projection)
+    if doc is None:
+        doc = await trips_archive_collection.find_one({"_id": ObjectId(trip_id)}, projection)
+    route_info = (doc or {}).get("route_info")
+    if not route_info:
+        return None
+    geometry = route_info.get("geometry")  # Chuyến cũ còn lưu polyline inline
+    if geometry is None and route_info.get("geometry_id"):
+        route_doc = await trip_routes_collection.find_one({"_id": route_info["geometry_id"]})
+        geometry = (route_doc or {}).get("geometry")
+    return {
+        "trip_id": trip_id,
+        "distance": route_info.get("distance"),
+        "duration": route_info.get("duration"),
+        "geometry": geometry
+    }
+
 async def create_trip_request_complete(trip_request: schemas.TripRequestComplete) -> dict:
     pickup_location = models.LocationInfo(
         address=trip_request.pickup.address,
@@ -221,7 +324,7 @@ async def create_trip_request_complete(trip_request: schemas.TripRequestComplete
     route_info_data = await get_route_info(pickup_coords, dropoff_coords, trip_request.vehicle_type)
     if not route_info_data:
         raise ValueError("Could not calculate route between coordinates")
-    route_info = models.RouteInfo(**route_info_data)
+    route_info = await _build_route_info(route_info_data)
     estimated_fare = calculate_estimated_fare(route_info_data["distance"], trip_request.vehicle_type)
     fare_info = models.FareInfo(estimated=estimated_fare)
     payment_info = models.PaymentInfo(
@@ -246,7 +349,7 @@ async def create_trip_request_complete(trip_request: schemas.TripRequestComplete
         rejected_driver_ids=[],
         offer_sent_at=None 
     )
-    trip_dict = trip_obj.model_dump(by_alias=True, exclude={"id"})
+    trip_dict = trip_obj.model_dump(by_alias=True, exclude={"id": True, "route_info": {"geometry"}})
 
     try:
         result = await trips_collection.insert_one(trip_dict)
@@ -256,6 +359,7 @@ async def create_trip_request_complete(trip_request: schemas.TripRequestComplete
     except Exception as e:
          logger.error(f"Lỗi khi insert chuyến đi vào DB: {e}", exc_info=True)
          raise HTTPException(status_code=500, detail="Lỗi server khi tạo chuyến đi.")
+    await _record_stats_transition(None, trip_dict)
     nearby_drivers_raw = await find_nearby_drivers_from_location_service(
         trip_request.pickup.latitude,
         trip_request.pickup.longitude
@@ -264,6 +368,10 @@ async def create_trip_request_complete(trip_request: schemas.TripRequestComplete
         driver_ids = [driver['driver_id'] for driver in nearby_drivers_raw]
         logger.info(f"Tìm thấy {len(driver_ids)} tài xế gần đó cho chuyến đi {trip_id}. Bắt đầu mời...")
         await add_notified_drivers_to_trip(trip_id, driver_ids)
+        # Làm nóng cache hồ sơ tài xế ngoài luồng chính: lúc nhận chuyến không phải gọi DriverService
+        prefetch_task = asyncio.create_task(prefetch_driver_profiles(driver_ids))
+        _background_tasks.add(prefetch_task)
+        prefetch_task.add_done_callback(_background_tasks.discard)
         trip_payload = {
             "type": "TRIP_OFFER",
             "trip_id": trip_id,
@@ -275,18 +383,17 @@ async def create_trip_request_complete(trip_request: schemas.TripRequestComplete
         await notify_drivers_via_location_service(driver_ids, trip_payload)
         offer_timestamp = datetime.now(timezone.utc) 
         try:
-            await trips_collection.update_one(
-                {"_id": ObjectId(trip_id)},
-                {"$set": {"offer_sent_at": offer_timestamp}}
-            )
+            updated_trip = await _mutate_trip(trip_id, {"$set": {"offer_sent_at": offer_timestamp}})
             logger.info(f"Đã cập nhật offer_sent_at cho chuyến đi {trip_id}.")
-            trip_dict["offer_sent_at"] = offer_timestamp
+            trip_dict = updated_trip or {**trip_dict, "offer_sent_at": offer_timestamp}
         except Exception as e:
              logger.error(f"Lỗi khi cập nhật offer_sent_at cho chuyến đi {trip_id}: {e}")
     else:
         logger.warning(f"Không tìm thấy tài xế nào cho chuyến đi {trip_id} khi tạo.")
-    final_trip_data = await get_trip_by_id(trip_id)
-    return final_trip_data if final_trip_data else trip_dict
+    final_trip_data = trip_dict
+    # Hành khách vẽ tuyến ngay sau khi đặt xe: trả kèm polyline đang có sẵn trong bộ nhớ
+    final_trip_data["route_info"] = {**(final_trip_data.get("route_info") or {}), "geometry": route_info_data["geometry"]}
+    return final_trip_data
 
 async def create_trip_request(trip_request: schemas.TripRequest) -> dict:
     """Create new trip request from passenger (using Mapbox APIs)"""
@@ -303,12 +410,8 @@ async def create_trip_request(trip_request: schemas.TripRequest) -> dict:
     if not route_info_data:
         raise ValueError("Could not calculate route between addresses")
     
-    # Create RouteInfo object
-    route_info = models.RouteInfo(
-        distance=route_info_data["distance"],
-        duration=route_info_data["duration"], 
-        geometry=route_info_data["geometry"]
-    )
+    # Create RouteInfo object (polyline stored separately in trip_routes)
+    route_info = await _build_route_info(route_info_data)
     
     # Calculate estimated fare based on distance and vehicle type
     estimated_fare = calculate_estimated_fare(route_info_data["distance"], trip_request.vehicle_type)
@@ -359,21 +462,42 @@ async def create_trip_request(trip_request: schemas.TripRequest) -> dict:
     )
     
     # Convert to dict for MongoDB - exclude the id field to let MongoDB generate it
-    trip_dict = trip_obj.model_dump(by_alias=True, exclude={"id"})
+    trip_dict = trip_obj.model_dump(by_alias=True, exclude={"id": True, "route_info": {"geometry"}})
     
     # Insert to database
     result = await trips_collection.insert_one(trip_dict)
     
     # Add the inserted ID to the dict and return it directly
     trip_dict["_id"] = str(result.inserted_id)
+    await _record_stats_transition(None, trip_dict)
     return trip_dict
 
+async def _mutate_trip(
+    trip_id: str,
+    update: dict | List[dict],
+    conditions: Optional[dict] = None,
+    return_document: ReturnDocument = ReturnDocument.AFTER
+) -> Optional[dict]:
+    """Apply a conditional update and return the projected trip in the same round trip"""
+    if not ObjectId.is_valid(trip_id):
+        return None
+    doc = await trips_collection.find_one_and_update(
+        {"_id": ObjectId(trip_id), **(conditions or {})},
+        update,
+        projection=TRIP_READ_PROJECTION,
+        return_document=return_document
+    )
+    return convert_objectid(doc)
+
 async def assign_driver_to_trip(trip_id: str, driver_id: str) -> Optional[dict]:
     if not ObjectId.is_valid(trip_id):
         logger.warning(f"assign_driver_to_trip: trip_id không hợp lệ: {trip_id}")
         return None
     try:
-        current_trip = await trips_collection.find_one({"_id": ObjectId(trip_id)})
+        current_trip = await trips_collection.find_one(
+            {"_id": ObjectId(trip_id)},
+            {"status": 1, "offer_sent_at": 1}
+        )
         if not current_trip:
             logger.warning(f"Tài xế {driver_id} cố nhận chuyến {trip_id} không tồn tại.")
             return None 
@@ -412,27 +536,30 @@ async def assign_driver_to_trip(trip_id: str, driver_id: str) -> Optional[dict]:
         "timestamp": datetime.now(timezone.utc) 
     }
     try:
-        result = await trips_collection.update_one(
-            {"_id": ObjectId(trip_id), "status": models.TripStatusEnum.PENDING.value},
+        updated_trip = await _mutate_trip(
+            trip_id,
             {
                 "$set": {
                     "driver_id": driver_id,
                     "status": models.TripStatusEnum.ACCEPTED.value
                 },
                 "$push": {"history": new_history_entry}
-            }
+            },
+            conditions={"status": models.TripStatusEnum.PENDING.value}
         )
     except Exception as e:
-        logger.error(f"Lỗi khi update_one để gán tài xế {driver_id} cho chuyến {trip_id}: {e}")
+        logger.error(f"Lỗi khi find_one_and_update để gán tài xế {driver_id} cho chuyến {trip_id}: {e}")
         return None 
 
-    if result.modified_count == 0:
+    if updated_trip is None:
         logger.warning(f"Tài xế {driver_id} THẤT BẠI khi nhận chuyến {trip_id} (Race condition - người khác nhanh hơn).")
         return None
     
     logger.info(f"Tài xế {driver_id} THÀNH CÔNG nhận chuyến {trip_id} (Thắng race condition).")
-    updated_trip = await get_trip_by_id(trip_id) 
-    if not updated_trip: return None 
+    await _record_stats_transition(
+        {**updated_trip, "status": models.TripStatusEnum.PENDING.value, "driver_id": ""},
+        updated_trip
+    )
     notified_ids = updated_trip.get("notified_driver_ids", [])
     winner_id = driver_id
     loser_ids = [id for id in notified_ids if id != winner_id]
@@ -462,42 +589,26 @@ async def deny_trip(trip_id: str, driver_id: str) -> Optional[dict]:
         "timestamp": datetime.now()
     }
     
-    result = await trips_collection.update_one(
-        {
-            "_id": ObjectId(trip_id), 
-            "status": models.TripStatusEnum.ACCEPTED.value,
-            "driver_id": driver_id
-        },
+    updated_trip = await _mutate_trip(
+        trip_id,
         {
             "$set": {
                 "driver_id": "",  # Remove driver
                 "status": models.TripStatusEnum.PENDING.value
             },
             "$push": {"history": new_history_entry}
-        }
+        },
+        conditions={"status": models.TripStatusEnum.ACCEPTED.value, "driver_id": driver_id}
     )
-    
-    if result.modified_count == 0:
-        return None
-        
-    return await get_trip_by_id(trip_id)
+    if updated_trip:
+        await _record_stats_transition(
+            {**updated_trip, "status": models.TripStatusEnum.ACCEPTED.value, "driver_id": driver_id},
+            updated_trip
+        )
+    return updated_trip
 
 async def update_trip_status(trip_id: str, new_status: models.TripStatusEnum) -> Optional[dict]:
     """Update trip status and add to history"""
-    if not ObjectId.is_valid(trip_id):
-        return None
-    
-    # Get current trip
-    current_trip = await get_trip_by_id(trip_id)
-    if not current_trip:
-        return None
-    
-    # Create new status history entry
-    new_history_entry = {
-        "status": new_status.value,
-        "timestamp": datetime.now()
-    }
-    
     # Prepare update data
     set_data = {
         "status": new_status.value
@@ -509,64 +620,112 @@ async def update_trip_status(trip_id: str, new_status: models.TripStatusEnum) ->
     elif new_status == models.TripStatusEnum.COMPLETED:
         set_data["endTime"] = datetime.now()
     
-    # Update with both $set and $push operations
-    result = await trips_collection.update_one(
-        {"_id": ObjectId(trip_id)},
-        {
-            "$set": set_data,
-            "$push": {"history": new_history_entry}
-        }
+    history_entry = {"status": new_status.value, "timestamp": datetime.now()}
+    # Bản trước cập nhật cho biết trạng thái nguồn thật (bộ đếm cần nó); bản sau được dựng tại chỗ
+    previous_trip = await _mutate_trip(
+        trip_id,
+        {"$set": set_data, "$push": {"history": history_entry}},
+        return_document=ReturnDocument.BEFORE
     )
-    
-    if result.modified_count:
-        return await get_trip_by_id(trip_id)
-    return None
+    if previous_trip is None:
+        return None
+    updated_trip = {**previous_trip, **set_data, "history": [*(previous_trip.get("history") or []), history_entry]}
+    await _record_stats_transition(previous_trip, updated_trip)
+    return updated_trip
 
 async def update_trip_fare(trip_id: str, actual_fare: float, discount: float = 0, tax: float = 0) -> Optional[dict]:
     """Update trip fare information"""
-    if not ObjectId.is_valid(trip_id):
-        return None
-    
-    update_data = {
-        "fare.actual": actual_fare,
-        "fare.discount": discount,
-        "fare.tax": tax
+    fare_update = {
+        "actual": actual_fare,
+        "discount": discount,
+        "tax": tax
     }
     
-    result = await trips_collection.update_one(
-        {"_id": ObjectId(trip_id)},
-        {"$set": update_data}
+    # Cần giá cũ để tính chênh lệch doanh thu: lấy bản trước khi cập nhật rồi áp $set tại chỗ
+    previous_trip = await _mutate_trip(
+        trip_id,
+        {"$set": {f"fare.{field}": value for field, value in fare_update.items()}},
+        return_document=ReturnDocument.BEFORE
     )
-    
-    if result.modified_count:
-        return await get_trip_by_id(trip_id)
-    return None
+    if previous_trip is None:
+        return None
+    updated_trip = {**previous_trip, "fare": {**(previous_trip.get("fare") or {}), **fare_update}}
+    await _record_stats_transition(previous_trip, updated_trip)
+    return updated_trip
+
+# Chuyến đang chạy (hoặc đã nhận nhưng chưa bấm bắt đầu) mới được hoàn thành
+COMPLETABLE_STATUSES = [models.TripStatusEnum.ON_TRIP.value, models.TripStatusEnum.ACCEPTED.value]
+
+async def complete_trip(trip_id: str, actual_fare: float, discount: float = 0, tax: float = 0) -> Optional[dict]:
+    """Complete an ON_TRIP/ACCEPTED trip in one conditional write: status, endTime, fare, payment state and history"""
+    now = datetime.now()
+    is_cash = {"$eq": ["$payment.method", models.PaymentMethodEnum.CASH.value]}
+    history_entry = {"status": models.TripStatusEnum.COMPLETED.value, "timestamp": now}
+    fare_update = {"actual": actual_fare, "discount": discount, "tax": tax}
+    previous_trip = await _mutate_trip(
+        trip_id,
+        # Pipeline update: trạng thái thanh toán phụ thuộc phương thức đã lưu trong chính document.
+        # Giá trị từ request bọc $literal để không bị hiểu thành biểu thức ("$field", {"$op": ...})
+        [{"$set": {
+            "status": models.TripStatusEnum.COMPLETED.value,
+            "endTime": now,
+            **{f"fare.{field}": {"$literal": value} for field, value in fare_update.items()},
+            # Tiền mặt được thu ngay khi kết thúc; phương thức khác chờ PaymentService báo về
+            "payment.status": {"$cond": [is_cash, models.PaymentStatusEnum.SUCCESS.value, "$payment.status"]},
+            "payment.paid_at": {"$cond": [is_cash, now, {"$ifNull": ["$payment.paid_at", None]}]},
+            "history": {"$concatArrays": [{"$ifNull": ["$history", []]}, [history_entry]]}
+        }}],
+        conditions={"status": {"$in": COMPLETABLE_STATUSES}},
+        return_document=ReturnDocument.BEFORE
+    )
+    if previous_trip is None:
+        return None
+    # Dựng bản sau cập nhật từ bản trước (cần trạng thái nguồn thật cho bộ đếm thống kê)
+    payment = previous_trip.get("payment")
+    if payment and payment.get("method") == models.PaymentMethodEnum.CASH.value:
+        payment = {**payment, "status": models.PaymentStatusEnum.SUCCESS.value, "paid_at": now}
+    updated_trip = {
+        **previous_trip,
+        "status": models.TripStatusEnum.COMPLETED.value,
+        "endTime": now,
+        "fare": {**(previous_trip.get("fare") or {}), **fare_update},
+        "payment": payment,
+        "history": [*(previous_trip.get("history") or []), history_entry]
+    }
+    await _record_stats_transition(previous_trip, updated_trip)
+    return updated_trip
+
+async def enqueue_payment_job(trip: dict) -> None:
+    """Queue the E-Wallet charge for a completed trip (one job per trip, safe to repeat)"""
+    now = datetime.now(timezone.utc)
+    await payment_jobs_collection.update_one(
+        {"_id": trip["_id"]},
+        {"$setOnInsert": {
+            "trip_id": trip["_id"],
+            "user_id": trip.get("passenger_id"),
+            "driver_id": trip.get("driver_id"),
+            "amount": (trip.get("fare") or {}).get("actual"),
+            "status": "QUEUED",
+            "attempts": 0,
+            "available_at": now,
+            "created_at": now
+        }},
+        upsert=True
+    )
+    logger.info(f"TripService: Đã xếp hàng thanh toán E-Wallet cho chuyến {trip['_id']}")
 
 async def add_payment_info(trip_id: str, payment: schemas.PaymentCreate) -> Optional[dict]:
     """Add payment information to trip"""
-    if not ObjectId.is_valid(trip_id):
-        return None
-    
     payment_data = models.PaymentInfo(
         method=payment.method,
         transaction_id=payment.transaction_id,
         status=models.PaymentStatusEnum.PENDING
     )
     
-    result = await trips_collection.update_one(
-        {"_id": ObjectId(trip_id)},
-        {"$set": {"payment": payment_data.dict()}}
-    )
-    
-    if result.modified_count:
-        return await get_trip_by_id(trip_id)
-    return None
+    return await _mutate_trip(trip_id, {"$set": {"payment": payment_data.dict()}})
 
 async def update_payment_status(trip_id: str, payment_update: schemas.PaymentUpdate) -> Optional[dict]:
     """Update payment status"""
-    if not ObjectId.is_valid(trip_id):
-        return None
-    
     update_data = {
         "payment.status": payment_update.status.value
     }
@@ -579,122 +738,435 @@ async def update_payment_status(trip_id: str, payment_update: schemas.PaymentUpd
     elif payment_update.status == models.PaymentStatusEnum.SUCCESS:
         update_data["payment.paid_at"] = datetime.now()
     
-    result = await trips_collection.update_one(
-        {"_id": ObjectId(trip_id)},
-        {"$set": update_data}
-    )
-    
-    if result.modified_count:
-        return await get_trip_by_id(trip_id)
-    return None
+    return await _mutate_trip(trip_id, {"$set": update_data})
 
 async def add_trip_rating(trip_id: str, rating: schemas.RatingCreate) -> Optional[dict]:
     """Add rating to trip (embedded)"""
-    if not ObjectId.is_valid(trip_id):
-        return None
-    
     rating_data = models.RatingInfo(
         stars=rating.stars,
         comment=rating.comment,
         rated_at=datetime.now()
     )
     
-    result = await trips_collection.update_one(
-        {"_id": ObjectId(trip_id)},
-        {"$set": {"rating": rating_data.dict()}}
+    rating_doc = rating_data.dict()
+    # Bản trước cho biết đánh giá cũ (nếu có) để bộ đếm trừ đúng phần đã cộng
+    previous_trip = await _mutate_trip(
+        trip_id,
+        {"$set": {"rating": rating_doc}},
+        return_document=ReturnDocument.BEFORE
     )
-    
-    if result.modified_count:
-        return await get_trip_by_id(trip_id)
-    return None
+    if previous_trip is None:
+        return None
+    updated_trip = {**previous_trip, "rating": rating_doc}
+    await _record_stats_transition(previous_trip, updated_trip)
+    return updated_trip
 
 async def cancel_trip(trip_id: str, cancellation: schemas.CancellationCreate) -> Optional[dict]:
     """Cancel trip with reason"""
-    if not ObjectId.is_valid(trip_id):
-        return None
-    
     cancellation_data = models.CancellationInfo(
         cancelled_by=cancellation.cancelled_by,
         reason=cancellation.reason,
         cancelled_at=datetime.now()
     )
     
-    update_data = {
+    set_data = {
         "status": models.TripStatusEnum.CANCELLED.value,
-        "cancellation": cancellation_data.dict(),
-        "$push": {
-            "history": {
-                "status": models.TripStatusEnum.CANCELLED.value,
-                "timestamp": datetime.now()
-            }
-        }
+        "cancellation": cancellation_data.dict()
     }
-    
-    result = await trips_collection.update_one(
-        {"_id": ObjectId(trip_id)},
-        {"$set": update_data}
+    history_entry = {"status": models.TripStatusEnum.CANCELLED.value, "timestamp": datetime.now()}
+    previous_trip = await _mutate_trip(
+        trip_id,
+        {"$set": set_data, "$push": {"history": history_entry}},
+        return_document=ReturnDocument.BEFORE
     )
-    
-    if result.modified_count:
-        return await get_trip_by_id(trip_id)
-    return None
+    if previous_trip is None:
+        return None
+    updated_trip = {**previous_trip, **set_data, "history": [*(previous_trip.get("history") or []), history_entry]}
+    await _record_stats_transition(previous_trip, updated_trip)
+    return updated_trip
 
 async def delete_trip(trip_id: str) -> bool:
     """Delete trip"""
     if not ObjectId.is_valid(trip_id):
         return False
     
-    result = await trips_collection.delete_one({"_id": ObjectId(trip_id)})
-    return result.deleted_count > 0
+    deleted_trip = await trips_collection.find_one_and_delete({"_id": ObjectId(trip_id)})
+    if deleted_trip is None:
+        deleted_trip = await trips_archive_collection.find_one_and_delete({"_id": ObjectId(trip_id)})
+    if deleted_trip is None:
+        return False
+    await _record_stats_transition(deleted_trip, None)
+    return True
+
+# --- Thống kê tài xế / hành khách (duy trì tăng dần bằng $inc) ---
+STATS_COUNTER_FIELDS = ("total_trips", "completed_trips", "cancelled_trips", "total_revenue", "rating_sum", "rating_count")
+
+def _stats_key(role: str, owner_id: str) -> str:
+    return f"{role}:{owner_id}"
+
+def _stats_contribution(trip: Optional[dict]) -> Dict[str, tuple]:
+    """Counters a single trip contributes to its driver's and passenger's stats documents"""
+    if not trip:
+        return {}
+    status = trip.get("status")
+    completed = status == models.TripStatusEnum.COMPLETED.value
+    stars = (trip.get("rating") or {}).get("stars")
+    counters = {
+        "total_trips": 1,
+        "completed_trips": 1 if completed else 0,
+        "cancelled_trips": 1 if status == models.TripStatusEnum.CANCELLED.value else 0,
+        "total_revenue": ((trip.get("fare") or {}).get("actual") or 0) if completed else 0,
+        "rating_sum": stars or 0,
+        "rating_count": 1 if stars else 0
+    }
+    contribution = {}
+    for role in ("passenger", "driver"):
+        owner_id = trip.get(f"{role}_id")
+        if owner_id:
+            contribution[_stats_key(role, owner_id)] = (counters, {"role": role, "owner_id": owner_id})
+    return contribution
+
+# --- Rollup doanh thu / chuyến đi theo giờ & ngày (theo tài xế và theo khu vực) ---
+ROLLUP_COUNTER_FIELDS = ("trips_completed", "trips_cancelled", "revenue", "distance_meters")
+ROLLUP_BUCKET_FORMATS = {
+    models.AnalyticsGranularityEnum.HOUR: "%Y-%m-%dT%H",
+    models.AnalyticsGranularityEnum.DAY: "%Y-%m-%d"
+}
+REGION_CELLS_PER_DEGREE = 10  # Ô lưới 0.1° (~11km) làm khu vực
+
+def _as_utc(value: Optional[datetime]) -> Optional[datetime]:
+    if value is not None and value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value
+
+def region_key_for(longitude: float, latitude: float) -> str:
+    """Region = index of the 0.1° grid cell containing the point ("<lat_idx>_<lng_idx>")"""
+    return f"{math.floor(latitude * REGION_CELLS_PER_DEGREE)}_{math.floor(longitude * REGION_CELLS_PER_DEGREE)}"
+
+def _truncate_to_bucket(moment: datetime, granularity: models.AnalyticsGranularityEnum) -> datetime:
+    moment = _as_utc(moment).astimezone(timezone.utc)
+    if granularity == models.AnalyticsGranularityEnum.DAY:
+        return moment.replace(hour=0, minute=0, second=0, microsecond=0)
+    return moment.replace(minute=0, second=0, microsecond=0)
+
+def _rollup_key(granularity: models.AnalyticsGranularityEnum, dimension: str, key: str, bucket_start: datetime) -> str:
+    return f"{granularity.value}:{dimension}:{key}:{bucket_start.strftime(ROLLUP_BUCKET_FORMATS[granularity])}"
+
+def _rollup_contribution(trip: Optional[dict]) -> Dict[str, tuple]:
+    """Counters a finished (completed/cancelled) trip contributes to its time buckets"""
+    if not trip:
+        return {}
+    status = trip.get("status")
+    completed = status == models.TripStatusEnum.COMPLETED.value
+    if completed:
+        event_at = trip.get("endTime") or trip.get("created_at")
+    elif status == models.TripStatusEnum.CANCELLED.value:
+        event_at = (trip.get("cancellation") or {}).get("cancelled_at") or trip.get("created_at")
+    else:
+        return {}
+    if event_at is None:
+        return {}
+    counters = {
+        "trips_completed": 1 if completed else 0,
+        "trips_cancelled": 0 if completed else 1,
+        "revenue": ((trip.get("fare") or {}).get("actual") or 0) if completed else 0,
+        "distance_meters": ((trip.get("route_info") or {}).get("distance") or 0) if completed else 0
+    }
+    dimensions = []
+    if trip.get("driver_id"):
+        dimensions.append(("driver", trip["driver_id"]))
+    coordinates = ((trip.get("pickup") or {}).get("location") or {}).get("coordinates")
+    if coordinates:
+        dimensions.append(("region", region_key_for(coordinates[0], coordinates[1])))
+    contribution = {}
+    for granularity in ROLLUP_BUCKET_FORMATS:
+        bucket_start = _truncate_to_bucket(event_at, granularity)
+        for dimension, key in dimensions:
+            meta = {"granularity": granularity.value, "dimension": dimension, "key": key, "bucket_start": bucket_start}
+            contribution[_rollup_key(granularity, dimension, key, bucket_start)] = (counters, meta)
+    return contribution
+
+def _counter_delta_operations(old: Dict[str, tuple], new: Dict[str, tuple], fields: tuple, now: datetime) -> List[UpdateOne]:
+    """Build upserting $inc operations for the difference between two contributions"""
+    operations = []
+    for key in old.keys() | new.keys():
+        old_counters, _ = old.get(key, ({}, None))
+        new_counters, meta = new.get(key) or old[key]
+        delta = {}
+        for field in fields:
+            diff = new_counters.get(field, 0) - old_counters.get(field, 0)
+            if diff:
+                delta[field] = diff
+        if not delta:
+            continue
+        operations.append(UpdateOne(
+            {"_id": key},
+            {"$inc": delta, "$set": {"updated_at": now}, "$setOnInsert": meta},
+            upsert=True
+        ))
+    return operations
+
+async def _record_stats_transition(before: Optional[dict], after: Optional[dict]):
+    """Apply the counter delta between two versions of a trip to trip_stats and trip_rollups with $inc"""
+    now = datetime.now(timezone.utc)
+    targets = (
+        (trip_stats_collection, _stats_contribution, STATS_COUNTER_FIELDS),
+        (trip_rollups_collection, _rollup_contribution, ROLLUP_COUNTER_FIELDS)
+    )
+    for collection, contribution, fields in targets:
+        operations = _counter_delta_operations(contribution(before), contribution(after), fields, now)
+        if not operations:
+            continue
+        try:
+            await collection.bulk_write(operations, ordered=False)
+        except Exception as e:
+            # Không làm hỏng thao tác chính; các job rebuild sẽ sửa lệch số liệu
+            logger.error(f"Lỗi khi cập nhật bộ đếm {collection.name}: {e}")
+
+def _stats_doc_to_statistics(doc: Optional[dict]) -> dict:
+    doc = doc or {}
+    rating_count = doc.get("rating_count", 0)
+    return {
+        "total_trips": doc.get("total_trips", 0),
+        "completed_trips": doc.get("completed_trips", 0),
+        "cancelled_trips": doc.get("cancelled_trips", 0),
+        "total_revenue": doc.get("total_revenue", 0),
+        "average_rating": doc.get("rating_sum", 0) / rating_count if rating_count else None
+    }
+
+def _stats_group_stage(group_id: Any) -> dict:
+    completed = {"$eq": ["$status", models.TripStatusEnum.COMPLETED.value]}
+    cancelled = {"$eq": ["$status", models.TripStatusEnum.CANCELLED.value]}
+    return {
+        "$group": {
+            "_id": group_id,
+            "total_trips": {"$sum": 1},
+            "completed_trips": {"$sum": {"$cond": [completed, 1, 0]}},
+            "cancelled_trips": {"$sum": {"$cond": [cancelled, 1, 0]}},
+            "total_revenue": {"$sum": {"$cond": [completed, {"$ifNull": ["$fare.actual", 0]}, 0]}},
+            "rating_sum": {"$sum": {"$ifNull": ["$rating.stars", 0]}},
+            "rating_count": {"$sum": {"$cond": [{"$ifNull": ["$rating.stars", False]}, 1, 0]}}
+        }
+    }
 
 async def get_trip_statistics(driver_id: Optional[str] = None, passenger_id: Optional[str] = None) -> dict:
-    """Get trip statistics"""
+    """Get trip statistics (point read from trip_stats for a single driver/passenger)"""
+    if bool(driver_id) != bool(passenger_id):
+        key = _stats_key("driver", driver_id) if driver_id else _stats_key("passenger", passenger_id)
+        doc = await trip_stats_collection.find_one({"_id": key})
+        return _stats_doc_to_statistics(doc)
+
+    # Kết hợp cả hai điều kiện (hoặc không có điều kiện): không có bộ đếm sẵn, dùng aggregation
     match_condition = {}
-    
     if driver_id:
         match_condition["driver_id"] = driver_id
     if passenger_id:
         match_condition["passenger_id"] = passenger_id
     
-    pipeline = [
-        {"$match": match_condition},
-        {
-            "$group": {
-                "_id": None,
-                "total_trips": {"$sum": 1},
-                "completed_trips": {
-                    "$sum": {
-                        "$cond": [{"$eq": ["$status", "COMPLETED"]}, 1, 0]
-                    }
-                },
-                "cancelled_trips": {
-                    "$sum": {
-                        "$cond": [{"$eq": ["$status", "CANCELLED"]}, 1, 0]
-                    }
-                },
-                "total_revenue": {
-                    "$sum": {
-                        "$cond": [
-                            {"$eq": ["$status", "COMPLETED"]},
-                            "$fare.actual",
-                            0
-                        ]
-                    }
-                },
-                "average_rating": {"$avg": "$rating.stars"}
-            }
-        }
-    ]
-    
+    pipeline = [{"$match": match_condition}, _stats_group_stage(None)]
     result = await trips_collection.aggregate(pipeline).to_list(length=1)
-    return result[0] if result else {
-        "total_trips": 0,
-        "completed_trips": 0, 
-        "cancelled_trips": 0,
-        "total_revenue": 0,
-        "average_rating": None
+    return _stats_doc_to_statistics(result[0] if result else None)
+
+def _stats_rebuild_pipeline(role: str, field: str, rebuilt_at: datetime) -> List[dict]:
+    """Recompute one role's trip_stats documents from trips (hot + archive) and $merge them in"""
+    return [
+        {"$unionWith": trips_archive_collection.name},
+        {"$match": {field: {"$nin": ["", None]}}},
+        _stats_group_stage(f"${field}"),
+        {"$addFields": {
+            "owner_id": "$_id",
+            "_id": {"$concat": [f"{role}:", "$_id"]},
+            "role": {"$literal": role},
+            "updated_at": rebuilt_at
+        }},
+        {"$merge": {
+            "into": trip_stats_collection.name,
+            "on": "_id",
+            "whenMatched": "replace",
+            "whenNotMatched": "insert"
+        }}
+    ]
+
+async def rebuild_trip_statistics() -> dict:
+    """Rebuild/backfill trip_stats from trips (hot + archive) using $group + $merge"""
+    started_at = datetime.now(timezone.utc)
+    for role, field in (("driver", "driver_id"), ("passenger", "passenger_id")):
+        await trips_collection.aggregate(_stats_rebuild_pipeline(role, field, started_at)).to_list(length=None)
+    # Xóa bộ đếm của các chủ thể không còn chuyến đi nào (không được $merge chạm tới)
+    stale = await trip_stats_collection.delete_many({"updated_at": {"$lt": started_at}})
+    owners = await trip_stats_collection.count_documents({})
+    logger.info(f"Đã rebuild thống kê: {owners} chủ thể, xóa {stale.deleted_count} bản ghi cũ.")
+    return {"owners": owners, "removed": stale.deleted_count, "rebuilt_at": started_at}
+    
+def _rollup_bucket_step(granularity: models.AnalyticsGranularityEnum) -> timedelta:
+    return timedelta(days=1) if granularity == models.AnalyticsGranularityEnum.DAY else timedelta(hours=1)
+
+async def get_rollup_series(
+    dimension: str,
+    key: str,
+    granularity: models.AnalyticsGranularityEnum,
+    start: datetime,
+    end: datetime
+) -> List[dict]:
+    """Dense time series for one driver/region; one _id range scan over pre-aggregated buckets"""
+    start = _truncate_to_bucket(start, granularity)
+    end = _truncate_to_bucket(end, granularity)
+    first_key = _rollup_key(granularity, dimension, key, start)
+    last_key = _rollup_key(granularity, dimension, key, end)
+    cursor = trip_rollups_collection.find({"_id": {"$gte": first_key, "$lte": last_key}})
+    docs = {doc["_id"]: doc async for doc in cursor}
+
+    series = []
+    step = _rollup_bucket_step(granularity)
+    bucket_start = start
+    while bucket_start <= end:
+        doc = docs.get(_rollup_key(granularity, dimension, key, bucket_start), {})
+        completed = doc.get("trips_completed", 0)
+        finished = completed + doc.get("trips_cancelled", 0)
+        series.append({
+            "bucket_start": bucket_start,
+            "trips_completed": completed,
+            "trips_cancelled": doc.get("trips_cancelled", 0),
+            "revenue": doc.get("revenue", 0),
+            "distance_meters": doc.get("distance_meters", 0),
+            "completion_rate": completed / finished if finished else None
+        })
+        bucket_start += step
+    return series
+
+async def rebuild_trip_rollups(since: Optional[datetime] = None) -> dict:
+    """Backfill hourly/daily rollups from trip history using $group + $merge"""
+    started_at = datetime.now(timezone.utc)
+    if since is not None:
+        # Căn về đầu ngày để không ghi đè bucket ngày bằng dữ liệu thiếu
+        since = _truncate_to_bucket(since, models.AnalyticsGranularityEnum.DAY)
+
+    completed = {"$eq": ["$status", models.TripStatusEnum.COMPLETED.value]}
+    event_at = {"$cond": [
+        completed,
+        {"$ifNull": ["$endTime", "$created_at"]},
+        {"$ifNull": ["$cancellation.cancelled_at", "$created_at"]}
+    ]}
+
+    def cell_index(axis: int) -> dict:
+        coordinate = {"$arrayElemAt": ["$pickup.location.coordinates", axis]}
+        return {"$toString": {"$toLong": {"$floor": {"$multiply": [coordinate, REGION_CELLS_PER_DEGREE]}}}}
+
+    dimensions = {
+        "driver": ({"driver_id": {"$nin": ["", None]}}, "$driver_id"),
+        "region": ({"pickup.location.coordinates.1": {"$exists": True}}, {"$concat": [cell_index(1), "_", cell_index(0)]})
     }
-    
+    finished_statuses = [models.TripStatusEnum.COMPLETED.value, models.TripStatusEnum.CANCELLED.value]
+
+    for granularity, bucket_format in ROLLUP_BUCKET_FORMATS.items():
+        for dimension, (dimension_match, key_expr) in dimensions.items():
+            pipeline = [
+                {"$unionWith": trips_archive_collection.name},
+                {"$match": {"status": {"$in": finished_statuses}, **dimension_match}},
+                {"$addFields": {"_event_at": event_at}}
+            ]
+            if since is not None:
+                pipeline.append({"$match": {"_event_at": {"$gte": since}}})
+            pipeline += [
+                {"$group": {
+                    "_id": {
+                        "key": key_expr,
+                        "bucket_start": {"$dateTrunc": {"date": "$_event_at", "unit": granularity.value}}
+                    },
+                    "trips_completed": {"$sum": {"$cond": [completed, 1, 0]}},
+                    "trips_cancelled": {"$sum": {"$cond": [completed, 0, 1]}},
+                    "revenue": {"$sum": {"$cond": [completed, {"$ifNull": ["$fare.actual", 0]}, 0]}},
+                    "distance_meters": {"$sum": {"$cond": [completed, {"$ifNull": ["$route_info.distance", 0]}, 0]}}
+                }},
+                {"$project": {
+                    "_id": {"$concat": [
+                        f"{granularity.value}:{dimension}:", "$_id.key", ":",
+                        {"$dateToString": {"date": "$_id.bucket_start", "format": bucket_format, "timezone": "UTC"}}
+                    ]},
+                    "granularity": {"$literal": granularity.value},
+                    "dimension": {"$literal": dimension},
+                    "key": "$_id.key",
+                    "bucket_start": "$_id.bucket_start",
+                    "trips_completed": 1,
+                    "trips_cancelled": 1,
+                    "revenue": 1,
+                    "distance_meters": 1,
+                    "updated_at": {"$literal": started_at}
+                }},
+                {"$merge": {
+                    "into": trip_rollups_collection.name,
+                    "on": "_id",
+                    "whenMatched": "replace",
+                    "whenNotMatched": "insert"
+                }}
+            ]
+            await trips_collection.aggregate(pipeline).to_list(length=None)
+
+    stale_filter = {"updated_at": {"$lt": started_at}}
+    if since is not None:
+        stale_filter["bucket_start"] = {"$gte": since}
+    stale = await trip_rollups_collection.delete_many(stale_filter)
+    logger.info(f"Đã rebuild rollup analytics (từ {since or 'đầu'}), xóa {stale.deleted_count} bucket cũ.")
+    return {"since": since, "removed": stale.deleted_count, "rebuilt_at": started_at}
+
+# --- Lưu trữ lạnh (archive) chuyến đi đã kết thúc ---
+TRIP_ARCHIVE_AFTER_DAYS = int(os.getenv("TRIP_ARCHIVE_AFTER_DAYS", 90))
+TRIP_ARCHIVE_BATCH_SIZE = int(os.getenv("TRIP_ARCHIVE_BATCH_SIZE", 500))
+# Các trường chỉ phục vụ điều phối, không cần giữ trong kho lưu trữ
+ARCHIVE_DROPPED_FIELDS = ("notified_driver_ids", "rejected_driver_ids", "offer_sent_at")
+
+async def archive_finished_trips(
+    older_than_days: int = TRIP_ARCHIVE_AFTER_DAYS,
+    batch_size: int = TRIP_ARCHIVE_BATCH_SIZE,
+    max_batches: Optional[int] = None
+) -> int:
+    """Move finished trips older than N days into trips_archive in batches; returns trips moved"""
+    cutoff = datetime.now(timezone.utc) - timedelta(days=older_than_days)
+    query = {
+        "status": {"$in": [models.TripStatusEnum.COMPLETED.value, models.TripStatusEnum.CANCELLED.value]},
+        "created_at": {"$lt": cutoff}
+    }
+    moved = 0
+    batches = 0
+    while max_batches is None or batches < max_batches:
+        batch = await trips_collection.find(query).sort("created_at", 1).limit(batch_size).to_list(length=batch_size)
+        if not batch:
+            break
+        for doc in batch:
+            for field in ARCHIVE_DROPPED_FIELDS:
+                doc.pop(field, None)
+        try:
+            # Ghi vào kho trước rồi mới xóa: chạy lại sau lỗi chỉ gặp duplicate key, không mất dữ liệu
+            await trips_archive_collection.insert_many(batch, ordered=False)
+        except BulkWriteError as e:
+            non_duplicate = [err for err in e.details.get("writeErrors", []) if err.get("code") != 11000]
+            if non_duplicate:
+                logger.error(f"Lỗi khi ghi chuyến đi vào kho lưu trữ: {non_duplicate[:3]}")
+                break
+        result = await trips_collection.delete_many({"_id": {"$in": [doc["_id"] for doc in batch]}})
+        moved += result.deleted_count
+        batches += 1
+    if moved:
+        logger.info(f"Đã chuyển {moved} chuyến đi (kết thúc trước {cutoff.isoformat()}) vào kho lưu trữ.")
+    return moved
+
+# Lease cho job định kỳ: nhiều replica cùng chạy vòng lặp nhưng chỉ replica giữ lease mới làm việc
+JOB_LEASE_HOLDER = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+async def acquire_job_lease(name: str, ttl_seconds: float) -> bool:
+    """Take or renew the named lease; False while another replica holds an unexpired one"""
+    now = datetime.now(timezone.utc)
+    try:
+        await job_leases_collection.update_one(
+            {"_id": name, "$or": [{"holder": JOB_LEASE_HOLDER}, {"expires_at": {"$lte": now}}]},
+            {"$set": {"holder": JOB_LEASE_HOLDER, "expires_at": now + timedelta(seconds=ttl_seconds)}},
+            upsert=True
+        )
+        return True
+    except DuplicateKeyError:
+        # Không khớp điều kiện -> upsert đụng _id của lease đang được replica khác giữ
+        return False
+
 async def find_nearby_drivers_from_location_service(latitude: float, longitude: float) -> List[Dict[str, Any]]:
     search_radii = [3, 7, 15] 
     limit_per_search = 10 
@@ -711,24 +1183,26 @@ async def find_nearby_drivers_from_location_service(latitude: float, longitude:
             "limit": limit_per_search
         }
 
-        try:
+        async def _fetch_nearby() -> httpx.Response:
             async with httpx.AsyncClient() as client:
-                response = await client.get(url, params=params)
-                
-                if response.status_code == 200:
-                    nearby_drivers = response.json()
-                    logger.info(f"Tìm thấy {len(nearby_drivers)} tài xế trong bán kính {radius_km}km.")
-                    break 
-                elif response.status_code == 404:
-                    logger.warning(f"Không tìm thấy tài xế nào trong bán kính {radius_km}km. Mở rộng tìm kiếm...")
-                    continue 
-                else:
-                    response.raise_for_status() 
+                return _raise_for_server_error(await client.get(url, params=params))
+
+        try:
+            response = await location_upstream.call(_fetch_nearby)
+            if response.status_code == 200:
+                nearby_drivers = response.json()
+                logger.info(f"Tìm thấy {len(nearby_drivers)} tài xế trong bán kính {radius_km}km.")
+                break 
+            elif response.status_code == 404:
+                logger.warning(f"Không tìm thấy tài xế nào trong bán kính {radius_km}km. Mở rộng tìm kiếm...")
+                continue 
+            else:
+                response.raise_for_status() 
 
         except httpx.HTTPStatusError as e:
             logger.error(f"Lỗi khi gọi LocationService (HTTP {e.response.status_code}): {e.response.text}")
             return [] 
-        except httpx.RequestError as e:
+        except (httpx.RequestError, resilience.UpstreamUnavailable) as e:
             logger.error(f"Không thể kết nối đến LocationService: {e}")
             return [] 
 
@@ -742,11 +1216,15 @@ async def notify_drivers_via_location_service(driver_ids: List[str], payload: Di
     url = f"{LOCATION_SERVICE_URL}/notify/drivers" 
     request_data = {"driver_ids": driver_ids, "payload": payload}
     
-    try:
+    async def _post_notification() -> httpx.Response:
         async with httpx.AsyncClient() as client:
-            response = await client.post(url, json=request_data, timeout=10.0)
-            response.raise_for_status() 
-            logger.info(f"TripService: Đã yêu cầu LocationService thông báo (loại: {payload.get('type')}) cho {len(driver_ids)} tài xế.")
+            return _raise_for_server_error(await client.post(url, json=request_data))
+
+    try:
+        # POST không idempotent: dùng chung breaker của LocationService nhưng không hedge
+        response = await location_upstream.call(_post_notification, hedge=False)
+        response.raise_for_status() 
+        logger.info(f"TripService: Đã yêu cầu LocationService thông báo (loại: {payload.get('type')}) cho {len(driver_ids)} tài xế.")
     except httpx.RequestError as e:
         logger.error(f"TripService: Không thể kết nối LocationService (để thông báo): {e}")
     except httpx.HTTPStatusError as e:
@@ -758,17 +1236,79 @@ async def notify_passenger_via_location_service(trip_id: str, payload: Dict[str,
     url = f"{LOCATION_SERVICE_URL}/notify/trip/{trip_id}/passenger"
     request_data = {"payload": payload}
     
-    try:
+    async def _post_notification() -> httpx.Response:
         async with httpx.AsyncClient() as client:
-            response = await client.post(url, json=request_data, timeout=10.0)
-            response.raise_for_status()
-            logger.info(f"TripService: Đã yêu cầu LocationService thông báo cho hành khách (chuyến {trip_id}, loại: {payload.get('type')}).")
+            return _raise_for_server_error(await client.post(url, json=request_data))
+
+    try:
+        response = await location_upstream.call(_post_notification, hedge=False)
+        response.raise_for_status()
+        logger.info(f"TripService: Đã yêu cầu LocationService thông báo cho hành khách (chuyến {trip_id}, loại: {payload.get('type')}).")
     except Exception as e:
         logger.error(f"TripService: Lỗi khi thông báo hành khách: {e}")
 
 
+def _cached_driver_profile(driver_id: str) -> Optional[Dict[str, Any]]:
+    entry = _driver_profile_cache.get(driver_id)
+    if entry is None:
+        return None
+    expires_at, profile = entry
+    if expires_at <= datetime.now(timezone.utc):
+        _driver_profile_cache.pop(driver_id, None)
+        return None
+    return profile
+
+def _cache_driver_profile(driver_id: str, profile: Dict[str, Any]):
+    if len(_driver_profile_cache) >= DRIVER_PROFILE_CACHE_MAX_SIZE:
+        # Đầy: bỏ mục cũ nhất (dict giữ thứ tự chèn)
+        _driver_profile_cache.pop(next(iter(_driver_profile_cache)), None)
+    _driver_profile_cache[driver_id] = (
+        datetime.now(timezone.utc) + timedelta(seconds=DRIVER_PROFILE_CACHE_TTL_SECONDS), profile
+    )
+
+def invalidate_driver_profile(driver_id: str) -> bool:
+    """Xóa hồ sơ tài xế khỏi cache (gọi khi DriverService báo hồ sơ thay đổi)."""
+    return _driver_profile_cache.pop(driver_id, None) is not None
+
+async def prefetch_driver_profiles(driver_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+    """Lấy hồ sơ của nhiều tài xế bằng một lần gọi /drivers/internal/batch, bỏ qua các mục đã có trong cache."""
+    profiles = {driver_id: _cached_driver_profile(driver_id) for driver_id in driver_ids}
+    missing = [driver_id for driver_id, profile in profiles.items() if profile is None]
+    if not missing:
+        return profiles
+
+    service_token = await _get_service_token()
+    if not service_token or not DRIVER_SERVICE_URL:
+        logger.error("Không thể lấy Service Token hoặc thiếu DRIVER_SERVICE_URL để lấy hồ sơ tài xế theo lô.")
+        return profiles
+
+    url = f"{DRIVER_SERVICE_URL}/drivers/internal/batch"
+    headers = {"Authorization": f"Bearer {service_token}"}
+
+    async def _fetch_batch() -> httpx.Response:
+        async with httpx.AsyncClient() as client:
+            return _raise_for_server_error(await client.post(url, json={"driver_ids": missing}, headers=headers))
+
+    try:
+        response = await driver_upstream.call(_fetch_batch)
+        if response.status_code in (401, 403):
+            service_token_manager.invalidate(service_token)
+        response.raise_for_status()
+        for profile in response.json():
+            driver_id = profile.get("_id") or profile.get("id")
+            if driver_id:
+                _cache_driver_profile(driver_id, profile)
+                profiles[driver_id] = profile
+    except Exception as e:
+        logger.error(f"Lỗi khi lấy hồ sơ {len(missing)} tài xế theo lô từ DriverService: {e}")
+    return profiles
+
 async def get_driver_details_from_driver_service(driver_id: str) -> Optional[Dict[str, Any]]:
-    """Lấy thông tin tài xế từ DriverService (dùng OAuth2 Service Token)."""
+    """Lấy thông tin tài xế từ DriverService (dùng OAuth2 Service Token), ưu tiên cache."""
+
+    cached_profile = _cached_driver_profile(driver_id)
+    if cached_profile is not None:
+        return cached_profile
 
     service_token = await _get_service_token()
     if not service_token:
@@ -782,21 +1322,23 @@ async def get_driver_details_from_driver_service(driver_id: str) -> Optional[Dic
     headers = {"Authorization": f"Bearer {service_token}"} 
 
     logger.info(f"Đang gọi DriverService (internal) cho driver {driver_id} với Service Token...")
-    try:
+    async def _fetch_driver() -> httpx.Response:
         async with httpx.AsyncClient() as client:
-            response = await client.get(url, headers=headers, timeout=5.0)
+            return _raise_for_server_error(await client.get(url, headers=headers))
 
-            if response.status_code == 200:
-                return response.json()
-            elif response.status_code == 401 or response.status_code == 403:
-                 logger.error(f"Lỗi gọi DriverService: Service Token không hợp lệ hoặc bị từ chối.")
-                 global _service_token_cache, _token_expiry_time
-                 _service_token_cache = None
-                 _token_expiry_time = None
-                 return None
-            else:
-                logger.warning(f"DriverService trả lỗi {response.status_code} khi lấy thông tin {driver_id}")
-                return None
+    try:
+        response = await driver_upstream.call(_fetch_driver)
+        if response.status_code == 200:
+            profile = response.json()
+            _cache_driver_profile(driver_id, profile)
+            return profile
+        elif response.status_code == 401 or response.status_code == 403:
+             logger.error(f"Lỗi gọi DriverService: Service Token không hợp lệ hoặc bị từ chối.")
+             service_token_manager.invalidate(service_token)
+             return None
+        else:
+            logger.warning(f"DriverService trả lỗi {response.status_code} khi lấy thông tin {driver_id}")
+            return None
     except Exception as e:
         logger.error(f"Lỗi khi gọi DriverService để lấy thông tin: {e}")
         return None
@@ -823,49 +1365,6 @@ async def reject_trip_by_driver(trip_id: str, driver_id: str) -> bool:
     return result.modified_count > 0
 
 async def _get_service_token() -> Optional[str]:
-    global _service_token_cache, _token_expiry_time
-
-    if _service_token_cache and _token_expiry_time and \
-       _token_expiry_time > (datetime.now(timezone.utc) + timedelta(minutes=1)):
-        logger.info("Sử dụng Service Token từ cache.")
-        return _service_token_cache
-
-    if not USER_SERVICE_URL or not MY_CLIENT_ID or not MY_CLIENT_SECRET:
-        logger.error("Client ID/Secret hoặc UserService URL chưa được cấu hình!")
-        return None
-
-    token_url = f"{USER_SERVICE_URL}/auth/token"
-    data = {
-        "username": MY_CLIENT_ID, 
-        "password": MY_CLIENT_SECRET 
-    }
-
-    logger.info(f"Đang xin Service Token từ {token_url} cho client {MY_CLIENT_ID}...")
-    try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(token_url, data=data, timeout=10.0)
-            response.raise_for_status() 
-
-            token_data = response.json()
-            new_token = token_data.get("access_token")
-
-            if new_token:
-                logger.info("Lấy Service Token mới thành công.")
-                _service_token_cache = new_token
-                _token_expiry_time = datetime.now(timezone.utc) + timedelta(minutes=14)
-                return new_token
-            else:
-                logger.error("Phản hồi từ UserService không chứa access_token.")
-                return None
-
-    except httpx.RequestError as e:
-        logger.error(f"Lỗi kết nối đến UserService để lấy token: {e}")
-        return None
-    except httpx.HTTPStatusError as e:
-        logger.error(f"UserService trả lỗi khi cấp token: {e.response.status_code} - {e.response.text}")
-        return None
-    except Exception as e:
-        logger.error(f"Lỗi không xác định khi lấy Service Token: {e}")
-        return None
+    return await service_token_manager.get_token()
 
     
@@ -1,6 +1,9 @@
 import os
+import logging
 import motor.motor_asyncio
-from pymongo import MongoClient
+from pymongo import MongoClient, ASCENDING, DESCENDING
+
+logger = logging.getLogger(__name__)
 
 MONGODB_URL = os.getenv("MONGODB_URL")
 DATABASE_NAME = os.getenv("MONGO_INITDB_DATABASE", "uitgo_trips")
@@ -12,9 +15,37 @@ database = client[DATABASE_NAME]
 
 trips_collection = database.get_collection("trips")
 ratings_collection = database.get_collection("ratings")
+trip_stats_collection = database.get_collection("trip_stats")
+trip_rollups_collection = database.get_collection("trip_rollups")
+trip_routes_collection = database.get_collection("trip_routes")
+# Kho lạnh cho chuyến đi đã kết thúc lâu (xem crud.archive_finished_trips)
+TRIPS_ARCHIVE_COLLECTION = "trips_archive"
+trips_archive_collection = database.get_collection(TRIPS_ARCHIVE_COLLECTION)
+# Hàng đợi thanh toán E-Wallet: TripService ghi, PaymentService tiêu thụ (cùng cluster, DB của PaymentService)
+PAYMENT_QUEUE_DATABASE = os.getenv("PAYMENT_QUEUE_DATABASE", "uitgo_payments")
+payment_jobs_collection = client[PAYMENT_QUEUE_DATABASE].get_collection("payment_jobs")
+# Lease của job định kỳ (archiver) để chỉ một replica chạy tại một thời điểm
+job_leases_collection = database.get_collection("job_leases")
+# Response đã lưu theo Idempotency-Key (xem idempotency.py), hết hạn qua TTL index
+idempotency_collection = database.get_collection("idempotency_keys")
 
 sync_client = MongoClient(MONGODB_URL)
 sync_database = sync_client[DATABASE_NAME]
 
 def get_database():
-    return database
\ No newline at end of file
+    return database
+
+async def create_trip_archive_collection():
+    """Tạo collection lưu trữ (nén zstd) và index cho đường đọc lịch sử (gọi khi startup)."""
+    try:
+        existing = await database.list_collection_names(filter={"name": TRIPS_ARCHIVE_COLLECTION})
+        if not existing:
+            await database.create_collection(
+                TRIPS_ARCHIVE_COLLECTION,
+                storageEngine={"wiredTiger": {"configString": "block_compressor=zstd"}}
+            )
+        await trips_archive_collection.create_index([("passenger_id", ASCENDING), ("created_at", DESCENDING)], background=True)
+        await trips_archive_collection.create_index([("driver_id", ASCENDING), ("created_at", DESCENDING)], background=True)
+        logger.info("TripService: Đã tạo/đảm bảo collection lưu trữ chuyến đi.")
+    except Exception as e:
+        logger.error(f"TripService: Lỗi khi tạo collection lưu trữ: {e}")
@@ -1,15 +1,22 @@
-from fastapi import FastAPI, HTTPException, status, Query
-from typing import List, Optional, Dict, Any
-from datetime import datetime
+from fastapi import FastAPI, HTTPException, status, Query, Header, Depends
+from typing import List, Optional, Dict, Any, AsyncGenerator
+from contextlib import asynccontextmanager
+import asyncio
+from datetime import datetime, timedelta, timezone
 from dotenv import load_dotenv
 
 import crud
 import models
 import schemas
+from database import create_trip_archive_collection
+from idempotency import IDEMPOTENCY_HEADER, create_idempotency_index, run_idempotent
+from resilience import UpstreamUnavailable, upstreams_snapshot
+from admission import AdmissionController, RoutePolicy, PRIORITY_CRITICAL, PRIORITY_NORMAL, PRIORITY_LOW
 
+import math
 import os
-import httpx
-from fastapi import Body
+from fastapi import Body, Request
+from fastapi.responses import JSONResponse
 import logging
 
 # Load environment variables
@@ -18,13 +25,75 @@ load_dotenv()
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
+
+TRIP_ARCHIVE_INTERVAL_MINUTES = int(os.getenv("TRIP_ARCHIVE_INTERVAL_MINUTES", 60))
+TRIP_ARCHIVER_LEASE = "trip-archiver"
+
+# Giới hạn đồng thời theo nhóm route: vòng đời chuyến (accept/complete...) được ưu tiên hơn tạo chuyến và ước tính giá
+admission = AdmissionController({
+    "trip_lifecycle": RoutePolicy(
+        limit=int(os.getenv("ADMISSION_TRIP_LIFECYCLE_LIMIT", 100)), max_queue=200, queue_timeout=2.0, priority=PRIORITY_CRITICAL
+    ),
+    "trip_create": RoutePolicy(
+        limit=int(os.getenv("ADMISSION_TRIP_CREATE_LIMIT", 50)), max_queue=100, queue_timeout=1.0, priority=PRIORITY_NORMAL
+    ),
+    "fare_estimate": RoutePolicy(
+        limit=int(os.getenv("ADMISSION_FARE_ESTIMATE_LIMIT", 20)), max_queue=20, queue_timeout=0.25, priority=PRIORITY_LOW
+    ),
+})
+
+async def _run_trip_archiver():
+    """Định kỳ chuyển chuyến đi cũ đã kết thúc sang kho lưu trữ (0 = tắt); chỉ replica giữ lease chạy."""
+    # Lease dài hơn một chu kỳ: replica giữ lease gia hạn mỗi vòng, chết thì replica khác tiếp quản
+    lease_seconds = TRIP_ARCHIVE_INTERVAL_MINUTES * 60 + 60
+    while True:
+        try:
+            if await crud.acquire_job_lease(TRIP_ARCHIVER_LEASE, lease_seconds):
+                await crud.archive_finished_trips()
+        except Exception as e:
+            logger.error(f"TripService: Lỗi khi chạy archiver: {e}", exc_info=True)
+        await asyncio.sleep(TRIP_ARCHIVE_INTERVAL_MINUTES * 60)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncGenerator[None, None]:
+    logger.info("TripService: Đang khởi động...")
+    await create_trip_archive_collection()
+    await create_idempotency_index()
+    archiver_task = asyncio.create_task(_run_trip_archiver()) if TRIP_ARCHIVE_INTERVAL_MINUTES > 0 else None
+    token_refresher_task = asyncio.create_task(crud.service_token_manager.run_refresher())
+    logger.info("TripService: Khởi động hoàn tất.")
+    yield
+    logger.info("TripService: Đang tắt...")
+    if archiver_task:
+        archiver_task.cancel()
+    token_refresher_task.cancel()
+    logger.info("TripService: Tắt hoàn tất.")
                            
-app = FastAPI(title="UIT-Go Trip Service (MongoDB)", version="1.0.0")
+app = FastAPI(title="UIT-Go Trip Service (MongoDB)", version="1.0.0", lifespan=lifespan)
 
 @app.get("/")
 async def get_service_info():
     return {"service": "UIT-Go Trip Service", "version": "1.0", "status": "running", "database": "MongoDB"}
 
+@app.exception_handler(UpstreamUnavailable)
+async def upstream_unavailable_handler(request: Request, exc: UpstreamUnavailable):
+    """Upstream bị ngắt mạch / quá hạn: trả 503 ngay thay vì chờ hết timeout"""
+    return JSONResponse(
+        status_code=503,
+        content={"detail": f"Dịch vụ phụ thuộc tạm thời không khả dụng ({exc.upstream})."},
+        headers={"Retry-After": str(exc.retry_after)}
+    )
+
+@app.get("/metrics/upstreams")
+async def upstream_metrics():
+    """Trạng thái circuit breaker và histogram độ trễ theo từng upstream"""
+    return upstreams_snapshot()
+
+@app.get("/metrics/admission")
+async def admission_metrics():
+    """Độ sâu hàng đợi, số request đang chạy và số request bị cắt theo từng nhóm route"""
+    return admission.snapshot()
+
 @app.get("/health")
 async def health_check():
     """Health check endpoint for Kubernetes probes"""
@@ -43,7 +112,7 @@ async def health_check():
 
 # Trip CRUD routes
 # New flow: FE sends coordinates -> BE returns fare estimates for all vehicle types
-@app.post("/fare-estimate/", response_model=schemas.FareEstimateResponse)
+@app.post("/fare-estimate/", response_model=schemas.FareEstimateResponse, dependencies=[Depends(admission.dependency("fare_estimate"))])
 async def estimate_fare(fare_request: schemas.FareEstimateRequest):
     """Estimate fare for all vehicle types based on pickup/dropoff coordinates"""
     pickup_coords = (fare_request.pickup.longitude, fare_request.pickup.latitude)
@@ -60,28 +129,38 @@ async def estimate_fare(fare_request: schemas.FareEstimateRequest):
 @app.post(
     "/trip-requests/complete/",
     response_model=schemas.TripCreationResponse, 
+    dependencies=[Depends(admission.dependency("trip_create"))],
 )
-async def create_complete_trip_request(trip_request: schemas.TripRequestComplete):
+async def create_complete_trip_request(
+    trip_request: schemas.TripRequestComplete,
+    idempotency_key: Optional[str] = Header(None, alias=IDEMPOTENCY_HEADER)
+):
 
-    try:
-        trip_data = await crud.create_trip_request_complete(trip_request)
-        if not trip_data: 
-             raise HTTPException(status_code=500, detail="Lỗi không xác định khi tạo chuyến đi.")
-        return {"trip": trip_data}
+    async def _create():
+        try:
+            trip_data = await crud.create_trip_request_complete(trip_request)
+            if not trip_data: 
+                 raise HTTPException(status_code=500, detail="Lỗi không xác định khi tạo chuyến đi.")
+            return schemas.TripCreationResponse(trip=trip_data)
 
-    except ValueError as e: 
-        logger.error(f"Lỗi khi tạo chuyến đi: {e}")
-        raise HTTPException(status_code=400, detail=str(e))
-    except HTTPException as http_exc: 
-         raise http_exc
-    except Exception as e: 
-        logger.error(f"Lỗi không xác định khi tạo chuyến đi: {e}", exc_info=True)
-        raise HTTPException(status_code=500, detail="Lỗi server khi tạo chuyến đi.")
+        except ValueError as e: 
+            logger.error(f"Lỗi khi tạo chuyến đi: {e}")
+            raise HTTPException(status_code=400, detail=str(e))
+        except HTTPException as http_exc: 
+             raise http_exc
+        except UpstreamUnavailable:
+            raise
+        except Exception as e: 
+            logger.error(f"Lỗi không xác định khi tạo chuyến đi: {e}", exc_info=True)
+            raise HTTPException(status_code=500, detail="Lỗi server khi tạo chuyến đi.")
 
+    # Client retry cùng Idempotency-Key: không tạo chuyến mới, không gọi lại Mapbox
+    return await run_idempotent(idempotency_key, "POST /trip-requests/complete/", trip_request, _create)
 
 
 
-@app.put("/trips/{trip_id}/assign-driver", response_model=schemas.TripResponse)
+
+@app.put("/trips/{trip_id}/assign-driver", response_model=schemas.TripResponse, dependencies=[Depends(admission.dependency("trip_lifecycle"))])
 async def assign_driver(trip_id: str, assign_data: schemas.AssignDriver):
     """Assign driver to a pending trip"""
     trip_data = await crud.assign_driver_to_trip(trip_id, assign_data.driver_id)
@@ -92,13 +171,24 @@ async def assign_driver(trip_id: str, assign_data: schemas.AssignDriver):
 
 
 @app.get("/trips/{trip_id}", response_model=schemas.TripResponse)
-async def get_trip(trip_id: str):
-    """Get trip by ID with all nested information"""
+async def get_trip(trip_id: str, include_route: bool = Query(False)):
+    """Get trip by ID with all nested information (route polyline only when include_route=true)"""
     trip_data = await crud.get_trip_by_id(trip_id)
     if trip_data is None:
         raise HTTPException(status_code=404, detail="Trip not found")
+    if include_route and trip_data.get("route_info"):
+        route = await crud.get_trip_route(trip_id)
+        trip_data["route_info"]["geometry"] = (route or {}).get("geometry")
     return schemas.TripResponse(**trip_data)
 
+@app.get("/trips/{trip_id}/route", response_model=schemas.TripRouteResponse)
+async def get_trip_route(trip_id: str):
+    """Get the encoded route polyline for map rendering"""
+    route = await crud.get_trip_route(trip_id)
+    if route is None:
+        raise HTTPException(status_code=404, detail="Route not found for this trip")
+    return schemas.TripRouteResponse(**route)
+
 @app.delete("/trips/{trip_id}")
 async def delete_trip(trip_id: str):
     success = await crud.delete_trip(trip_id)
@@ -148,7 +238,7 @@ async def get_trips_near_location(
     return [_convert_to_summary(trip) for trip in trips]
 
 # Trip status management
-@app.post("/trips/{trip_id}/accept")
+@app.post("/trips/{trip_id}/accept", dependencies=[Depends(admission.dependency("trip_lifecycle"))])
 async def accept_trip(trip_id: str):
     """Accept a trip (PENDING -> ACCEPTED)"""
     trip_data = await crud.update_trip_status(trip_id, models.TripStatusEnum.ACCEPTED)
@@ -156,7 +246,7 @@ async def accept_trip(trip_id: str):
         raise HTTPException(status_code=404, detail="Trip not found")
     return {"message": "Trip accepted successfully", "trip_id": trip_id, "status": "ACCEPTED"}
 
-@app.post("/trips/{trip_id}/start")
+@app.post("/trips/{trip_id}/start", dependencies=[Depends(admission.dependency("trip_lifecycle"))])
 async def start_trip(trip_id: str):
     """Start a trip (ACCEPTED -> ON_TRIP)"""
     trip_data = await crud.update_trip_status(trip_id, models.TripStatusEnum.ON_TRIP)
@@ -164,7 +254,7 @@ async def start_trip(trip_id: str):
         raise HTTPException(status_code=404, detail="Trip not found")
     return {"message": "Trip started successfully", "trip_id": trip_id, "status": "ON_TRIP"}
 
-@app.post("/trips/{trip_id}/deny")
+@app.post("/trips/{trip_id}/deny", dependencies=[Depends(admission.dependency("trip_lifecycle"))])
 async def deny_trip(trip_id: str, deny_data: schemas.AssignDriver):
     """Driver denies/rejects assigned trip - removes driver and sets back to PENDING"""
     trip_data = await crud.deny_trip(trip_id, deny_data.driver_id)
@@ -172,57 +262,56 @@ async def deny_trip(trip_id: str, deny_data: schemas.AssignDriver):
         raise HTTPException(status_code=404, detail="Trip not found or cannot be denied")
     return {"message": "Trip denied successfully - returned to pending", "trip_id": trip_id, "status": "PENDING"}
 
-@app.post("/trips/{trip_id}/complete")
-async def complete_trip(trip_id: str, data: dict = Body(...)):
+@app.post("/trips/{trip_id}/complete", dependencies=[Depends(admission.dependency("trip_lifecycle"))])
+async def complete_trip(
+    trip_id: str,
+    data: dict = Body(...),
+    idempotency_key: Optional[str] = Header(None, alias=IDEMPOTENCY_HEADER)
+):
     """
     Hoàn thành chuyến đi và xử lý thanh toán tùy theo phương thức đã chọn.
     """
-    actual_fare = data.get("actual_fare")
-    if actual_fare is None:
+    try:
+        actual_fare = float(data["actual_fare"])
+    except KeyError:
         raise HTTPException(status_code=400, detail="actual_fare is required in the request body")
-    trip = await crud.get_trip_by_id(trip_id)
-    if trip is None:
-        raise HTTPException(status_code=404, detail="Trip not found")
-
-    payment_method = trip.get("payment", {}).get("method", "Cash")
-    if payment_method == "E-Wallet":
-        payment_request_data = {
-            "trip_id": trip_id,
-            "user_id": trip.get("passenger_id"),
-            "driver_id": trip.get("driver_id"),
-            "amount": actual_fare
-        }
-
-        PAYMENT_SERVICE_URL = os.getenv("PAYMENT_SERVICE_URL")
-        if not PAYMENT_SERVICE_URL:
-            raise HTTPException(status_code=500, detail="PAYMENT_SERVICE_URL is not configured")
-
-        try:
-            async with httpx.AsyncClient() as client:
-                response = await client.post(
-                    f"{PAYMENT_SERVICE_URL}/process-payment", json=payment_request_data, timeout=20.0
-                )
-                response.raise_for_status()
-                payment_result = response.json()
-        except (httpx.RequestError, httpx.TimeoutException):
-            raise HTTPException(status_code=503, detail="Could not connect to Payment Service")
-        except httpx.HTTPStatusError as e:
-            raise HTTPException(status_code=e.response.status_code, detail=e.response.json())
-        await crud.update_trip_status(trip_id, models.TripStatusEnum.COMPLETED)
-        await crud.update_trip_fare(trip_id, actual_fare)
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="actual_fare must be a number")
+    if not math.isfinite(actual_fare) or actual_fare < 0:
+        raise HTTPException(status_code=400, detail="actual_fare must be a non-negative number")
+    return await run_idempotent(
+        idempotency_key, f"POST /trips/{trip_id}/complete", data,
+        lambda: _complete_trip(trip_id, actual_fare)
+    )
 
+async def _complete_trip(trip_id: str, actual_fare: float) -> dict:
+    # Một lần ghi có điều kiện (ON_TRIP/ACCEPTED) -> COMPLETED; gọi lại (retry) không áp dụng lần hai
+    trip = await crud.complete_trip(trip_id, actual_fare)
+    already_completed = trip is None
+    if already_completed:
+        trip = await crud.get_trip_by_id(trip_id)
+        if trip is None:
+            raise HTTPException(status_code=404, detail="Trip not found")
+        if trip.get("status") != models.TripStatusEnum.COMPLETED.value:
+            raise HTTPException(status_code=409, detail=f"Trip cannot be completed from status {trip.get('status')}")
+
+    payment = trip.get("payment") or {}
+    if payment.get("method") == models.PaymentMethodEnum.E_WALLET.value:
+        # Không chờ nhà cung cấp thanh toán: PaymentService lấy job từ hàng đợi rồi báo lại
+        # qua PUT /trips/{trip_id}/payment. Retry sẽ xếp lại job nếu lần trước chưa kịp ghi.
+        if payment.get("status") == models.PaymentStatusEnum.PENDING.value:
+            await crud.enqueue_payment_job(trip)
         return {
-            "message": "Trip completed and payment processed successfully",
-            "payment_details": payment_result
+            "message": "Trip already completed" if already_completed else "Trip completed, payment queued",
+            "trip_id": trip_id,
+            "payment_status": payment.get("status")
         }
 
-    else:
-        await crud.update_trip_status(trip_id, models.TripStatusEnum.COMPLETED)
-        await crud.update_trip_fare(trip_id, actual_fare)
-        
-        return {"message": "Trip completed (Cash payment)"}
+    if already_completed:
+        return {"message": "Trip already completed", "trip_id": trip_id}
+    return {"message": "Trip completed (Cash payment)"}
 
-@app.post("/trips/{trip_id}/cancel")
+@app.post("/trips/{trip_id}/cancel", dependencies=[Depends(admission.dependency("trip_lifecycle"))])
 async def cancel_trip(trip_id: str, cancellation: schemas.CancellationCreate):
     """Cancel a trip with reason"""
     trip_data = await crud.cancel_trip(trip_id, cancellation)
@@ -254,6 +343,14 @@ async def update_trip_payment_status_internal(
     return {"message": "Payment status updated successfully"}
 
 
+@app.post("/internal/driver-events", tags=["Driver Internal"])
+async def handle_driver_change_event(event: schemas.DriverChangeEvent):
+    """[API NỘI BỘ] DriverService báo hồ sơ tài xế thay đổi: bỏ bản cache cũ."""
+    invalidated = crud.invalidate_driver_profile(event.driver_id)
+    logger.info(f"Nhận sự kiện {event.event} cho tài xế {event.driver_id} (đã xóa cache: {invalidated})")
+    return {"driver_id": event.driver_id, "invalidated": invalidated}
+
+
 @app.post("/trips/{trip_id}/rating")
 async def add_trip_rating(trip_id: str, rating: schemas.RatingCreate):
     trip_data = await crud.get_trip_by_id(trip_id)
@@ -295,6 +392,74 @@ async def get_passenger_statistics(passenger_id: str):
     stats = await crud.get_trip_statistics(passenger_id=passenger_id)
     return schemas.TripStatistics(**stats)
 
+@app.post("/statistics/rebuild", tags=["Statistics Internal"])
+async def rebuild_statistics():
+    """[API NỘI BỘ] Tính lại toàn bộ bộ đếm thống kê từ collection trips (backfill)."""
+    result = await crud.rebuild_trip_statistics()
+    return {"message": "Statistics rebuilt successfully", **result}
+
+# Analytics (rollup theo giờ/ngày)
+ANALYTICS_DEFAULT_WINDOWS = {
+    models.AnalyticsGranularityEnum.HOUR: timedelta(hours=24),
+    models.AnalyticsGranularityEnum.DAY: timedelta(days=30)
+}
+ANALYTICS_MAX_BUCKETS = 744  # 31 ngày theo giờ
+
+async def _analytics_series(
+    dimension: str,
+    key: str,
+    granularity: models.AnalyticsGranularityEnum,
+    start: Optional[datetime],
+    end: Optional[datetime]
+) -> schemas.AnalyticsSeriesResponse:
+    # Query string có thể không kèm múi giờ: coi như UTC để so sánh được với now()
+    end = crud._as_utc(end) or datetime.now(timezone.utc)
+    start = crud._as_utc(start) or end - ANALYTICS_DEFAULT_WINDOWS[granularity]
+    if start > end:
+        raise HTTPException(status_code=400, detail="start must be before end")
+    step = timedelta(days=1) if granularity == models.AnalyticsGranularityEnum.DAY else timedelta(hours=1)
+    if (end - start) / step > ANALYTICS_MAX_BUCKETS:
+        raise HTTPException(status_code=400, detail=f"Time range exceeds {ANALYTICS_MAX_BUCKETS} buckets")
+    buckets = await crud.get_rollup_series(dimension, key, granularity, start, end)
+    return schemas.AnalyticsSeriesResponse(dimension=dimension, key=key, granularity=granularity, buckets=buckets)
+
+@app.get("/analytics/driver/{driver_id}", response_model=schemas.AnalyticsSeriesResponse)
+async def get_driver_analytics(
+    driver_id: str,
+    granularity: models.AnalyticsGranularityEnum = Query(models.AnalyticsGranularityEnum.DAY),
+    start: Optional[datetime] = Query(None),
+    end: Optional[datetime] = Query(None)
+):
+    """Earnings and completion-rate time series for a driver"""
+    return await _analytics_series("driver", driver_id, granularity, start, end)
+
+@app.get("/analytics/region", response_model=schemas.AnalyticsSeriesResponse)
+async def get_region_analytics(
+    longitude: float = Query(..., ge=-180, le=180),
+    latitude: float = Query(..., ge=-90, le=90),
+    granularity: models.AnalyticsGranularityEnum = Query(models.AnalyticsGranularityEnum.DAY),
+    start: Optional[datetime] = Query(None),
+    end: Optional[datetime] = Query(None)
+):
+    """Revenue and completion-rate time series for the region (0.1° grid cell) containing a point"""
+    region = crud.region_key_for(longitude, latitude)
+    return await _analytics_series("region", region, granularity, start, end)
+
+@app.post("/analytics/rebuild", tags=["Statistics Internal"])
+async def rebuild_analytics(since: Optional[datetime] = Query(None)):
+    """[API NỘI BỘ] Backfill rollup theo giờ/ngày từ lịch sử chuyến đi (toàn bộ hoặc từ `since`)."""
+    result = await crud.rebuild_trip_rollups(since)
+    return {"message": "Analytics rollups rebuilt successfully", **result}
+
+@app.post("/trips/archive/run", tags=["Statistics Internal"])
+async def run_trip_archiver(
+    older_than_days: int = Query(crud.TRIP_ARCHIVE_AFTER_DAYS, ge=1),
+    max_batches: Optional[int] = Query(None, ge=1)
+):
+    """[API NỘI BỘ] Chạy archiver ngay (ví dụ từ CronJob) thay vì đợi vòng định kỳ."""
+    moved = await crud.archive_finished_trips(older_than_days=older_than_days, max_batches=max_batches)
+    return {"message": "Trip archiver finished", "archived": moved}
+
 # Helper function
 def _convert_to_summary(trip: dict) -> schemas.TripSummaryResponse:
     """Convert full trip to summary response"""
@@ -312,7 +477,7 @@ def _convert_to_summary(trip: dict) -> schemas.TripSummaryResponse:
         endTime=trip.get("endTime")
     )
     
-@app.post("/trips/{trip_id}/reject")
+@app.post("/trips/{trip_id}/reject", dependencies=[Depends(admission.dependency("trip_lifecycle"))])
 async def reject_trip(trip_id: str, reject_data: schemas.AssignDriver):
     driver_id = reject_data.driver_id
     success = await crud.reject_trip_by_driver(trip_id, driver_id)
@@ -28,6 +28,10 @@ class CancelledByEnum(str, Enum):
     DRIVER = "DRIVER"
     SYSTEM = "SYSTEM"
 
+class AnalyticsGranularityEnum(str, Enum):
+    HOUR = "hour"
+    DAY = "day"
+
 class VehicleTypeEnum(str, Enum):
     TWO_SEATER = "2_SEATER"  # Xe 2 chỗ
     FOUR_SEATER = "4_SEATER"  # Xe 4 chỗ  
@@ -71,7 +75,8 @@ class StatusHistory(BaseModel):
 class RouteInfo(BaseModel):
     distance: float  # Total distance in meters
     duration: float  # Total duration in seconds  
-    geometry: str    # Encoded polyline for route visualization
+    geometry_id: Optional[str] = None  # Key into trip_routes (encoded polyline, loaded lazily)
+    geometry: Optional[str] = None     # Encoded polyline; only inline on legacy trips / when hydrated
 
 class Trip(BaseModel):
     id: Optional[str] = Field(default=None, alias="_id")
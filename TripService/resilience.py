@@ -0,0 +1,215 @@
+"""Circuit breaker + hedged request cho các upstream (Mapbox, LocationService, DriverService)."""
+import asyncio
+import bisect
+import logging
+import math
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Biên trên (ms) của các bucket histogram độ trễ
+LATENCY_BUCKETS_MS = [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+# Cần ít nhất chừng này mẫu thì mới dùng p95 thực tế làm ngưỡng hedge
+HEDGE_MIN_SAMPLES = 20
+
+class UpstreamUnavailable(Exception):
+    """Upstream bị ngắt mạch hoặc quá thời gian chờ."""
+
+    def __init__(self, upstream: str, reason: str, retry_after: int = 1):
+        super().__init__(f"{upstream}: {reason}")
+        self.upstream = upstream
+        self.retry_after = retry_after
+
+class LatencyHistogram:
+    """Fixed-bucket latency histogram with approximate percentiles"""
+
+    def __init__(self, buckets_ms: List[float] = LATENCY_BUCKETS_MS):
+        self.buckets_ms = list(buckets_ms)
+        self.counts = [0] * (len(self.buckets_ms) + 1)
+        self.total = 0
+        self.sum_ms = 0.0
+
+    def record(self, seconds: float):
+        ms = seconds * 1000
+        self.counts[bisect.bisect_left(self.buckets_ms, ms)] += 1
+        self.total += 1
+        self.sum_ms += ms
+
+    def percentile(self, q: float) -> Optional[float]:
+        """Upper bound (ms) of the bucket holding the q-th quantile; None when empty or in the overflow bucket"""
+        if not self.total:
+            return None
+        rank = math.ceil(q * self.total)
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return self.buckets_ms[index] if index < len(self.buckets_ms) else None
+        return None
+
+    def snapshot(self) -> dict:
+        labels = [f"le_{bound}" for bound in self.buckets_ms] + ["le_inf"]
+        return {
+            "count": self.total,
+            "avg_ms": round(self.sum_ms / self.total, 2) if self.total else 0.0,
+            "p50_ms": self.percentile(0.50),
+            "p95_ms": self.percentile(0.95),
+            "p99_ms": self.percentile(0.99),
+            "buckets": dict(zip(labels, self.counts)),
+        }
+
+class CircuitBreaker:
+    """closed -> open after consecutive failures -> half_open probe after recovery_timeout"""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int = 5, recovery_timeout: float = 30.0, half_open_max_calls: int = 1):
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.half_open_max_calls = half_open_max_calls
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self._probes_in_flight = 0
+
+    def retry_after(self) -> int:
+        remaining = self.opened_at + self.recovery_timeout - time.monotonic()
+        return max(1, math.ceil(remaining))
+
+    def allow(self) -> bool:
+        if self.state == self.OPEN:
+            if time.monotonic() - self.opened_at < self.recovery_timeout:
+                return False
+            self.state = self.HALF_OPEN
+            self._probes_in_flight = 0
+        if self.state == self.HALF_OPEN:
+            # Chỉ cho vài request thăm dò; phần còn lại vẫn bị chặn
+            if self._probes_in_flight >= self.half_open_max_calls:
+                return False
+            self._probes_in_flight += 1
+        return True
+
+    def release_probe(self):
+        """Trả lại lượt thăm dò khi lời gọi kết thúc mà không có kết quả (ví dụ bị hủy)."""
+        if self.state == self.HALF_OPEN and self._probes_in_flight > 0:
+            self._probes_in_flight -= 1
+
+    def record_success(self):
+        if self.state == self.HALF_OPEN:
+            logger.info("Circuit breaker: thăm dò thành công, đóng mạch.")
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self._probes_in_flight = 0
+
+    def record_failure(self):
+        self.consecutive_failures += 1
+        if self.state == self.HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+            self._probes_in_flight = 0
+
+class Upstream:
+    """Timeout, circuit breaker, optional hedging and latency histogram for one dependency"""
+
+    def __init__(
+        self,
+        name: str,
+        timeout: float,
+        hedge_after: Optional[float] = None,
+        failure_threshold: int = 5,
+        recovery_timeout: float = 30.0
+    ):
+        self.name = name
+        self.timeout = timeout
+        self.hedge_after = hedge_after
+        self.breaker = CircuitBreaker(failure_threshold, recovery_timeout)
+        self.latency = LatencyHistogram()
+        self.calls = 0
+        self.failures = 0
+        self.rejected = 0
+        self.hedged = 0
+
+    def _hedge_delay(self) -> Optional[float]:
+        if self.hedge_after is None:
+            return None
+        p95 = self.latency.percentile(0.95) if self.latency.total >= HEDGE_MIN_SAMPLES else None
+        return max(self.hedge_after, p95 / 1000) if p95 else self.hedge_after
+
+    async def _attempt(self, fn: Callable[[], Awaitable[Any]]) -> Any:
+        started = time.monotonic()
+        try:
+            return await fn()
+        finally:
+            self.latency.record(time.monotonic() - started)
+
+    async def _hedged(self, fn: Callable[[], Awaitable[Any]], delay: float) -> Any:
+        primary = asyncio.ensure_future(self._attempt(fn))
+        done, _ = await asyncio.wait({primary}, timeout=delay)
+        if done:
+            return primary.result()
+        # Request đầu chậm hơn ngưỡng: bắn thêm một bản sao, lấy kết quả thành công đầu tiên
+        self.hedged += 1
+        pending = {primary, asyncio.ensure_future(self._attempt(fn))}
+        error: Optional[BaseException] = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def call(self, fn: Callable[[], Awaitable[Any]], hedge: bool = True) -> Any:
+        """Run fn (a zero-arg coroutine factory; must be idempotent when hedged) through the breaker"""
+        if not self.breaker.allow():
+            self.rejected += 1
+            raise UpstreamUnavailable(self.name, "circuit open", self.breaker.retry_after())
+        self.calls += 1
+        delay = self._hedge_delay() if hedge else None
+        try:
+            if delay is not None and delay < self.timeout:
+                result = await asyncio.wait_for(self._hedged(fn, delay), self.timeout)
+            else:
+                result = await asyncio.wait_for(self._attempt(fn), self.timeout)
+        except asyncio.TimeoutError:
+            self.failures += 1
+            self.breaker.record_failure()
+            raise UpstreamUnavailable(self.name, f"timeout after {self.timeout}s")
+        except Exception:
+            self.failures += 1
+            self.breaker.record_failure()
+            raise
+        except BaseException:
+            # CancelledError (client ngắt kết nối...): không tính là lỗi upstream nhưng phải nhả lượt thăm dò
+            self.breaker.release_probe()
+            raise
+        self.breaker.record_success()
+        return result
+
+    def snapshot(self) -> dict:
+        return {
+            "state": self.breaker.state,
+            "consecutive_failures": self.breaker.consecutive_failures,
+            "calls": self.calls,
+            "failures": self.failures,
+            "rejected": self.rejected,
+            "hedged": self.hedged,
+            "latency": self.latency.snapshot(),
+        }
+
+_upstreams: Dict[str, Upstream] = {}
+
+def register_upstream(name: str, **kwargs) -> Upstream:
+    upstream = Upstream(name, **kwargs)
+    _upstreams[name] = upstream
+    return upstream
+
+def upstreams_snapshot() -> dict:
+    return {name: upstream.snapshot() for name, upstream in _upstreams.items()}
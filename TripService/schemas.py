@@ -5,7 +5,7 @@ from models import (
     TripStatusEnum, LocationInfo, FareInfo, PaymentInfo, 
     RatingInfo, CancellationInfo, StatusHistory, PaymentMethodEnum,
     PaymentStatusEnum, CancelledByEnum, GeoLocation, VehicleTypeEnum,
-    RouteInfo
+    RouteInfo, AnalyticsGranularityEnum
 )
 
 # Input schemas for creating/updating
@@ -113,6 +113,12 @@ class TripResponse(BaseModel):
 
     model_config = ConfigDict(populate_by_name=True)
 
+class TripRouteResponse(BaseModel):
+    trip_id: str
+    distance: Optional[float] = None
+    duration: Optional[float] = None
+    geometry: Optional[str] = None  # Encoded polyline for FE to decode
+
 class TripSummaryResponse(BaseModel):
     """Simplified trip response for list views"""
     id: str = Field(alias="_id")
@@ -148,6 +154,21 @@ class TripStatistics(BaseModel):
     total_revenue: float
     average_rating: Optional[float]
     
+# Analytics (rollup theo giờ/ngày)
+class AnalyticsBucket(BaseModel):
+    bucket_start: datetime
+    trips_completed: int
+    trips_cancelled: int
+    revenue: float
+    distance_meters: float
+    completion_rate: Optional[float]
+
+class AnalyticsSeriesResponse(BaseModel):
+    dimension: str  # "driver" | "region"
+    key: str        # driver_id hoặc mã ô lưới khu vực
+    granularity: AnalyticsGranularityEnum
+    buckets: List[AnalyticsBucket]
+    
 class NearbyDriverInfo(BaseModel):
     
     driver_id: str
@@ -157,4 +178,9 @@ class NearbyDriverInfo(BaseModel):
     # Add any other fields LocationService might return (optional)
 
 class TripCreationResponse(BaseModel):
-    trip: TripResponse # Use your existing TripResponse schema here
\ No newline at end of file
+    trip: TripResponse # Use your existing TripResponse schema here
+
+class DriverChangeEvent(BaseModel):
+    """Sự kiện thay đổi hồ sơ do DriverService gửi sang"""
+    driver_id: str
+    event: str = "DRIVER_UPDATED"
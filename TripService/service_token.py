@@ -0,0 +1,128 @@
+"""Quản lý Service Token (client credentials): làm mới trước khi hết hạn và gộp các lần làm mới đồng thời.
+
+Dành cho service phải xin token qua HTTP từ UserService (/auth/token). UserService tự ký token của mình
+(auth.create_service_access_token) nên không dùng lớp này.
+"""
+import asyncio
+import base64
+import json
+import logging
+import time
+from typing import Awaitable, Callable, Optional
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+class ServiceTokenManager:
+    """Caches one service token, refreshes it ahead of expiry and single-flights concurrent refreshes"""
+
+    def __init__(
+        self,
+        token_url: Optional[str],
+        client_id: Optional[str],
+        client_secret: Optional[str],
+        refresh_margin_seconds: float = 120,
+        default_ttl_seconds: float = 14 * 60,
+        fetch: Optional[Callable[[], Awaitable[dict]]] = None
+    ):
+        self.token_url = token_url
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.refresh_margin_seconds = refresh_margin_seconds
+        self.default_ttl_seconds = default_ttl_seconds
+        self._fetch = fetch or self._fetch_from_user_service
+        # Ghi nhớ lúc khởi tạo: mỗi lần truy cập self._fetch_from_user_service tạo một bound method mới
+        self._custom_fetch = fetch is not None
+        self._token: Optional[str] = None
+        self._expires_at = 0.0
+        self._refresh_task: Optional[asyncio.Task] = None
+        self.refresh_count = 0
+
+    @property
+    def configured(self) -> bool:
+        return self._custom_fetch or bool(self.token_url and self.client_id and self.client_secret)
+
+    def _expires_in(self) -> float:
+        return self._expires_at - time.time()
+
+    async def _fetch_from_user_service(self) -> dict:
+        async with httpx.AsyncClient() as client:
+            response = await client.post(
+                self.token_url, data={"username": self.client_id, "password": self.client_secret}, timeout=10.0
+            )
+            response.raise_for_status()
+            return response.json()
+
+    @staticmethod
+    def _token_expiry(token: str) -> Optional[float]:
+        """Đọc claim exp (không xác minh chữ ký, chỉ để biết lúc cần làm mới)."""
+        try:
+            payload_segment = token.split(".")[1]
+            payload_segment += "=" * (-len(payload_segment) % 4)
+            return float(json.loads(base64.urlsafe_b64decode(payload_segment))["exp"])
+        except (IndexError, KeyError, ValueError, TypeError):
+            return None
+
+    async def _refresh(self) -> Optional[str]:
+        try:
+            token_data = await self._fetch()
+        except httpx.HTTPStatusError as e:
+            logger.error(f"UserService trả lỗi khi cấp token: {e.response.status_code} - {e.response.text}")
+            return None
+        except Exception as e:
+            logger.error(f"Lỗi khi lấy Service Token: {e}")
+            return None
+        new_token = token_data.get("access_token")
+        if not new_token:
+            logger.error("Phản hồi từ UserService không chứa access_token.")
+            return None
+        self._token = new_token
+        self._expires_at = self._token_expiry(new_token) or time.time() + self.default_ttl_seconds
+        self.refresh_count += 1
+        logger.info(f"Lấy Service Token mới thành công (còn hạn {self._expires_in():.0f}s).")
+        return new_token
+
+    def _start_refresh(self) -> asyncio.Task:
+        # Single-flight: mọi caller cùng chờ một request làm mới duy nhất
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.create_task(self._refresh())
+        return self._refresh_task
+
+    async def get_token(self) -> Optional[str]:
+        if not self.configured:
+            logger.error("Client ID/Secret hoặc UserService URL chưa được cấu hình!")
+            return None
+        expires_in = self._expires_in()
+        if self._token and expires_in > self.refresh_margin_seconds:
+            return self._token
+        if self._token and expires_in > 0:
+            # Sắp hết hạn: vẫn trả token hiện tại, làm mới ở nền
+            self._start_refresh()
+            return self._token
+        return await asyncio.shield(self._start_refresh())
+
+    def invalidate(self, token: Optional[str] = None):
+        """Bỏ token hiện tại (ví dụ sau khi bị 401); bỏ qua nếu token đã được thay bằng token mới."""
+        if token is None or token == self._token:
+            self._token = None
+            self._expires_at = 0.0
+
+    async def run_refresher(self, idle_seconds: float = 30):
+        """Vòng lặp nền: làm mới token trước khi vào vùng refresh_margin để request không phải chờ."""
+        while True:
+            try:
+                if self.configured and self._expires_in() <= self.refresh_margin_seconds:
+                    await self._start_refresh()
+            except Exception as e:
+                logger.error(f"Lỗi trong vòng làm mới Service Token: {e}")
+            wait = self._expires_in() - self.refresh_margin_seconds if self._token else idle_seconds
+            await asyncio.sleep(min(max(wait, 1), idle_seconds * 10))
+
+    def snapshot(self) -> dict:
+        return {
+            "has_token": self._token is not None,
+            "expires_in_seconds": round(self._expires_in(), 1) if self._token else None,
+            "refresh_count": self.refresh_count,
+            "refresh_in_flight": self._refresh_task is not None and not self._refresh_task.done(),
+        }
@@ -1,9 +1,12 @@
 # UserService/auth.py
 from datetime import datetime, timedelta, timezone
-from typing import Union, Optional 
+from typing import Union, Optional, Callable, Any, Tuple
+from concurrent.futures import ThreadPoolExecutor
 from jose import JWTError, jwt
 from passlib.context import CryptContext
+import asyncio
 import os
+import time
 from fastapi import HTTPException, status 
 
 SECRET_KEY = os.getenv("SECRET_KEY", "default-secret-key-change-in-production-min-32-chars")
@@ -11,16 +14,85 @@ ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", 30))
 
 # --- Mã hóa mật khẩu ---
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Đổi BCRYPT_ROUNDS thì hash cũ được băm lại khi user đăng nhập (xem verify_and_update_password)
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", 12))
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS)
+
+def _truncate_password(password: str) -> str:
+    # Bcrypt chỉ hỗ trợ tối đa 72 bytes, truncate nếu cần
+    if len(password.encode('utf-8')) > 72:
+        password = password.encode('utf-8')[:72].decode('utf-8', errors='ignore')
+    return password
 
 def verify_password(plain_password, hashed_password):
     return pwd_context.verify(plain_password, hashed_password)
 
 def get_password_hash(password):
-    # Bcrypt chỉ hỗ trợ tối đa 72 bytes, truncate nếu cần
-    if len(password.encode('utf-8')) > 72:
-        password = password.encode('utf-8')[:72].decode('utf-8', errors='ignore')
-    return pwd_context.hash(password)
+    return pwd_context.hash(_truncate_password(password))
+
+class PasswordHashPool:
+    """Bounded thread pool for bcrypt so hashing never blocks the event loop"""
+
+    def __init__(self, workers: int, max_pending: int):
+        self.workers = workers
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bcrypt")
+        self.pending = 0  # đang chờ + đang chạy
+        self.completed = 0
+        self.rejected = 0
+        self.total_wait_seconds = 0.0
+        self.total_run_seconds = 0.0
+
+    async def run(self, fn: Callable[..., Any], *args) -> Any:
+        if self.pending >= self.max_pending:
+            # Hàng đợi đầy: từ chối nhanh thay vì để request chờ vô hạn
+            self.rejected += 1
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Hệ thống xác thực đang quá tải, vui lòng thử lại.",
+                headers={"Retry-After": "1"},
+            )
+
+        def _timed():
+            started = time.monotonic()
+            result = fn(*args)
+            return result, started, time.monotonic()
+
+        self.pending += 1
+        submitted = time.monotonic()
+        try:
+            result, started, finished = await asyncio.get_running_loop().run_in_executor(self._executor, _timed)
+        finally:
+            self.pending -= 1
+        self.completed += 1
+        self.total_wait_seconds += started - submitted
+        self.total_run_seconds += finished - started
+        return result
+
+    def snapshot(self) -> dict:
+        return {
+            "workers": self.workers,
+            "max_pending": self.max_pending,
+            "running": min(self.pending, self.workers),
+            "queued": max(0, self.pending - self.workers),
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "avg_queue_ms": round(1000 * self.total_wait_seconds / self.completed, 2) if self.completed else 0.0,
+            "avg_hash_ms": round(1000 * self.total_run_seconds / self.completed, 2) if self.completed else 0.0,
+            "bcrypt_rounds": BCRYPT_ROUNDS,
+        }
+
+password_hash_pool = PasswordHashPool(
+    workers=int(os.getenv("PASSWORD_HASH_WORKERS", os.cpu_count() or 2)),
+    max_pending=int(os.getenv("PASSWORD_HASH_MAX_PENDING", 64)),
+)
+
+async def get_password_hash_async(password: str) -> str:
+    return await password_hash_pool.run(get_password_hash, password)
+
+async def verify_and_update_password(plain_password: str, hashed_password: str) -> Tuple[bool, Optional[str]]:
+    """Kiểm tra mật khẩu trên pool; trả về hash mới nếu hash cũ dùng tham số (rounds) đã lỗi thời."""
+    return await password_hash_pool.run(pwd_context.verify_and_update, _truncate_password(plain_password), hashed_password)
 
 # --- Tạo JWT ---
 def create_access_token(data: dict, expires_delta: Union[timedelta, None] = None):
@@ -33,6 +105,13 @@ def create_access_token(data: dict, expires_delta: Union[timedelta, None] = None
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
+def create_user_access_token(email: str, user_id: str, user_type: str, expires_delta: Union[timedelta, None] = None):
+    """Token người dùng mang sẵn id và loại user để service khác xác thực cục bộ, không phải gọi lại UserService."""
+    return create_access_token(
+        data={"sub": email, "uid": user_id, "user_type": user_type, "type": "user"},
+        expires_delta=expires_delta
+    )
+
 # --- Xác thực JWT ---
 async def verify_token(token: str) -> Optional[str]:
     credentials_exception = HTTPException(
@@ -1,22 +1,32 @@
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, update, delete
-from sqlalchemy.dialects.postgresql import JSONB, insert
-from typing import Optional, List, Dict, Any
-from datetime import datetime, timezone
+from sqlalchemy import select, update, delete, or_, and_, any_, bindparam, String
+from sqlalchemy.dialects.postgresql import JSONB, ARRAY, insert
+from typing import Optional, List, Dict, Any, Tuple
+from datetime import datetime, timezone, timedelta
 from pydantic import ValidationError
+from sqlalchemy.exc import IntegrityError
 import httpx 
 import os 
 import logging
 import json 
+import asyncio
 
-from models import User, UserTable, UserTypeEnum 
-from schemas import UserCreate, UserUpdate
-from auth import get_password_hash
+from models import User, UserTable, UserTypeEnum, DriverProfileOutboxTable
+from schemas import UserCreate, UserUpdate, UserImportError, UserSummary
+from auth import get_password_hash_async, password_hash_pool, create_service_access_token
+from user_cache import UserCache
 
 logger = logging.getLogger(__name__)
 DRIVER_SERVICE_URL = os.getenv("DRIVER_SERVICE_URL", "http://driverservice:8000")
 USER_SERVICE_URL = os.getenv("USER_SERVICE_URL", "http://userservice:8000") #
 
+DRIVER_PROVISION_MAX_ATTEMPTS = int(os.getenv("DRIVER_PROVISION_MAX_ATTEMPTS", 8))
+DRIVER_PROVISION_LEASE_SECONDS = int(os.getenv("DRIVER_PROVISION_LEASE_SECONDS", 60))
+DRIVER_PROVISION_BATCH_SIZE = int(os.getenv("DRIVER_PROVISION_BATCH_SIZE", 200))
+
+# Cache user cho get_current_user và endpoint nội bộ /users/email/{email}
+user_cache = UserCache()
+
 # === HÀM HELPER: CHUYỂN ĐỔI JSONB ===
 
 def _prepare_user_data(user_data: UserCreate | UserUpdate) -> Dict[str, Any]:
@@ -61,71 +71,158 @@ async def get_user_by_id(db: AsyncSession, user_id: str) -> Optional[User]:
         return User.model_validate(user_row)
     return None
 
+async def get_user_by_email_cached(db: AsyncSession, email: str) -> Optional[User]:
+    """Như get_user_by_email nhưng đọc qua user_cache; chỉ cache khi tìm thấy."""
+    user = user_cache.get_by_email(email)
+    if user is None:
+        user = await get_user_by_email(db, email)
+        if user:
+            user_cache.put(user)
+    return user
+
+async def get_user_by_id_cached(db: AsyncSession, user_id: str) -> Optional[User]:
+    user = user_cache.get_by_id(user_id)
+    if user is None:
+        user = await get_user_by_id(db, user_id)
+        if user:
+            user_cache.put(user)
+    return user
+
+# Cột trả về cho tra cứu hàng loạt: không đọc password/JSONB
+_USER_SUMMARY_COLUMNS = (
+    UserTable.id, UserTable.username, UserTable.email, UserTable.full_name,
+    UserTable.phone, UserTable.user_type, UserTable.is_active
+)
+
+async def get_users_by_ids_or_emails(db: AsyncSession, ids: List[str], emails: List[str]) -> List[UserSummary]:
+    """Một truy vấn cho cả lô: WHERE id = ANY(:ids) OR email = ANY(:emails)."""
+    if not ids and not emails:
+        return []
+    # Bind cả mảng làm một tham số: câu SQL giống nhau với mọi kích thước lô nên dùng lại được prepared statement
+    query = select(*_USER_SUMMARY_COLUMNS).where(or_(
+        UserTable.id == any_(bindparam("ids", list(ids), type_=ARRAY(String))),
+        UserTable.email == any_(bindparam("emails", list(emails), type_=ARRAY(String)))
+    ))
+    result = await db.execute(query)
+    return [UserSummary.model_validate(row) for row in result.all()]
+
 # === HÀM CREATE (TẠO) ===
 
 async def create_user(db: AsyncSession, user_data: UserCreate) -> User:
-    existing_user = await get_user_by_email(db, email=user_data.email)
-    if existing_user:
-        raise ValueError("Email đã được đăng ký")
-
     # Hash password trước khi tạo dict
-    hashed_password = get_password_hash(user_data.password)
+    hashed_password = await get_password_hash_async(user_data.password)
 
     # Tạo dict từ user_data, loại bỏ password gốc
     user_data_dict = user_data.model_dump(exclude={"password"}, exclude_none=True)
     # Thêm hashed password vào dict
     user_data_dict["password"] = hashed_password
 
-    db_user = UserTable(**user_data_dict) 
-    
-    
+    # Một round trip: INSERT ... ON CONFLICT (email) DO NOTHING RETURNING *
+    # Không có dòng trả về nghĩa là email đã tồn tại; trùng phone do unique constraint báo lỗi
+    stmt = (
+        insert(UserTable)
+        .values(**user_data_dict)
+        .on_conflict_do_nothing(index_elements=[UserTable.email])
+        .returning(UserTable)
+    )
     try:
-        db.add(db_user)
+        result = await db.execute(stmt)
+        db_user = result.scalar_one_or_none()
+        if db_user is not None and db_user.user_type == UserTypeEnum.DRIVER:
+            # Hồ sơ tài xế được tạo bởi worker (outbox) để đăng ký không phải chờ DriverService
+            await db.execute(insert(DriverProfileOutboxTable).values(
+                user_id=db_user.id,
+                payload=_driver_profile_payload(db_user.full_name, db_user.phone, db_user.email)
+            ))
         await db.commit()
-        await db.refresh(db_user) 
-        
-    except Exception as e:
+    except IntegrityError as e:
         await db.rollback()
         if 'duplicate key value violates unique constraint' in str(e):
              raise ValueError("Số điện thoại này đã được đăng ký.")
         logger.error(f"PostgreSQL: Lỗi khi tạo user: {e}", exc_info=True)
         raise Exception("Không thể tạo user do lỗi database.")
+    except Exception as e:
+        await db.rollback()
+        logger.error(f"PostgreSQL: Lỗi khi tạo user: {e}", exc_info=True)
+        raise Exception("Không thể tạo user do lỗi database.")
 
-    created_user = User.model_validate(db_user)
-    
-    if created_user.user_type == UserTypeEnum.DRIVER:
+    if db_user is None:
+        raise ValueError("Email đã được đăng ký")
 
-        await call_create_driver_profile(
-            user_id=created_user.id,
-            full_name=created_user.full_name,
-            phone=created_user.phone, 
-            email=created_user.email
-        )
-        
-    return created_user
+    return User.model_validate(db_user)
+
+
+async def bulk_create_users(db: AsyncSession, rows: List[Tuple[int, UserCreate]]) -> Tuple[int, List[UserImportError]]:
+    """Tạo một lô user (line, UserCreate) bằng một INSERT nhiều dòng; trả về (số user tạo được, lỗi từng dòng)."""
+    # Chỉ dùng một nửa pool bcrypt để import không làm nghẽn đăng nhập
+    hash_slots = asyncio.Semaphore(max(1, password_hash_pool.workers // 2))
+
+    async def _hash(password: str) -> str:
+        async with hash_slots:
+            return await get_password_hash_async(password)
+
+    hashed_passwords = await asyncio.gather(*[_hash(user.password) for _, user in rows])
+    values = []
+    for (_, user), hashed_password in zip(rows, hashed_passwords):
+        # Giữ cả trường None: INSERT nhiều dòng lấy danh sách cột theo dòng đầu, mọi dòng phải cùng bộ cột
+        user_data_dict = user.model_dump(exclude={"password"})
+        user_data_dict["password"] = hashed_password
+        values.append(user_data_dict)
+
+    # ON CONFLICT DO NOTHING (mọi unique constraint): dòng trùng email/phone không làm hỏng cả lô
+    stmt = (
+        insert(UserTable)
+        .values(values)
+        .on_conflict_do_nothing()
+        .returning(UserTable.id, UserTable.email, UserTable.full_name, UserTable.phone, UserTable.user_type)
+    )
+    try:
+        result = await db.execute(stmt)
+        inserted = result.all()
+        drivers = [row for row in inserted if row.user_type == UserTypeEnum.DRIVER]
+        if drivers:
+            await db.execute(insert(DriverProfileOutboxTable).values([
+                {"user_id": row.id, "payload": _driver_profile_payload(row.full_name, row.phone, row.email)}
+                for row in drivers
+            ]))
+        await db.commit()
+    except Exception as e:
+        await db.rollback()
+        logger.error(f"PostgreSQL: Lỗi khi import lô {len(rows)} user: {e}", exc_info=True)
+        return 0, [UserImportError(line=line, email=user.email, error="Lỗi database khi import lô này.") for line, user in rows]
+
+    inserted_emails = {row.email for row in inserted}
+    errors = [
+        UserImportError(line=line, email=user.email, error="Email hoặc số điện thoại đã được đăng ký.")
+        for line, user in rows if user.email not in inserted_emails
+    ]
+    # Trùng email ngay trong lô: chỉ dòng đầu tiên được tạo
+    seen = set()
+    for line, user in rows:
+        if user.email in inserted_emails and user.email in seen:
+            errors.append(UserImportError(line=line, email=user.email, error="Email bị lặp trong file import."))
+        seen.add(user.email)
+    return len(inserted), sorted(errors, key=lambda error: error.line)
 
 
 async def update_user(db: AsyncSession, user_id: str, user_update_data: UserUpdate) -> Optional[User]:
-    """Cập nhật thông tin người dùng."""
-    user_query = select(UserTable).where(UserTable.id == user_id)
-    result = await db.execute(user_query)
-    db_user = result.scalar_one_or_none()
-    
-    if not db_user:
-        return None
-    
+    """Cập nhật thông tin người dùng (một câu UPDATE ... RETURNING)."""
     update_data = user_update_data.model_dump(exclude_unset=True, exclude_none=True)
     
     update_data['updated_at'] = datetime.now(timezone.utc)
     
-    stmt = update(UserTable).where(UserTable.id == user_id).values(**update_data)
+    stmt = (
+        update(UserTable)
+        .where(UserTable.id == user_id)
+        .values(**update_data)
+        .returning(UserTable)
+        .execution_options(synchronize_session=False)
+    )
     
     try:
-        await db.execute(stmt)
+        result = await db.execute(stmt)
+        db_user = result.scalar_one_or_none()
         await db.commit()
-        await db.refresh(db_user)
-        return User.model_validate(db_user)
-        
     except Exception as e:
         await db.rollback()
         if 'duplicate key value violates unique constraint' in str(e):
@@ -133,13 +230,27 @@ async def update_user(db: AsyncSession, user_id: str, user_update_data: UserUpda
         logger.error(f"PostgreSQL: Lỗi khi cập nhật user {user_id}: {e}", exc_info=True)
         return None 
 
+    if not db_user:
+        return None
+    updated_user = User.model_validate(db_user)
+    user_cache.invalidate(user_id=user_id)
+    user_cache.put(updated_user)
+    return updated_user
 
-async def call_create_driver_profile(user_id: str, full_name: Optional[str], phone: Optional[str], email: str):
-    if not DRIVER_SERVICE_URL:
-        logger.error("DRIVER_SERVICE_URL chưa được cấu hình. Bỏ qua việc tạo hồ sơ tài xế.")
-        return
-    url = f"{DRIVER_SERVICE_URL}/drivers/?user_id={user_id}"
-    driver_payload = {
+
+async def update_password_hash(db: AsyncSession, user_id: str, hashed_password: str) -> None:
+    """Ghi hash mới (rehash khi đăng nhập); lỗi chỉ ghi log vì hash cũ vẫn dùng được."""
+    try:
+        await db.execute(update(UserTable).where(UserTable.id == user_id).values(password=hashed_password))
+        await db.commit()
+        user_cache.invalidate(user_id=user_id)
+    except Exception as e:
+        await db.rollback()
+        logger.error(f"PostgreSQL: Lỗi khi cập nhật hash mật khẩu cho user {user_id}: {e}")
+
+
+def _driver_profile_payload(full_name: Optional[str], phone: Optional[str], email: str) -> Dict[str, Any]:
+    return {
         "name": full_name or "Tài xế mới",
         "phone": phone or "Chưa cập nhật",
         "email": email,
@@ -148,22 +259,110 @@ async def call_create_driver_profile(user_id: str, full_name: Optional[str], pho
             "seat_type": 4
         }
     }
-    logger.info(f"Đang gọi DriverService để tạo hồ sơ cho user {user_id} tại {url}...")
+
+async def call_create_driver_profiles_bulk(jobs: List[DriverProfileOutboxTable]) -> Dict[str, Optional[str]]:
+    """Gửi một lô hồ sơ tài xế (NDJSON) tới DriverService; trả về user_id -> None nếu thành công, ngược lại là lỗi."""
+    if not DRIVER_SERVICE_URL:
+        logger.error("DRIVER_SERVICE_URL chưa được cấu hình. Bỏ qua việc tạo hồ sơ tài xế.")
+        return {job.user_id: "DRIVER_SERVICE_URL chưa được cấu hình" for job in jobs}
+    url = f"{DRIVER_SERVICE_URL}/drivers/internal/bulk"
+    body = "\n".join(json.dumps({**job.payload, "user_id": job.user_id}) for job in jobs)
+    # UserService là nơi cấp Service Token: tự ký tại chỗ (không gọi /auth/token qua mạng) nên không cần
+    # ServiceTokenManager như TripService; mỗi lô outbox ký một token mới, chi phí chỉ là một HMAC
+    service_token = create_service_access_token({"sub": "userservice", "aud": "driverservice"})
+    logger.info(f"Đang gọi DriverService để tạo {len(jobs)} hồ sơ tài xế tại {url}...")
     try:
         async with httpx.AsyncClient() as client:
-            response = await client.post(url, json=driver_payload, timeout=10.0)
-            if response.status_code == 201:
-                logger.info(f"Tạo hồ sơ tài xế thành công cho user {user_id}.")
-            elif response.status_code == 400:
-                logger.warning(f"Hồ sơ tài xế cho user {user_id} có thể đã tồn tại.")
-            else:
-                response.raise_for_status()
+            response = await client.post(
+                url,
+                content=body.encode("utf-8"),
+                headers={"Content-Type": "application/x-ndjson", "Authorization": f"Bearer {service_token}"},
+                timeout=30.0
+            )
+            response.raise_for_status()
+            outcomes = {job.user_id: "Không có kết quả từ DriverService" for job in jobs}
+            for result in response.json().get("results", []):
+                if result.get("user_id") in outcomes:
+                    outcomes[result["user_id"]] = result.get("error") if result.get("status") == "ERROR" else None
+            return outcomes
     except httpx.RequestError as e:
         logger.error(f"Lỗi khi gọi DriverService (tại {e.request.url!r}): {e}")
+        error_message = f"RequestError: {e}"
     except httpx.HTTPStatusError as e:
         logger.error(f"DriverService trả lỗi: {e.response.status_code} - {e.response.text}")
+        error_message = f"HTTP {e.response.status_code}"
     except Exception as e:
         logger.error(f"Lỗi không xác định khi gọi DriverService: {e}")
+        error_message = str(e)
+    return {job.user_id: error_message for job in jobs}
+
+# === OUTBOX: TẠO HỒ SƠ TÀI XẾ ===
+
+async def claim_driver_provisioning_jobs(db: AsyncSession, limit: int = DRIVER_PROVISION_BATCH_SIZE) -> List[DriverProfileOutboxTable]:
+    """Lấy tối đa `limit` job đến hạn (hoặc có lease đã hết hạn) và đánh dấu PROCESSING."""
+    now = datetime.now(timezone.utc)
+    # SKIP LOCKED: nhiều replica cùng chạy worker không lấy trùng job
+    due_jobs = (
+        select(DriverProfileOutboxTable.user_id)
+        .where(or_(
+            and_(DriverProfileOutboxTable.status == "QUEUED", DriverProfileOutboxTable.available_at <= now),
+            and_(DriverProfileOutboxTable.status == "PROCESSING", DriverProfileOutboxTable.locked_until <= now)
+        ))
+        .order_by(DriverProfileOutboxTable.available_at)
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+    )
+    stmt = (
+        update(DriverProfileOutboxTable)
+        .where(DriverProfileOutboxTable.user_id.in_(due_jobs.scalar_subquery()))
+        .values(
+            status="PROCESSING",
+            locked_until=now + timedelta(seconds=DRIVER_PROVISION_LEASE_SECONDS),
+            attempts=DriverProfileOutboxTable.attempts + 1
+        )
+        .returning(DriverProfileOutboxTable)
+        .execution_options(synchronize_session=False)
+    )
+    result = await db.execute(stmt)
+    jobs = list(result.scalars().all())
+    await db.commit()
+    return jobs
+
+async def process_driver_provisioning_jobs(db: AsyncSession, jobs: List[DriverProfileOutboxTable]) -> None:
+    """Tạo hồ sơ cho cả lô job; job lỗi được thử lại với backoff, quá số lần thì đánh dấu FAILED."""
+    outcomes = await call_create_driver_profiles_bulk(jobs)
+    now = datetime.now(timezone.utc)
+    done_ids = [job.user_id for job in jobs if outcomes.get(job.user_id) is None]
+    if done_ids:
+        await db.execute(
+            update(DriverProfileOutboxTable)
+            .where(DriverProfileOutboxTable.user_id.in_(done_ids), DriverProfileOutboxTable.status == "PROCESSING")
+            .values(status="DONE", locked_until=None, completed_at=now)
+            .execution_options(synchronize_session=False)
+        )
+    for job in jobs:
+        error_message = outcomes.get(job.user_id)
+        if error_message is None:
+            continue
+        if job.attempts >= DRIVER_PROVISION_MAX_ATTEMPTS:
+            logger.error(f"Tạo hồ sơ tài xế cho user {job.user_id} thất bại sau {job.attempts} lần: {error_message}")
+            values = {"status": "FAILED", "locked_until": None, "last_error": error_message, "completed_at": now}
+        else:
+            retry_in = min(2 ** job.attempts, 300)
+            logger.warning(f"Tạo hồ sơ tài xế cho user {job.user_id} lỗi ({error_message}), thử lại sau {retry_in}s.")
+            values = {
+                "status": "QUEUED",
+                "locked_until": None,
+                "last_error": error_message,
+                "available_at": now + timedelta(seconds=retry_in)
+            }
+        await db.execute(
+            update(DriverProfileOutboxTable)
+            .where(DriverProfileOutboxTable.user_id == job.user_id, DriverProfileOutboxTable.status == "PROCESSING")
+            .values(**values)
+            .execution_options(synchronize_session=False)
+        )
+    await db.commit()
 
 async def get_user_by_email_internal(db: AsyncSession, email: str) -> Optional[User]:
-    return await get_user_by_email(db, email)
+    return await get_user_by_email_cached(db, email)
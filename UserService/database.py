@@ -1,5 +1,9 @@
 import os
+import time
+from sqlalchemy import event
+from sqlalchemy.exc import TimeoutError as SQLAlchemyTimeoutError
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 from sqlalchemy.orm import declarative_base, sessionmaker
 from typing import AsyncGenerator
 import logging
@@ -15,20 +19,92 @@ POSTGRES_PASSWORD = os.getenv("POSTGRES_PASSWORD", "default-password")
 POSTGRES_DB = os.getenv("POSTGRES_DB", "mydb")
 POSTGRES_PORT = os.getenv("POSTGRES_PORT", "5432")
 
+# --- Cấu hình connection pool ---
+# Tổng kết nối tối đa mỗi replica = DB_POOL_SIZE + DB_MAX_OVERFLOW
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 10))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 10))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 5))
+# Đóng kết nối cũ hơn ngưỡng này để không dính kết nối bị firewall/LB cắt ngầm
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", 1800))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() == "true"
+# Số prepared statement asyncpg giữ cho mỗi kết nối (0 = tắt, cần khi đi qua pgbouncer transaction mode)
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", 256))
+
 SQLALCHEMY_DATABASE_URL = (
     f"postgresql+asyncpg://{POSTGRES_USER}:{POSTGRES_PASSWORD}@"
     f"{POSTGRES_HOST}:{POSTGRES_PORT}/{POSTGRES_DB}"
+    f"?prepared_statement_cache_size={DB_STATEMENT_CACHE_SIZE}"
 )
 
 Base = declarative_base()
 
 
+class PoolStats:
+    """Counters for connection checkouts and time spent waiting for a pooled connection"""
+
+    def __init__(self):
+        self.connects = 0
+        self.checkouts = 0
+        self.timeouts = 0
+        self.total_wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    def record_wait(self, seconds: float):
+        self.checkouts += 1
+        self.total_wait_seconds += seconds
+        self.max_wait_seconds = max(self.max_wait_seconds, seconds)
+
+    def snapshot(self) -> dict:
+        pool = engine.sync_engine.pool
+        return {
+            "pool_size": DB_POOL_SIZE,
+            "max_overflow": DB_MAX_OVERFLOW,
+            "checked_out": pool.checkedout(),
+            "idle": pool.checkedin(),
+            "overflow": max(0, pool.overflow()),
+            "connects": self.connects,
+            "checkouts": self.checkouts,
+            "timeouts": self.timeouts,
+            "avg_wait_ms": round(1000 * self.total_wait_seconds / self.checkouts, 2) if self.checkouts else 0.0,
+            "max_wait_ms": round(1000 * self.max_wait_seconds, 2),
+        }
+
+pool_stats = PoolStats()
+
+class TimedQueuePool(AsyncAdaptedQueuePool):
+    """Queue pool that records how long each checkout waited, only when a session actually needs a connection"""
+
+    def _do_get(self):
+        started = time.monotonic()
+        try:
+            connection = super()._do_get()
+        except SQLAlchemyTimeoutError:
+            pool_stats.timeouts += 1
+            raise
+        pool_stats.record_wait(time.monotonic() - started)
+        return connection
+
 engine = create_async_engine(
     SQLALCHEMY_DATABASE_URL,
     echo=False,
-    future=True
+    future=True,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_timeout=DB_POOL_TIMEOUT,
+    pool_recycle=DB_POOL_RECYCLE,
+    pool_pre_ping=DB_POOL_PRE_PING,
+    # Đo thời gian chờ ngay trong pool: session chỉ lấy kết nối khi thật sự truy vấn
+    poolclass=TimedQueuePool,
+    connect_args={
+        "statement_cache_size": DB_STATEMENT_CACHE_SIZE,
+        "server_settings": {"application_name": "userservice"},
+    },
 )
 
+@event.listens_for(engine.sync_engine, "connect")
+def _on_connect(dbapi_connection, connection_record):
+    pool_stats.connects += 1
+
 
 AsyncSessionLocal = sessionmaker(
     autocommit=False,
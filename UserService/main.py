@@ -1,33 +1,57 @@
 # UserService/main.py 
 import os
-from fastapi import FastAPI, Depends, HTTPException, status, APIRouter 
+import asyncio
+from fastapi import FastAPI, Depends, HTTPException, status, APIRouter, Request, Header
 from fastapi.security import OAuth2PasswordRequestForm, OAuth2PasswordBearer
 from datetime import timedelta
-from typing import List, AsyncGenerator
+from typing import List, AsyncGenerator, Optional
 from contextlib import asynccontextmanager
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import text
+from sqlalchemy.exc import TimeoutError as SQLAlchemyTimeoutError
+from fastapi.responses import JSONResponse
+from pydantic import ValidationError
+import hmac
+from jose import JWTError, jwt
 import logging
 import crud
 import models
 import schemas
 import auth
-from database import init_db, get_db, Base 
+from ndjson_stream import iter_ndjson_batches
+from database import init_db, get_db, Base, pool_stats, engine, AsyncSessionLocal
 
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+DRIVER_PROVISION_POLL_SECONDS = float(os.getenv("DRIVER_PROVISION_POLL_SECONDS", 1.0))
+
+async def _run_driver_provisioning_worker():
+    """Tiêu thụ outbox tạo hồ sơ tài xế được ghi khi đăng ký user DRIVER."""
+    while True:
+        try:
+            async with AsyncSessionLocal() as db:
+                jobs = await crud.claim_driver_provisioning_jobs(db)
+                if jobs:
+                    await crud.process_driver_provisioning_jobs(db, jobs)
+                    continue
+        except Exception as e:
+            logger.error(f"UserService: Lỗi trong worker tạo hồ sơ tài xế: {e}", exc_info=True)
+        await asyncio.sleep(DRIVER_PROVISION_POLL_SECONDS)
+
 @asynccontextmanager
 async def lifespan(app: FastAPI) -> AsyncGenerator[None, None]:
     logger.info("UserService: Đang khởi động...")
     try:
         await init_db()
+        worker_task = asyncio.create_task(_run_driver_provisioning_worker())
         logger.info("UserService: Khởi động hoàn tất.")
         yield # Ứng dụng chạy ở đây
+        worker_task.cancel()
     finally:
         logger.info("UserService: Đang tắt...")
-        # (Không cần đóng engine SQLAlchemy rõ ràng ở đây)
+        await engine.dispose()
         logger.info("UserService: Tắt hoàn tất.")
 
 # --- KHỞI TẠO FASTAPI APP VỚI LIFESPAN ---
@@ -39,6 +63,16 @@ app = FastAPI(
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/auth/login")
 
+@app.exception_handler(SQLAlchemyTimeoutError)
+async def db_pool_timeout_handler(request: Request, exc: SQLAlchemyTimeoutError):
+    """Hết pool_timeout khi chờ kết nối PostgreSQL: trả 503 thay vì 500"""
+    logger.warning("UserService: Hết thời gian chờ kết nối PostgreSQL từ pool.")
+    return JSONResponse(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={"detail": "Cơ sở dữ liệu đang bận, vui lòng thử lại."},
+        headers={"Retry-After": "1"},
+    )
+
 # --- DEPENDENCIES ---
 async def get_current_user(
     token: str = Depends(oauth2_scheme),
@@ -47,7 +81,7 @@ async def get_current_user(
 ) -> models.User: # <-- Vẫn trả về Pydantic User model
     email = await auth.verify_token(token)
     # THAY THẾ: Truyền db session vào hàm crud
-    user = await crud.get_user_by_email(db=db, email=email)
+    user = await crud.get_user_by_email_cached(db=db, email=email)
     if user is None:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -56,6 +90,25 @@ async def get_current_user(
         )
     return user
 
+# Service token do /auth/token cấp cho các service nội bộ (aud gồm "userservice")
+SERVICE_AUDIENCE = "userservice"
+
+async def verify_service_jwt(token: str = Depends(oauth2_scheme)) -> None:
+    """Dependency cho API nội bộ: chỉ nhận Service JWT, không nhận token của user."""
+    credentials_exception = HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="Could not validate service credentials (Invalid Service Token)",
+        headers={"WWW-Authenticate": "Bearer"},
+    )
+    try:
+        payload = jwt.decode(token, auth.SECRET_KEY, algorithms=[auth.ALGORITHM], audience=SERVICE_AUDIENCE)
+    except JWTError as e:
+        logger.warning(f"Lỗi xác thực Service JWT: {e}")
+        raise credentials_exception
+    if payload.get("type") != "service":
+        logger.warning(f"Token không hợp lệ, type không phải 'service': {payload.get('type')}")
+        raise credentials_exception
+
 # --- ROUTERS ---
 auth_router = APIRouter(prefix="/auth", tags=["Authentication"])
 users_router = APIRouter(prefix="/users", tags=["Users"])
@@ -63,6 +116,9 @@ users_router = APIRouter(prefix="/users", tags=["Users"])
 # THÊM: Đọc Client Credentials từ biến môi trường
 EXPECTED_TRIPSVC_CLIENT_ID = os.getenv("TRIPSVC_CLIENT_ID")
 EXPECTED_TRIPSVC_CLIENT_SECRET = os.getenv("TRIPSVC_CLIENT_SECRET")
+# Token cho công cụ import hàng loạt; không cấu hình thì endpoint import bị tắt
+BULK_IMPORT_TOKEN = os.getenv("BULK_IMPORT_TOKEN")
+USER_IMPORT_BATCH_SIZE = int(os.getenv("USER_IMPORT_BATCH_SIZE", 500))
 
 # --- ENDPOINTS XÁC THỰC ---
 
@@ -94,15 +150,25 @@ async def login_for_access_token(
     db: AsyncSession = Depends(get_db)
 ):
     user = await crud.get_user_by_email(db=db, email=form_data.username)
-    if not user or not auth.verify_password(form_data.password, user.password):
+    # Trả kết nối về pool trước khi xếp hàng chờ bcrypt
+    await db.rollback()
+    password_ok, new_hash = (
+        await auth.verify_and_update_password(form_data.password, user.password) if user else (False, None)
+    )
+    if not password_ok:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Email hoặc mật khẩu không đúng.",
             headers={"WWW-Authenticate": "Bearer"},
         )
+    if new_hash:
+        # Hash cũ dùng cost đã lỗi thời: băm lại trong suốt khi đăng nhập thành công
+        await crud.update_password_hash(db, user.id, new_hash)
     access_token_expires = timedelta(minutes=auth.ACCESS_TOKEN_EXPIRE_MINUTES)
-    access_token = auth.create_access_token(
-        data={"sub": user.email}, # Dùng email làm subject cho user token
+    access_token = auth.create_user_access_token(
+        email=user.email, # Dùng email làm subject cho user token
+        user_id=str(user.id),
+        user_type=models.UserTypeEnum(user.user_type).value,
         expires_delta=access_token_expires
     )
     return {"access_token": access_token, "token_type": "bearer"}
@@ -119,7 +185,8 @@ async def login_for_service_token(
         # Tạo payload cho service token
         service_token_data = {
             "sub": client_id, 
-            "aud": "driverservice" 
+            # Cùng một token gọi được API nội bộ của DriverService và UserService
+            "aud": ["driverservice", SERVICE_AUDIENCE]
 
         }
         # Gọi hàm tạo service token trong auth.py
@@ -183,6 +250,52 @@ async def get_user_by_email_endpoint(
     return user
 
 
+@users_router.post(
+    "/internal/batch",
+    response_model=List[schemas.UserSummary],
+    dependencies=[Depends(verify_service_jwt)]
+)
+async def get_users_internal_batch(
+    request: schemas.UserBatchRequest,
+    db: AsyncSession = Depends(get_db)
+):
+    """Tra cứu nhiều user theo id và/hoặc email trong một truy vấn; id/email không tồn tại bị bỏ qua."""
+    logger.info(f"Yêu cầu nội bộ: Tra cứu lô {len(request.ids)} id, {len(request.emails)} email")
+    return await crud.get_users_by_ids_or_emails(db, request.ids, request.emails)
+
+@users_router.post("/internal/import", response_model=schemas.UserImportResponse)
+async def import_users_bulk(
+    request: Request,
+    x_import_token: Optional[str] = Header(None),
+    db: AsyncSession = Depends(get_db)
+):
+    """Import user hàng loạt từ body NDJSON (mỗi dòng một UserCreate); tài xế được tạo hồ sơ qua outbox."""
+    if not BULK_IMPORT_TOKEN or not x_import_token or not hmac.compare_digest(x_import_token, BULK_IMPORT_TOKEN):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Không có quyền import người dùng.")
+
+    created = 0
+    errors: List[schemas.UserImportError] = []
+    async for batch in iter_ndjson_batches(request.stream(), USER_IMPORT_BATCH_SIZE):
+        rows = []
+        for row in batch:
+            if row.error:
+                errors.append(schemas.UserImportError(line=row.line, error=row.error))
+                continue
+            try:
+                rows.append((row.line, schemas.UserCreate.model_validate(row.data)))
+            except ValidationError as e:
+                email = row.data.get("email") if isinstance(row.data, dict) else None
+                errors.append(schemas.UserImportError(line=row.line, email=email, error=str(e)))
+        if rows:
+            batch_created, batch_errors = await crud.bulk_create_users(db, rows)
+            created += batch_created
+            errors.extend(batch_errors)
+
+    errors.sort(key=lambda error: error.line)
+    logger.info(f"UserService: Import hàng loạt xong: {created} user được tạo, {len(errors)} dòng lỗi.")
+    return schemas.UserImportResponse(created=created, failed=len(errors), errors=errors)
+
+
 # --- INCLUDE ROUTERS VÀ ROOT ENDPOINT ---
 app.include_router(auth_router)
 app.include_router(users_router)
@@ -204,4 +317,20 @@ async def health_check(db: AsyncSession = Depends(get_db)):
         }
     except Exception as e:
         logger.error(f"Health check failed: {e}")
-        raise HTTPException(status_code=503, detail="Service unhealthy")
\ No newline at end of file
+        raise HTTPException(status_code=503, detail="Service unhealthy")
+
+
+@app.get("/metrics/password-hashing")
+async def password_hashing_metrics():
+    """Độ sâu hàng đợi và thời gian băm của pool bcrypt"""
+    return auth.password_hash_pool.snapshot()
+
+@app.get("/metrics/user-cache")
+async def user_cache_metrics():
+    """Tỉ lệ hit và kích thước cache user"""
+    return crud.user_cache.snapshot()
+
+@app.get("/metrics/db-pool")
+async def db_pool_metrics():
+    """Số kết nối đang dùng/rảnh và thời gian chờ lấy kết nối PostgreSQL"""
+    return pool_stats.snapshot()
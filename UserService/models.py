@@ -1,4 +1,4 @@
-from sqlalchemy import Column, String, Boolean, DateTime, Float, Enum as SQLEnum
+from sqlalchemy import Column, String, Boolean, DateTime, Float, Integer, Enum as SQLEnum
 from sqlalchemy.dialects.postgresql import JSONB # Dùng JSONB để lưu cấu trúc lồng
 from pydantic import BaseModel, EmailStr, Field as PydanticField
 from typing import Optional, List
@@ -41,6 +41,20 @@ class UserTable(Base):
     updated_at = Column(DateTime(timezone=True), default=lambda: datetime.now(timezone.utc), onupdate=lambda: datetime.now(timezone.utc))
     driver_profile_json = Column(JSONB, nullable=True) 
     vehicles_json = Column(JSONB, default=lambda: [], nullable=False) 
+
+class DriverProfileOutboxTable(Base):
+    """Outbox: job tạo hồ sơ tài xế bên DriverService, ghi cùng transaction với user."""
+    __tablename__ = "driver_profile_outbox"
+    user_id = Column(String, primary_key=True)
+    payload = Column(JSONB, nullable=False)
+    status = Column(String, default="QUEUED", nullable=False, index=True)  # QUEUED | PROCESSING | DONE | FAILED
+    attempts = Column(Integer, default=0, nullable=False)
+    available_at = Column(DateTime(timezone=True), default=lambda: datetime.now(timezone.utc), nullable=False, index=True)
+    locked_until = Column(DateTime(timezone=True), nullable=True)
+    last_error = Column(String, nullable=True)
+    created_at = Column(DateTime(timezone=True), default=lambda: datetime.now(timezone.utc))
+    completed_at = Column(DateTime(timezone=True), nullable=True)
+
 class User(BaseModel):
     id: Optional[str] = PydanticField(None) 
     username: str
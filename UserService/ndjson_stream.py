@@ -0,0 +1,52 @@
+"""Đọc body NDJSON dạng stream và gom thành lô, không nạp cả file vào bộ nhớ."""
+import json
+from typing import Any, AsyncIterator, List, NamedTuple, Optional
+
+NDJSON_MAX_LINE_BYTES = 64 * 1024
+
+class NdjsonRow(NamedTuple):
+    line: int
+    data: Optional[Any]
+    error: Optional[str]
+
+def _parse_line(line_no: int, raw: bytes) -> Optional[NdjsonRow]:
+    raw = raw.strip()
+    if not raw:
+        return None
+    if len(raw) > NDJSON_MAX_LINE_BYTES:
+        return NdjsonRow(line_no, None, f"Dòng vượt quá {NDJSON_MAX_LINE_BYTES} bytes")
+    try:
+        return NdjsonRow(line_no, json.loads(raw), None)
+    except ValueError as e:
+        return NdjsonRow(line_no, None, f"JSON không hợp lệ: {e}")
+
+async def iter_ndjson_batches(chunks: AsyncIterator[bytes], batch_size: int) -> AsyncIterator[List[NdjsonRow]]:
+    """Yield batches of parsed rows (1-based line numbers); bad lines carry an error instead of data"""
+    buffer = b""
+    line_no = 0
+    overflow = False  # dòng hiện tại đã vượt NDJSON_MAX_LINE_BYTES, bỏ phần còn lại tới khi xuống dòng
+    batch: List[NdjsonRow] = []
+    async for chunk in chunks:
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for raw in lines:
+            line_no += 1
+            if overflow:
+                overflow = False
+                row = NdjsonRow(line_no, None, f"Dòng vượt quá {NDJSON_MAX_LINE_BYTES} bytes")
+            else:
+                row = _parse_line(line_no, raw)
+            if row is not None:
+                batch.append(row)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if len(buffer) > NDJSON_MAX_LINE_BYTES:
+            overflow = True
+            buffer = b""
+    if overflow:
+        batch.append(NdjsonRow(line_no + 1, None, f"Dòng vượt quá {NDJSON_MAX_LINE_BYTES} bytes"))
+    elif buffer.strip():
+        batch.append(_parse_line(line_no + 1, buffer))
+    if batch:
+        yield batch
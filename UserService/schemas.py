@@ -56,4 +56,31 @@ class VehicleCreate(BaseModel):
 
 class VehicleUpdate(BaseModel):
     license_plate: Optional[str] = None
-    seat_type: Optional[int] = None
\ No newline at end of file
+    seat_type: Optional[int] = None
+
+
+class UserBatchRequest(BaseModel):
+    ids: List[str] = Field(default_factory=list, max_length=500)
+    emails: List[str] = Field(default_factory=list, max_length=500)
+
+class UserSummary(BaseModel):
+    """Projection gọn (không có password) cho tra cứu nội bộ hàng loạt"""
+    id: str
+    username: str
+    email: EmailStr
+    full_name: Optional[str] = None
+    phone: Optional[str] = None
+    user_type: UserTypeEnum
+    is_active: bool
+
+    model_config = ConfigDict(from_attributes=True)
+
+class UserImportError(BaseModel):
+    line: int
+    email: Optional[str] = None
+    error: str
+
+class UserImportResponse(BaseModel):
+    created: int
+    failed: int
+    errors: List[UserImportError]
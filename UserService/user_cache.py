@@ -0,0 +1,81 @@
+"""Cache đọc-xuyên (read-through) cho bản ghi user, tra theo id và email, có TTL và invalidate chủ động."""
+import os
+import time
+from typing import TYPE_CHECKING, Dict, Optional, Tuple
+
+if TYPE_CHECKING:
+    from models import User
+
+USER_CACHE_TTL_SECONDS = float(os.getenv("USER_CACHE_TTL_SECONDS", 60))
+USER_CACHE_MAX_SIZE = int(os.getenv("USER_CACHE_MAX_SIZE", 10000))
+
+class UserCache:
+    """In-process TTL cache of validated User models, indexed by id and by email"""
+
+    def __init__(self, ttl_seconds: float = USER_CACHE_TTL_SECONDS, max_size: int = USER_CACHE_MAX_SIZE):
+        self.ttl_seconds = ttl_seconds
+        self.max_size = max_size
+        self._by_id: Dict[str, Tuple[float, "User"]] = {}
+        self._email_to_id: Dict[str, str] = {}
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def _lookup(self, user_id: Optional[str]) -> Optional["User"]:
+        entry = self._by_id.get(user_id) if user_id else None
+        if entry is None:
+            return None
+        expires_at, user = entry
+        if expires_at <= time.monotonic():
+            self._drop(user_id)
+            return None
+        return user
+
+    def _count(self, user: Optional["User"]) -> Optional["User"]:
+        if user is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return user
+
+    def get_by_id(self, user_id: str) -> Optional["User"]:
+        return self._count(self._lookup(user_id))
+
+    def get_by_email(self, email: str) -> Optional["User"]:
+        return self._count(self._lookup(self._email_to_id.get(email)))
+
+    def put(self, user: "User"):
+        if not user.id or self.ttl_seconds <= 0:
+            return
+        if len(self._by_id) >= self.max_size and user.id not in self._by_id:
+            # Đầy: bỏ entry cũ nhất (dict giữ thứ tự chèn)
+            self._drop(next(iter(self._by_id)))
+        self._drop(user.id)
+        self._by_id[user.id] = (time.monotonic() + self.ttl_seconds, user)
+        self._email_to_id[user.email] = user.id
+
+    def _drop(self, user_id: str):
+        entry = self._by_id.pop(user_id, None)
+        if entry is not None and self._email_to_id.get(entry[1].email) == user_id:
+            del self._email_to_id[entry[1].email]
+
+    def invalidate(self, user_id: Optional[str] = None, email: Optional[str] = None):
+        """Xóa user khỏi cache sau khi ghi; truyền id hoặc email (hoặc cả hai)."""
+        if email is not None:
+            user_id = user_id or self._email_to_id.get(email)
+            self._email_to_id.pop(email, None)
+        if user_id is not None:
+            self._drop(user_id)
+        self.invalidations += 1
+
+    def snapshot(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._by_id),
+            "max_size": self.max_size,
+            "ttl_seconds": self.ttl_seconds,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "invalidations": self.invalidations,
+        }
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+"""
+Benchmark connection pool của UserService với PostgreSQL chạy local.
+
+Mô phỏng traffic login/profile: mỗi request mở session qua get_db rồi SELECT user theo email.
+Chạy (Postgres local, ví dụ `docker compose up postgres`):
+    POSTGRES_HOST=localhost DB_POOL_SIZE=10 DB_MAX_OVERFLOW=10 \
+        python scripts/bench_userservice_pool.py --concurrency 200 --requests 5000
+So sánh nhiều cấu hình pool bằng cách đổi biến môi trường DB_*.
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "UserService"))
+
+from fastapi import HTTPException  # noqa: E402
+from sqlalchemy import select  # noqa: E402
+
+import database  # noqa: E402
+from models import UserTable  # noqa: E402
+
+BENCH_EMAIL = "bench-pool@example.com"
+
+async def seed_user():
+    await database.init_db()
+    async with database.AsyncSessionLocal() as session:
+        existing = await session.execute(select(UserTable).where(UserTable.email == BENCH_EMAIL))
+        if existing.scalar_one_or_none() is None:
+            session.add(UserTable(username="bench", email=BENCH_EMAIL, password="x"))
+            await session.commit()
+
+async def one_request(latencies: list, errors: list):
+    started = time.monotonic()
+    sessions = database.get_db()
+    try:
+        session = await sessions.__anext__()
+        result = await session.execute(select(UserTable).where(UserTable.email == BENCH_EMAIL))
+        result.scalar_one_or_none()
+        latencies.append(time.monotonic() - started)
+    except HTTPException as e:
+        errors.append(e.status_code)
+    finally:
+        await sessions.aclose()
+
+async def run(concurrency: int, total: int):
+    await seed_user()
+    latencies, errors = [], []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def worker():
+        async with semaphore:
+            await one_request(latencies, errors)
+
+    started = time.monotonic()
+    await asyncio.gather(*[worker() for _ in range(total)])
+    elapsed = time.monotonic() - started
+
+    quantiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else [0.0] * 99
+    print(f"pool_size={database.DB_POOL_SIZE} max_overflow={database.DB_MAX_OVERFLOW} "
+          f"statement_cache={database.DB_STATEMENT_CACHE_SIZE} concurrency={concurrency}")
+    print(f"requests={total} ok={len(latencies)} errors={len(errors)} throughput={len(latencies) / elapsed:.0f} req/s")
+    print(f"latency p50={quantiles[49] * 1000:.1f}ms p95={quantiles[94] * 1000:.1f}ms p99={quantiles[98] * 1000:.1f}ms")
+    print(f"pool={database.pool_stats.snapshot()}")
+    await database.engine.dispose()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--requests", type=int, default=2000)
+    args = parser.parse_args()
+    asyncio.run(run(args.concurrency, args.requests))
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+"""
+Benchmark kiểm tra chữ ký callback VNPay: số callback verify được mỗi giây.
+
+So sánh cách cũ (hmac.new với secret mỗi lần, so sánh bằng !=) với VnpaySigner
+(trạng thái HMAC có key tính sẵn + copy(), compare_digest). Không cần MongoDB hay VNPay:
+    python scripts/bench_vnpay_signing.py --callbacks 200000
+"""
+import argparse
+import hashlib
+import hmac
+import os
+import sys
+import time
+from urllib.parse import quote_plus
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "PaymentService"))
+
+from vnpay_signing import signer_for  # noqa: E402
+
+SECRET = "BENCHVNPAYSECRETKEY0123456789ABC"
+
+def make_callbacks(count: int) -> list:
+    signer = signer_for(SECRET)
+    callbacks = []
+    for i in range(count):
+        params = {
+            "vnp_Amount": 15000000 + i,
+            "vnp_BankCode": "NCB",
+            "vnp_BankTranNo": f"VNP{i:08d}",
+            "vnp_CardType": "ATM",
+            "vnp_OrderInfo": f"Thanh toan cho chuyen di {i}",
+            "vnp_PayDate": "20250101120000",
+            "vnp_ResponseCode": "00",
+            "vnp_TmnCode": "BENCH001",
+            "vnp_TransactionNo": str(14000000 + i),
+            "vnp_TransactionStatus": "00",
+            "vnp_TxnRef": f"20250101120000{i:06d}",
+        }
+        params["vnp_SecureHash"] = signer.sign(params)
+        callbacks.append(params)
+    return callbacks
+
+def legacy_verify(data: dict) -> bool:
+    input_params = {k: v for k, v in data.items() if k.startswith('vnp_') and k != 'vnp_SecureHash'}
+    hash_data_string = "&".join([f"{key}={quote_plus(str(value))}" for key, value in sorted(input_params.items())])
+    h = hmac.new(SECRET.encode('utf-8'), hash_data_string.encode('utf-8'), hashlib.sha512)
+    return h.hexdigest() == data['vnp_SecureHash']
+
+def signer_verify(data: dict) -> bool:
+    return signer_for(SECRET).verify(data)
+
+def measure(name: str, verify, callbacks: list, rounds: int):
+    best = float("inf")
+    for _ in range(rounds):
+        started = time.perf_counter()
+        for data in callbacks:
+            if not verify(data):
+                raise SystemExit(f"{name}: chữ ký không hợp lệ")
+        best = min(best, time.perf_counter() - started)
+    print(f"{name:<8} {len(callbacks) / best:>12,.0f} callbacks/s  ({best * 1e6 / len(callbacks):.2f} µs/callback)")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--callbacks", type=int, default=50000)
+    parser.add_argument("--rounds", type=int, default=3)
+    args = parser.parse_args()
+    callbacks = make_callbacks(args.callbacks)
+    measure("legacy", legacy_verify, callbacks, args.rounds)
+    measure("signer", signer_verify, callbacks, args.rounds)
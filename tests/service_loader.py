@@ -0,0 +1,48 @@
+"""
+Test helpers for importing one service's modules in isolation.
+
+Services reuse module names (crud, database, models, schemas, ...), so a test
+file cannot simply put two services on sys.path. load_service_modules imports
+the requested modules from one service directory and then restores whatever
+was in sys.modules before, so each test file keeps its own copies.
+"""
+import importlib
+import inspect
+import os
+import sys
+
+import mongomock.collection
+from mongomock_motor import AsyncMongoMockClient
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+# Dummy connection settings: clients connect lazily, tests swap in mongomock
+os.environ.setdefault("MONGODB_URL", "mongodb://localhost:1")
+os.environ.setdefault("SECRET_KEY", "test-secret-key-for-unit-tests-only-32chars-minimum")
+
+# pymongo >= 4.11 passes sort= to bulk update builders, which mongomock does not accept yet
+_add_update = mongomock.collection.BulkOperationBuilder.add_update
+if "sort" not in inspect.signature(_add_update).parameters:
+    mongomock.collection.BulkOperationBuilder.add_update = (
+        lambda self, *args, sort=None, **kwargs: _add_update(self, *args, **kwargs)
+    )
+
+
+def load_service_modules(service: str, *names: str) -> list:
+    """Import `names` from the given service directory without leaking them into other tests"""
+    service_dir = os.path.join(ROOT, service)
+    local_names = {f[:-3] for f in os.listdir(service_dir) if f.endswith(".py")}
+    saved = {name: sys.modules.pop(name) for name in local_names if name in sys.modules}
+    sys.path.insert(0, service_dir)
+    try:
+        return [importlib.import_module(name) for name in names]
+    finally:
+        sys.path.remove(service_dir)
+        for name in local_names:
+            sys.modules.pop(name, None)
+        sys.modules.update(saved)
+
+
+def mock_mongo_database(name: str = "test"):
+    """Fresh in-memory Motor-compatible database"""
+    return AsyncMongoMockClient()[name]
@@ -0,0 +1,366 @@
+"""
+Unit tests for PaymentService
+Run with: pytest tests/test_paymentservice.py
+"""
+import asyncio
+import hashlib
+import hmac
+import os
+import sys
+from urllib.parse import quote_plus
+
+import pytest
+from datetime import datetime, timedelta, timezone
+from fastapi.testclient import TestClient
+
+# Add PaymentService to path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'PaymentService'))
+
+# Import only what we need, avoid importing main.py (has DB dependencies)
+from vnpay_signing import VnpaySigner, canonical_query, signer_for
+from service_loader import load_service_modules, mock_mongo_database
+
+pay_database, pay_models, pay_wallet, pay_settlement, pay_crud, pay_main = load_service_modules(
+    "PaymentService", "database", "models", "wallet", "settlement", "crud", "main"
+)
+
+SECRET = "TESTVNPAYSECRET"
+class FakeSession:
+    """Stands in for a Motor session: runs the callback once and rolls the collections back if it raises"""
+
+    def __init__(self, db):
+        self.db = db
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def with_transaction(self, callback):
+        names = await self.db.list_collection_names()
+        snapshot = {name: await self.db[name].find().to_list(None) for name in names}
+        try:
+            return await callback(None)
+        except Exception:
+            for name, docs in snapshot.items():
+                await self.db[name].delete_many({})
+                if docs:
+                    await self.db[name].insert_many(docs)
+            raise
+
+class FakeClient:
+    def __init__(self, db):
+        self.db = db
+
+    async def start_session(self):
+        return FakeSession(self.db)
+
+@pytest.fixture
+def pay_db(monkeypatch):
+    """Point PaymentService at an in-memory database"""
+    db = mock_mongo_database("uitgo_payments_test")
+    monkeypatch.setattr(pay_database, "database", db)
+    monkeypatch.setattr(pay_wallet, "client", FakeClient(db))
+    asyncio.run(db["wallets"].create_index("driver_id", unique=True))
+    return db
+
+PARAMS = {
+    "vnp_Amount": 15000000,
+    "vnp_TxnRef": "20250101120000000000",
+    "vnp_OrderInfo": "Thanh toan cho chuyen di abc",
+    "vnp_ResponseCode": "00",
+    "vnp_ReturnUrl": "http://localhost:8004/v1/payment/vnpay_return?order_id=1&trip_id=abc",
+}
+
+class TestVnpaySigning:
+    """Test VNPay signing and verification"""
+
+    def test_signature_matches_reference_hmac(self):
+        """Same signature as hashing the sorted, quote_plus-encoded query with a fresh HMAC"""
+        data = "&".join(f"{k}={quote_plus(str(v))}" for k, v in sorted(PARAMS.items()))
+        expected = hmac.new(SECRET.encode(), data.encode(), hashlib.sha512).hexdigest()
+        assert canonical_query(PARAMS) == data
+        assert VnpaySigner(SECRET).sign(PARAMS) == expected
+        # Chữ ký lặp lại giống nhau: trạng thái HMAC gốc không bị thay đổi bởi copy()
+        assert VnpaySigner(SECRET).sign(PARAMS) == signer_for(SECRET).sign(PARAMS) == signer_for(SECRET).sign(PARAMS)
+
+    def test_verify_callback(self):
+        """Hash fields and non-vnp_ params are ignored; tampering or a wrong secret fails"""
+        signer = signer_for(SECRET)
+        callback = dict(PARAMS, vnp_SecureHash=signer.sign(PARAMS), vnp_SecureHashType="HmacSHA512", order_id="1")
+        assert signer.verify(callback)
+        assert signer.verify(dict(callback, vnp_SecureHash=callback["vnp_SecureHash"].upper()))
+        assert not signer.verify(dict(callback, vnp_Amount=15000001))
+        assert not VnpaySigner("other-secret").verify(callback)
+        assert not signer.verify({k: v for k, v in callback.items() if k != "vnp_SecureHash"})
+
+class TestWalletEntry:
+    """Test apply_wallet_entry on the transaction and the ledger-first paths"""
+
+    @pytest.mark.parametrize("use_transactions", [True, False])
+    def test_entry_is_applied_once(self, pay_db, monkeypatch, use_transactions):
+        """Same entry_id twice credits the wallet once and leaves one SUCCESS ledger row"""
+        monkeypatch.setattr(pay_wallet, "WALLET_USE_TRANSACTIONS", use_transactions)
+        earning = pay_models.TransactionType.EARNING
+
+        async def scenario():
+            first = await pay_wallet.apply_wallet_entry("d1", 30000.0, earning, trip_id="t1", entry_id="EARNING:t1")
+            again = await pay_wallet.apply_wallet_entry("d1", 30000.0, earning, trip_id="t1", entry_id="EARNING:t1")
+            topup = await pay_wallet.apply_wallet_entry("d1", 5000.0, pay_models.TransactionType.TOPUP)
+            return first, again, topup, await pay_db["wallets"].find_one({"driver_id": "d1"}), \
+                await pay_db["transactions"].find_one({"_id": "EARNING:t1"})
+
+        first, again, topup, wallet, entry = asyncio.run(scenario())
+        assert first == (30000.0, True)
+        assert again == (30000.0, False)
+        assert topup == (35000.0, True)
+        assert wallet["balance"] == 35000.0
+        assert not wallet.get("pending_entries")
+        assert entry["status"] == "SUCCESS"
+        assert entry["balance_after"] == 30000.0
+        assert entry["wallet_id"] == str(wallet["_id"])
+
+    def test_retry_finishes_entry_left_pending_before_credit(self, pay_db, monkeypatch):
+        """Crash after the ledger insert: the retry credits the wallet and marks the row SUCCESS"""
+        monkeypatch.setattr(pay_wallet, "WALLET_USE_TRANSACTIONS", False)
+        earning = pay_models.TransactionType.EARNING
+
+        async def crash(entry):
+            raise RuntimeError("process killed")
+
+        async def scenario():
+            with monkeypatch.context() as m:
+                m.setattr(pay_wallet, "_finish_pending_entry", crash)
+                with pytest.raises(RuntimeError):
+                    await pay_wallet.apply_wallet_entry("d1", 30000.0, earning, trip_id="t1", entry_id="EARNING:t1")
+            pending = await pay_db["transactions"].find_one({"_id": "EARNING:t1"})
+            result = await pay_wallet.apply_wallet_entry("d1", 30000.0, earning, trip_id="t1", entry_id="EARNING:t1")
+            return pending, result, await pay_db["transactions"].find_one({"_id": "EARNING:t1"})
+
+        pending, result, entry = asyncio.run(scenario())
+        assert pending["status"] == "PENDING"
+        assert result == (30000.0, True)
+        assert entry["status"] == "SUCCESS"
+
+    def test_retry_after_credit_does_not_credit_again(self, pay_db, monkeypatch):
+        """Crash after the $inc but before the ledger update: the pending marker stops a second credit"""
+        monkeypatch.setattr(pay_wallet, "WALLET_USE_TRANSACTIONS", False)
+        earning = pay_models.TransactionType.EARNING
+        transactions = pay_db["transactions"]
+
+        async def crash_on_ledger_update(*args, **kwargs):
+            raise RuntimeError("process killed")
+
+        async def scenario():
+            with monkeypatch.context() as m:
+                m.setattr(type(transactions), "update_one", crash_on_ledger_update)
+                with pytest.raises(RuntimeError):
+                    await pay_wallet.apply_wallet_entry("d1", 30000.0, earning, trip_id="t1", entry_id="EARNING:t1")
+            credited = await pay_db["wallets"].find_one({"driver_id": "d1"})
+            finished = await pay_wallet.finish_pending_entries(older_than_seconds=0)
+            return credited, finished, await pay_db["wallets"].find_one({"driver_id": "d1"}), \
+                await transactions.find_one({"_id": "EARNING:t1"})
+
+        credited, finished, wallet, entry = asyncio.run(scenario())
+        assert credited["balance"] == 30000.0
+        assert credited["pending_entries"] == ["EARNING:t1"]
+        assert finished == 1
+        assert wallet["balance"] == 30000.0
+        assert not wallet["pending_entries"]
+        assert entry["status"] == "SUCCESS"
+        assert entry["balance_after"] == 30000.0
+
+class TestSettlement:
+    """Test batch settlement of pending driver earnings"""
+
+    def test_batch_credits_per_driver_totals(self, pay_db):
+        """One batch sums each driver's trips into one credit and the report matches the wallets"""
+        async def scenario():
+            await pay_settlement.record_pending_earning("d1", 30000.0, "t1")
+            await pay_settlement.record_pending_earning("d1", 12000.0, "t2")
+            await pay_settlement.record_pending_earning("d2", 8000.0, "t3")
+            # IPN lặp lại cho cùng chuyến không tạo thêm thu nhập chờ
+            assert not await pay_settlement.record_pending_earning("d1", 30000.0, "t1")
+            settled = await pay_settlement.run_settlement_cycle()
+            wallets = {doc["driver_id"]: doc["balance"] async for doc in pay_db["wallets"].find()}
+            return settled, wallets, await pay_settlement.list_settlement_batches(), \
+                await pay_settlement.reconcile_driver("d1")
+
+        settled, wallets, reports, reconciliation = asyncio.run(scenario())
+        assert settled == 1
+        assert wallets == {"d1": 42000.0, "d2": 8000.0}
+        report = reports[0]
+        assert (report["entries"], report["drivers"], report["total_amount"]) == (3, 2, 50000.0)
+        assert report["per_driver"] == [
+            {"driver_id": "d1", "amount": 42000.0, "entries": 2},
+            {"driver_id": "d2", "amount": 8000.0, "entries": 1},
+        ]
+        assert reconciliation["difference"] == 0
+        assert reconciliation["ledger_entries"] == 2
+        assert reconciliation["pending_entries"] == 0
+
+    def test_trip_already_credited_elsewhere_is_skipped(self, pay_db):
+        """A trip whose EARNING entry was written outside the batch is not credited again"""
+        async def scenario():
+            await pay_wallet.apply_wallet_entry(
+                "d1", 30000.0, pay_models.TransactionType.EARNING, trip_id="t1", entry_id=pay_wallet.earning_entry_id("t1")
+            )
+            await pay_settlement.record_pending_earning("d1", 30000.0, "t1")
+            await pay_settlement.record_pending_earning("d1", 12000.0, "t2")
+            await pay_settlement.run_settlement_cycle()
+            return await pay_db["wallets"].find_one({"driver_id": "d1"}), await pay_settlement.list_settlement_batches()
+
+        wallet, reports = asyncio.run(scenario())
+        assert wallet["balance"] == 42000.0
+        assert reports[0]["skipped_duplicates"] == 1
+        assert reports[0]["per_driver"] == [{"driver_id": "d1", "amount": 12000.0, "entries": 1}]
+
+    def test_rerun_of_interrupted_batch_credits_once(self, pay_db):
+        """Worker died after the $inc: the stale batch is settled again without a second credit"""
+        async def scenario():
+            await pay_settlement.record_pending_earning("d1", 30000.0, "t1")
+            await pay_settlement.record_pending_earning("d2", 8000.0, "t2")
+            batch_id = await pay_settlement._claim_batch()
+            await pay_settlement.settle_batch(batch_id)
+            # Trạng thái như khi worker chết trước khi đánh dấu SETTLED, lease đã hết
+            expired = datetime.now(timezone.utc) - timedelta(seconds=pay_settlement.SETTLEMENT_LEASE_SECONDS + 1)
+            await pay_db["pending_earnings"].update_many(
+                {"batch_id": batch_id}, {"$set": {"status": "SETTLING", "settling_since": expired}}
+            )
+            settled = await pay_settlement.run_settlement_cycle()
+            wallets = {doc["driver_id"]: doc["balance"] async for doc in pay_db["wallets"].find()}
+            statuses = {doc["status"] async for doc in pay_db["pending_earnings"].find()}
+            return batch_id, settled, wallets, statuses, await pay_db["transactions"].count_documents({})
+
+        batch_id, settled, wallets, statuses, ledger_rows = asyncio.run(scenario())
+        assert batch_id is not None
+        assert settled == 1
+        assert wallets == {"d1": 30000.0, "d2": 8000.0}
+        assert statuses == {"SETTLED"}
+        assert ledger_rows == 2
+
+    def test_batches_endpoint_exposes_batch_id(self, pay_db):
+        """The report is served with batch_id, not Mongo's _id"""
+        async def scenario():
+            await pay_settlement.record_pending_earning("d1", 30000.0, "t1")
+            await pay_settlement.run_settlement_cycle()
+            return (await pay_settlement.list_settlement_batches())[0]["_id"]
+
+        batch_id = asyncio.run(scenario())
+        response = TestClient(pay_main.app).get("/v1/settlements/batches")
+        assert response.status_code == 200
+        assert response.json()[0]["batch_id"] == batch_id
+        assert "_id" not in response.json()[0]
+
+class TestVnpayCallbackWorker:
+    """Test the IPN worker that settles VNPay payments"""
+
+    def test_failed_earning_write_is_retried(self, pay_db, monkeypatch):
+        """The transaction stays PENDING and the IPN goes back to the queue until the earning is recorded"""
+        async def no_notify(*args, **kwargs):
+            return None
+
+        async def earning_write_fails(*args, **kwargs):
+            raise RuntimeError("pending_earnings unavailable")
+
+        monkeypatch.setattr(pay_crud, "notify_trip_service_payment_status", no_notify)
+        params = {"vnp_TxnRef": "ORDER1", "vnp_ResponseCode": "00", "vnp_TransactionNo": "14000001"}
+
+        async def scenario():
+            await pay_db["transactions"].insert_one({
+                "_id": "tx1", "transaction_id": "ORDER1", "trip_id": "t1", "amount": 50000.0,
+                "transaction_type": "PAYMENT", "status": "PENDING", "driver_id": "d1", "driver_earning": 40000.0,
+            })
+            await pay_crud.record_vnpay_callback(params)
+            with monkeypatch.context() as m:
+                m.setattr(pay_settlement, "record_pending_earning", earning_write_fails)
+                await pay_crud.process_vnpay_callback(await pay_crud.claim_vnpay_callback())
+            after_failure = (
+                await pay_db["transactions"].find_one({"_id": "tx1"}),
+                await pay_db["vnpay_callbacks"].find_one({"_id": "ORDER1"}),
+                await pay_crud.claim_vnpay_callback(),
+            )
+            # Hết thời gian backoff: lần thử lại ghi được thu nhập và hoàn tất giao dịch
+            await pay_db["vnpay_callbacks"].update_one(
+                {"_id": "ORDER1"}, {"$set": {"available_at": datetime.now(timezone.utc)}}
+            )
+            await pay_crud.process_vnpay_callback(await pay_crud.claim_vnpay_callback())
+            return after_failure, await pay_db["transactions"].find_one({"_id": "tx1"}), \
+                await pay_db["vnpay_callbacks"].find_one({"_id": "ORDER1"}), \
+                await pay_db["pending_earnings"].find_one({"_id": "EARNING:t1"})
+
+        (failed_tx, queued, early_claim), tx, callback, earning = asyncio.run(scenario())
+        assert failed_tx["status"] == "PENDING"
+        assert queued["status"] == "QUEUED"
+        assert queued["attempts"] == 1
+        assert "pending_earnings unavailable" in queued["last_error"]
+        assert early_claim is None  # chưa đến hạn thử lại
+        assert tx["status"] == "SUCCESS"
+        assert callback["status"] == "DONE"
+        assert (earning["driver_id"], earning["amount"]) == ("d1", 40000.0)
+
+class TestSettlementInputs:
+    """Test where the IPN takes the driver and earning from"""
+
+    def test_stored_inputs_skip_trip_service(self, monkeypatch):
+        """A transaction that already carries driver_id/driver_earning never calls TripService"""
+        calls = []
+
+        async def get_trip_details(trip_id):
+            calls.append(trip_id)
+            return None
+
+        monkeypatch.setattr(pay_crud, "get_trip_details", get_trip_details)
+        transaction = {"trip_id": "t1", "amount": 50000.0, "driver_id": "d1", "driver_earning": 40000.0}
+        assert asyncio.run(pay_crud._resolve_settlement_inputs("ORDER1", transaction)) == ("d1", 40000.0)
+        assert calls == []
+
+    def test_legacy_transaction_asks_trip_service(self, monkeypatch):
+        """An older transaction without settlement inputs falls back to the trip's driver and actual fare"""
+        calls = []
+
+        async def get_trip_details(trip_id):
+            calls.append(trip_id)
+            return {"driver_id": "d2", "fare": {"actual": 60000.0}}
+
+        monkeypatch.setattr(pay_crud, "get_trip_details", get_trip_details)
+        driver_id, earning = asyncio.run(pay_crud._resolve_settlement_inputs("ORDER2", {"trip_id": "t2", "amount": 50000.0}))
+        assert calls == ["t2"]
+        assert driver_id == "d2"
+        assert earning == pytest.approx(60000.0 * (1 - pay_crud.APP_COMMISSION_RATE))
+
+    def test_legacy_transaction_without_driver_is_retried(self, monkeypatch):
+        """No driver from TripService raises so the IPN stays queued instead of dropping the earning"""
+        async def get_trip_details(trip_id):
+            return None
+
+        monkeypatch.setattr(pay_crud, "get_trip_details", get_trip_details)
+        with pytest.raises(RuntimeError):
+            asyncio.run(pay_crud._resolve_settlement_inputs("ORDER3", {"trip_id": "t3", "amount": 50000.0}))
+
+class TestPaymentIdempotency:
+    """Test Idempotency-Key on payment link creation"""
+
+    def test_retry_replays_link_without_new_transaction(self, pay_db, monkeypatch):
+        """A retry with the same key returns the first link; another body with that key is rejected"""
+        calls = []
+
+        async def process_vnpay_payment(request):
+            calls.append(request.trip_id)
+            return {"status": "PENDING", "payUrl": f"https://vnpay.test/pay/{len(calls)}", "transaction_id": "ORDER1"}
+
+        monkeypatch.setattr(pay_crud, "process_vnpay_payment", process_vnpay_payment)
+        client = TestClient(pay_main.app)
+        body = {"trip_id": "t1", "user_id": "p1", "driver_id": "d1", "amount": 50000}
+        headers = {"Idempotency-Key": "retry-1"}
+
+        first = client.post("/v1/payment/process", json=body, headers=headers)
+        replay = client.post("/v1/payment/process", json=body, headers=headers)
+        other = client.post("/v1/payment/process", json=dict(body, amount=60000), headers=headers)
+
+        assert calls == ["t1"]
+        assert first.status_code == replay.status_code == 200
+        assert replay.json() == first.json()
+        assert replay.headers["Idempotent-Replayed"] == "true"
+        assert other.status_code == 422
@@ -0,0 +1,493 @@
+"""
+Unit tests for TripService
+Run with: pytest tests/test_tripservice.py
+"""
+import asyncio
+import pytest
+import sys
+import os
+
+# Add TripService to path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'TripService'))
+
+# Import only what we need, avoid importing main.py (has DB dependencies)
+from admission import AdmissionController, RoutePolicy, Overloaded, PRIORITY_LOW, PRIORITY_CRITICAL
+from resilience import CircuitBreaker, LatencyHistogram, Upstream, UpstreamUnavailable
+from service_token import ServiceTokenManager
+from service_loader import load_service_modules, mock_mongo_database
+from bson import ObjectId
+from fastapi.testclient import TestClient
+from datetime import datetime, timedelta, timezone
+
+trip_crud, trip_models, trip_schemas, trip_main, trip_idempotency = load_service_modules(
+    "TripService", "crud", "models", "schemas", "main", "idempotency"
+)
+
+TRIP_COLLECTIONS = (
+    "trips", "trips_archive", "trip_stats", "trip_rollups", "trip_routes", "ratings", "payment_jobs", "job_leases",
+    "idempotency_keys"
+)
+
+@pytest.fixture
+def trip_db(monkeypatch):
+    """Point TripService crud at an in-memory database"""
+    db = mock_mongo_database("uitgo_trips_test")
+    for name in TRIP_COLLECTIONS:
+        if hasattr(trip_crud, f"{name}_collection"):
+            monkeypatch.setattr(trip_crud, f"{name}_collection", db[name])
+    monkeypatch.setattr(trip_idempotency, "idempotency_collection", db["idempotency_keys"])
+    return db
+
+async def insert_trip(db, status, passenger_id="p1", driver_id="", fare=40000.0):
+    """Insert a trip and count it the way trip creation does"""
+    trip = {
+        "_id": ObjectId(),
+        "status": status,
+        "passenger_id": passenger_id,
+        "driver_id": driver_id,
+        "fare": {"estimated": fare},
+        "payment": {"method": trip_models.PaymentMethodEnum.CASH.value, "status": "PENDING"},
+        "pickup": {"location": {"type": "Point", "coordinates": [106.70, 10.77]}},
+        "history": [],
+        "created_at": datetime.now(timezone.utc),
+    }
+    await db["trips"].insert_one(trip)
+    await trip_crud._record_stats_transition(None, {**trip, "_id": str(trip["_id"])})
+    return str(trip["_id"])
+
+class TestAdmission:
+    """Test admission control"""
+
+    def test_sheds_when_queue_full(self):
+        """Requests beyond limit + queue are rejected with a Retry-After hint"""
+        async def scenario():
+            controller = AdmissionController({"r": RoutePolicy(limit=1, max_queue=0, queue_timeout=1.5)})
+            await controller.acquire("r")
+            with pytest.raises(Overloaded) as exc:
+                await controller.acquire("r")
+            assert exc.value.retry_after == 2
+            assert controller.snapshot()["routes"]["r"]["shed"] == 1
+
+        asyncio.run(scenario())
+
+    def test_queued_request_gets_released_slot(self):
+        """A waiter is admitted as soon as a slot is released"""
+        async def scenario():
+            controller = AdmissionController({"r": RoutePolicy(limit=1, max_queue=1, queue_timeout=1.0)})
+            limiter = await controller.acquire("r")
+            waiter = asyncio.create_task(controller.acquire("r"))
+            await asyncio.sleep(0)
+            assert limiter.queued == 1
+            limiter.release()
+            await waiter
+            assert limiter.in_flight == 1
+            assert limiter.queued == 0
+
+        asyncio.run(scenario())
+
+    def test_queue_timeout_sheds(self):
+        """A waiter that exceeds its queue budget is shed and leaves the queue"""
+        async def scenario():
+            controller = AdmissionController({"r": RoutePolicy(limit=1, max_queue=1, queue_timeout=0.01)})
+            limiter = await controller.acquire("r")
+            with pytest.raises(Overloaded):
+                await controller.acquire("r")
+            assert limiter.queued == 0
+            assert limiter.in_flight == 1
+
+        asyncio.run(scenario())
+
+    def test_low_priority_shed_first(self):
+        """Low-priority routes are refused above the brownout threshold, critical ones are not"""
+        async def scenario():
+            controller = AdmissionController(
+                {
+                    "critical": RoutePolicy(limit=5, max_queue=0, queue_timeout=0, priority=PRIORITY_CRITICAL),
+                    "low": RoutePolicy(limit=5, max_queue=0, queue_timeout=0, priority=PRIORITY_LOW),
+                },
+                shed_low_priority_at=1
+            )
+            await controller.acquire("critical")
+            with pytest.raises(Overloaded):
+                await controller.acquire("low")
+            await controller.acquire("critical")
+            assert controller.in_flight == 2
+
+        asyncio.run(scenario())
+
+class TestResilience:
+    """Test circuit breaker, hedging and latency histogram"""
+
+    def test_breaker_opens_and_half_opens(self):
+        """Breaker opens after consecutive failures and lets one probe through after recovery"""
+        breaker = CircuitBreaker(failure_threshold=2, recovery_timeout=0)
+        breaker.record_failure()
+        assert breaker.state == CircuitBreaker.CLOSED
+        breaker.record_failure()
+        assert breaker.state == CircuitBreaker.OPEN
+
+        assert breaker.allow()
+        assert breaker.state == CircuitBreaker.HALF_OPEN
+        assert not breaker.allow()
+        breaker.record_success()
+        assert breaker.state == CircuitBreaker.CLOSED
+
+    def test_open_breaker_fails_fast(self):
+        """Calls are rejected without touching the upstream while the breaker is open"""
+        async def scenario():
+            upstream = Upstream("test", timeout=1.0, failure_threshold=1, recovery_timeout=60)
+            calls = []
+
+            async def failing():
+                calls.append(1)
+                raise RuntimeError("boom")
+
+            with pytest.raises(RuntimeError):
+                await upstream.call(failing)
+            with pytest.raises(UpstreamUnavailable):
+                await upstream.call(failing)
+            assert len(calls) == 1
+            assert upstream.rejected == 1
+
+        asyncio.run(scenario())
+
+    def test_hedged_request_returns_fastest(self):
+        """A slow first attempt is hedged and the faster duplicate wins"""
+        async def scenario():
+            upstream = Upstream("test", timeout=1.0, hedge_after=0.01)
+            attempts = []
+
+            async def fetch():
+                attempts.append(1)
+                await asyncio.sleep(0.5 if len(attempts) == 1 else 0)
+                return len(attempts)
+
+            assert await upstream.call(fetch) == 2
+            assert upstream.hedged == 1
+
+        asyncio.run(scenario())
+
+    def test_cancelled_probe_releases_half_open_slot(self):
+        """A half-open probe cancelled mid-call frees its slot so the next call can probe"""
+        async def scenario():
+            upstream = Upstream("test", timeout=1.0, failure_threshold=1, recovery_timeout=0)
+
+            async def failing():
+                raise RuntimeError("boom")
+
+            async def hanging():
+                await asyncio.sleep(10)
+
+            async def healthy():
+                return "ok"
+
+            with pytest.raises(RuntimeError):
+                await upstream.call(failing, hedge=False)
+            probe = asyncio.create_task(upstream.call(hanging, hedge=False))
+            await asyncio.sleep(0.01)
+            assert upstream.breaker.state == CircuitBreaker.HALF_OPEN
+            probe.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await probe
+
+            assert await upstream.call(healthy, hedge=False) == "ok"
+            assert upstream.breaker.state == CircuitBreaker.CLOSED
+
+        asyncio.run(scenario())
+
+    def test_histogram_percentiles(self):
+        """Percentiles report the upper bound of the matching bucket"""
+        histogram = LatencyHistogram([10, 100])
+        for _ in range(9):
+            histogram.record(0.005)
+        histogram.record(0.05)
+        assert histogram.percentile(0.5) == 10
+        assert histogram.percentile(0.99) == 100
+        assert histogram.snapshot()["count"] == 10
+
+class TestServiceToken:
+    """Test service token manager"""
+
+    def test_concurrent_callers_share_one_refresh(self):
+        """Concurrent cache misses trigger exactly one token request"""
+        async def scenario():
+            calls = []
+
+            async def fetch():
+                calls.append(1)
+                await asyncio.sleep(0.01)
+                return {"access_token": f"token-{len(calls)}"}
+
+            manager = ServiceTokenManager(None, None, None, fetch=fetch)
+            tokens = await asyncio.gather(*[manager.get_token() for _ in range(20)])
+            assert set(tokens) == {"token-1"}
+            assert len(calls) == 1
+
+        asyncio.run(scenario())
+
+    def test_invalidate_ignores_stale_token(self):
+        """Invalidating an already-replaced token keeps the current one"""
+        async def scenario():
+            counter = iter(range(100))
+
+            async def fetch():
+                return {"access_token": f"token-{next(counter)}"}
+
+            manager = ServiceTokenManager(None, None, None, fetch=fetch)
+            first = await manager.get_token()
+            manager.invalidate(first)
+            second = await manager.get_token()
+            manager.invalidate(first)
+            assert await manager.get_token() == second != first
+
+        asyncio.run(scenario())
+
+    def test_unconfigured_manager_never_fetches(self):
+        """Without URL/credentials (and no custom fetch) no token request is attempted"""
+        async def scenario():
+            manager = ServiceTokenManager(None, None, None)
+            assert not manager.configured
+            assert ServiceTokenManager("http://userservice/auth/token", "id", "secret").configured
+            assert await manager.get_token() is None
+            assert manager.snapshot()["refresh_in_flight"] is False
+            assert manager.refresh_count == 0
+
+        asyncio.run(scenario())
+
+class TestTripStatistics:
+    """Test incremental trip_stats counters"""
+
+    def test_incremental_counters_match_rebuild(self, trip_db):
+        """Counters kept with $inc after status transitions equal a full recomputation"""
+        status = trip_models.TripStatusEnum
+
+        async def scenario():
+            completed = await insert_trip(trip_db, status.ACCEPTED.value, driver_id="d1")
+            assert await trip_crud.update_trip_status(completed, status.ON_TRIP)
+            assert await trip_crud.complete_trip(completed, 52000.0)
+            assert await trip_crud.add_trip_rating(completed, trip_schemas.RatingCreate(stars=1))
+            # Re-rating replaces the earlier rating in the counters instead of adding to it
+            assert await trip_crud.add_trip_rating(completed, trip_schemas.RatingCreate(stars=4))
+
+            cancelled = await insert_trip(trip_db, status.ACCEPTED.value, driver_id="d1")
+            cancellation = trip_schemas.CancellationCreate(cancelled_by=trip_models.CancelledByEnum.DRIVER)
+            assert await trip_crud.cancel_trip(cancelled, cancellation)
+            assert await trip_crud.cancel_trip(cancelled, cancellation)
+
+            fare_changed = await insert_trip(trip_db, status.ON_TRIP.value, passenger_id="p2", driver_id="d2")
+            assert await trip_crud.complete_trip(fare_changed, 30000.0)
+            assert await trip_crud.update_trip_fare(fare_changed, 35000.0, discount=1000)
+            await insert_trip(trip_db, status.PENDING.value, passenger_id="p2")
+
+            incremental = {
+                doc["_id"]: {field: doc.get(field, 0) for field in trip_crud.STATS_COUNTER_FIELDS}
+                async for doc in trip_db["trip_stats"].find()
+            }
+            rebuilt = {}
+            for role, field in (("driver", "driver_id"), ("passenger", "passenger_id")):
+                # mongomock lacks $unionWith/$merge: run the recomputation stages and compare their output
+                stages = trip_crud._stats_rebuild_pipeline(role, field, datetime.now(timezone.utc))[1:-1]
+                async for doc in trip_db["trips"].aggregate(stages):
+                    rebuilt[doc["_id"]] = {field: doc[field] for field in trip_crud.STATS_COUNTER_FIELDS}
+
+            assert incremental == rebuilt
+            assert rebuilt["driver:d1"] == {
+                "total_trips": 2, "completed_trips": 1, "cancelled_trips": 1,
+                "total_revenue": 52000.0, "rating_sum": 4, "rating_count": 1
+            }
+            assert rebuilt["driver:d2"]["total_revenue"] == 35000.0
+
+        asyncio.run(scenario())
+
+    def test_transitions_report_real_previous_status(self, trip_db, monkeypatch):
+        """Counter deltas are computed from the stored status, not the first allowed source"""
+        status = trip_models.TripStatusEnum
+        transitions = []
+        record = trip_crud._record_stats_transition
+
+        async def spy(before, after):
+            transitions.append((before and before["status"], after and after["status"]))
+            await record(before, after)
+
+        monkeypatch.setattr(trip_crud, "_record_stats_transition", spy)
+
+        async def scenario():
+            trip_id = await insert_trip(trip_db, status.ON_TRIP.value, driver_id="d1")
+            cancellation = trip_schemas.CancellationCreate(cancelled_by=trip_models.CancelledByEnum.SYSTEM)
+            cancelled = await trip_crud.cancel_trip(trip_id, cancellation)
+            assert cancelled["status"] == status.CANCELLED.value
+            assert cancelled["history"][-1]["status"] == status.CANCELLED.value
+            assert cancelled["cancellation"]["cancelled_by"] == trip_models.CancelledByEnum.SYSTEM
+
+            trip_id = await insert_trip(trip_db, status.ACCEPTED.value, driver_id="d1")
+            completed = await trip_crud.update_trip_status(trip_id, status.COMPLETED)
+            assert completed["status"] == status.COMPLETED.value and completed["endTime"]
+
+            # Status updates keep their original, unconditional filter
+            trip_id = await insert_trip(trip_db, status.PENDING.value)
+            started = await trip_crud.update_trip_status(trip_id, status.ON_TRIP)
+            assert started["status"] == status.ON_TRIP.value and started["startTime"]
+            assert [transition for transition in transitions if transition[0]] == [
+                (status.ON_TRIP.value, status.CANCELLED.value),
+                (status.ACCEPTED.value, status.COMPLETED.value),
+                (status.PENDING.value, status.ON_TRIP.value),
+            ]
+
+        asyncio.run(scenario())
+
+class TestCompleteTrip:
+    """Test trip completion"""
+
+    def test_complete_validates_and_stores_fare_literally(self, trip_db):
+        """The fare must be a number; stored values are never evaluated as pipeline expressions"""
+        status = trip_models.TripStatusEnum
+        client = TestClient(trip_main.app)
+
+        async def setup():
+            return await insert_trip(trip_db, status.ACCEPTED.value, driver_id="d1")
+
+        trip_id = asyncio.run(setup())
+        for body in ({}, {"actual_fare": "$passenger_id"}, {"actual_fare": {"$toString": "$_id"}}, {"actual_fare": -1}):
+            assert client.post(f"/trips/{trip_id}/complete", json=body).status_code == 400
+
+        response = client.post(f"/trips/{trip_id}/complete", json={"actual_fare": "52000"})
+        assert response.status_code == 200
+        assert client.post(f"/trips/{trip_id}/complete", json={"actual_fare": 52000}).json()["message"] == "Trip already completed"
+
+        async def check():
+            trip = await trip_db["trips"].find_one({"_id": ObjectId(trip_id)})
+            assert trip["status"] == status.COMPLETED.value
+            assert trip["fare"]["actual"] == 52000.0
+            assert trip["payment"]["status"] == trip_models.PaymentStatusEnum.SUCCESS.value
+            assert [entry["status"] for entry in trip["history"]] == [status.COMPLETED.value]
+
+            # crud-level writes keep operator-looking values as plain data
+            other = await insert_trip(trip_db, status.ON_TRIP.value, driver_id="d2")
+            assert await trip_crud.complete_trip(other, 1000.0, discount="$fare.estimated")
+            stored = await trip_db["trips"].find_one({"_id": ObjectId(other)})
+            assert stored["fare"]["discount"] == "$fare.estimated"
+
+        asyncio.run(check())
+
+class TestAnalytics:
+    """Test analytics time series"""
+
+    def test_naive_bounds_are_treated_as_utc(self, trip_db):
+        """A start without timezone (and no end) is read as UTC instead of failing the comparison"""
+        async def scenario():
+            start = (datetime.now(timezone.utc) - timedelta(days=3)).replace(tzinfo=None)
+            series = await trip_main._analytics_series("driver", "d1", trip_models.AnalyticsGranularityEnum.DAY, start, None)
+            assert len(series.buckets) == 4
+            assert series.buckets[0].bucket_start.tzinfo is not None
+
+            with pytest.raises(trip_main.HTTPException) as exc:
+                await trip_main._analytics_series(
+                    "driver", "d1", trip_models.AnalyticsGranularityEnum.DAY, datetime.now() + timedelta(days=2), None
+                )
+            assert exc.value.status_code == 400
+
+        asyncio.run(scenario())
+
+class TestTripArchive:
+    """Test reads across hot and archived trips"""
+
+    def test_page_merges_hot_and_archive_by_created_at(self, trip_db):
+        """An old unfinished trip still in the hot collection sorts after newer archived trips"""
+        async def scenario():
+            now = datetime.now(timezone.utc)
+            trips = {
+                "new": ("trips", now),
+                "archived": ("trips_archive", now - timedelta(days=120)),
+                "old_on_trip": ("trips", now - timedelta(days=200)),
+                "archived_oldest": ("trips_archive", now - timedelta(days=300)),
+            }
+            for label, (collection, created_at) in trips.items():
+                await trip_db[collection].insert_one({"_id": label, "passenger_id": "p1", "created_at": created_at})
+
+            first = await trip_crud.get_trips_by_passenger("p1", skip=0, limit=2)
+            second = await trip_crud.get_trips_by_passenger("p1", skip=2, limit=2)
+            assert [trip["_id"] for trip in first + second] == list(trips)
+            assert await trip_crud.get_trips_by_passenger("p1", skip=4, limit=2) == []
+
+        asyncio.run(scenario())
+
+    def test_archiver_lease_single_holder(self, trip_db, monkeypatch):
+        """Only one replica holds the archiver lease until it expires"""
+        async def scenario():
+            assert await trip_crud.acquire_job_lease("trip-archiver", 60)
+            assert await trip_crud.acquire_job_lease("trip-archiver", 60)  # renewal by the holder
+
+            monkeypatch.setattr(trip_crud, "JOB_LEASE_HOLDER", "other-replica")
+            assert not await trip_crud.acquire_job_lease("trip-archiver", 60)
+            await trip_db["job_leases"].update_one(
+                {"_id": "trip-archiver"}, {"$set": {"expires_at": datetime.now(timezone.utc) - timedelta(seconds=1)}}
+            )
+            assert await trip_crud.acquire_job_lease("trip-archiver", 60)
+
+        asyncio.run(scenario())
+
+class TestIdempotency:
+    """Test Idempotency-Key handling"""
+
+    def test_replays_stored_response(self, trip_db):
+        """A retry with the same key and body gets the stored response without re-running the handler"""
+        async def scenario():
+            calls = []
+
+            async def handler():
+                calls.append(1)
+                return {"trip_id": "t1", "call": len(calls)}
+
+            first = await trip_idempotency.run_idempotent("k1", "POST /x", {"a": 1}, handler)
+            replay = await trip_idempotency.run_idempotent("k1", "POST /x", {"a": 1}, handler)
+            assert len(calls) == 1
+            assert replay.status_code == 200 and replay.body == first.body
+            assert replay.headers["Idempotent-Replayed"] == "true"
+            # Same key in another scope is a different request
+            await trip_idempotency.run_idempotent("k1", "POST /y", {"a": 1}, handler)
+            assert len(calls) == 2
+
+        asyncio.run(scenario())
+
+    def test_rejects_different_body_and_in_flight_duplicate(self, trip_db):
+        """Reusing a key for another body is a 422; a duplicate while the first is running is a 409"""
+        async def scenario():
+            started = asyncio.Event()
+            finish = asyncio.Event()
+
+            async def slow_handler():
+                started.set()
+                await finish.wait()
+                return {"ok": True}
+
+            first = asyncio.create_task(
+                trip_idempotency.run_idempotent("k2", "POST /x", {"a": 1}, slow_handler)
+            )
+            await started.wait()
+            with pytest.raises(trip_idempotency.HTTPException) as exc:
+                await trip_idempotency.run_idempotent("k2", "POST /x", {"a": 1}, slow_handler)
+            assert exc.value.status_code == 409
+            finish.set()
+            await first
+
+            with pytest.raises(trip_idempotency.HTTPException) as exc:
+                await trip_idempotency.run_idempotent("k2", "POST /x", {"a": 2}, slow_handler)
+            assert exc.value.status_code == 422
+
+        asyncio.run(scenario())
+
+    def test_failed_handler_releases_key(self, trip_db):
+        """Errors are not stored, so the next retry runs the handler again"""
+        async def scenario():
+            async def failing():
+                raise RuntimeError("boom")
+
+            async def succeeding():
+                return {"ok": True}
+
+            with pytest.raises(RuntimeError):
+                await trip_idempotency.run_idempotent("k3", "POST /x", {}, failing)
+            response = await trip_idempotency.run_idempotent("k3", "POST /x", {}, succeeding)
+            assert response.status_code == 200
+
+        asyncio.run(scenario())
@@ -14,7 +14,26 @@ os.environ.setdefault("ACCESS_TOKEN_EXPIRE_MINUTES", "30")
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'UserService'))
 
 # Import only what we need, avoid importing main.py (has DB dependencies)
-from auth import get_password_hash, verify_password, create_access_token
+import asyncio
+import time
+from auth import get_password_hash, verify_password, create_access_token, create_user_access_token, SECRET_KEY, ALGORITHM
+from auth import get_password_hash_async, verify_and_update_password, password_hash_pool
+from user_cache import UserCache
+from ndjson_stream import iter_ndjson_batches
+from service_loader import load_service_modules
+from types import SimpleNamespace
+from passlib.context import CryptContext
+from jose import jwt
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.exc import TimeoutError as SQLAlchemyTimeoutError
+from sqlalchemy.util import greenlet_spawn
+from unittest.mock import MagicMock
+from fastapi.testclient import TestClient
+
+# crud/schemas share module names with other services: load them in isolation
+user_crud, user_schemas, user_models, user_database, user_main = load_service_modules(
+    "UserService", "crud", "schemas", "models", "database", "main"
+)
 
 class TestAuth:
     """Test authentication functions"""
@@ -42,6 +61,27 @@ class TestAuth:
         # Should not raise exception
         assert hashed is not None
 
+    def test_async_hashing_uses_pool(self):
+        """Hashing and verification run on the bcrypt pool"""
+        async def scenario():
+            completed = password_hash_pool.completed
+            hashed = await get_password_hash_async("pool-password")
+            ok, new_hash = await verify_and_update_password("pool-password", hashed)
+            assert ok and new_hash is None
+            assert password_hash_pool.completed == completed + 2
+
+        asyncio.run(scenario())
+
+    def test_rehash_on_outdated_cost(self):
+        """A hash made with a lower cost is upgraded on successful verification"""
+        old_hash = CryptContext(schemes=["bcrypt"], bcrypt__rounds=4).hash("rehash-me")
+        ok, new_hash = asyncio.run(verify_and_update_password("rehash-me", old_hash))
+        assert ok
+        assert new_hash is not None and verify_password("rehash-me", new_hash)
+
+        ok, new_hash = asyncio.run(verify_and_update_password("wrong", old_hash))
+        assert not ok and new_hash is None
+
     def test_create_access_token(self):
         """Test JWT token creation"""
         data = {"sub": "test@example.com"}
@@ -53,6 +93,193 @@ class TestAuth:
         # Token should have 3 parts (header.payload.signature)
         assert len(token.split('.')) == 3
 
+    def test_user_token_carries_identity_claims(self):
+        """User tokens carry id and type so other services can skip UserService lookups"""
+        token = create_user_access_token("driver@example.com", "42", "DRIVER")
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+
+        assert payload["sub"] == "driver@example.com"
+        assert payload["uid"] == "42"
+        assert payload["user_type"] == "DRIVER"
+        assert payload["type"] == "user"
+
+class TestUserCache:
+    """Test user lookup cache"""
+
+    def test_hit_by_id_and_email(self):
+        """A cached user is served by id and by email and counted as hits"""
+        cache = UserCache(ttl_seconds=60)
+        user = SimpleNamespace(id="u1", email="a@example.com")
+        assert cache.get_by_email("a@example.com") is None
+        cache.put(user)
+        assert cache.get_by_email("a@example.com") is user
+        assert cache.get_by_id("u1") is user
+        snapshot = cache.snapshot()
+        assert (snapshot["hits"], snapshot["misses"]) == (2, 1)
+
+    def test_invalidate_and_expiry(self):
+        """Invalidation removes both indexes; expired entries are misses"""
+        cache = UserCache(ttl_seconds=60)
+        cache.put(SimpleNamespace(id="u1", email="a@example.com"))
+        cache.invalidate(user_id="u1")
+        assert cache.get_by_email("a@example.com") is None
+        assert cache.snapshot()["size"] == 0
+
+        expired = UserCache(ttl_seconds=0.001)
+        expired.put(SimpleNamespace(id="u2", email="b@example.com"))
+        time.sleep(0.01)
+        assert expired.get_by_id("u2") is None
+
+    def test_bounded_size(self):
+        """The oldest entry is evicted when the cache is full"""
+        cache = UserCache(ttl_seconds=60, max_size=2)
+        for i in range(3):
+            cache.put(SimpleNamespace(id=f"u{i}", email=f"{i}@example.com"))
+        assert cache.get_by_id("u0") is None
+        assert cache.get_by_email("2@example.com").id == "u2"
+
+class TestNdjsonImport:
+    """Test streamed NDJSON parsing for bulk import"""
+
+    def test_batches_and_reports_bad_lines(self):
+        """Lines split across chunks are joined, blank lines skipped and bad JSON reported per line"""
+        async def chunks():
+            for chunk in [b'{"email": "a@example.com"}\n{"email": "b@ex', b'ample.com"}\n\nnot-json\n{"email": "c@example.com"}']:
+                yield chunk
+
+        async def collect():
+            return [batch async for batch in iter_ndjson_batches(chunks(), batch_size=2)]
+
+        batches = asyncio.run(collect())
+        rows = [row for batch in batches for row in batch]
+        assert [len(batch) for batch in batches] == [2, 2]
+        assert [row.line for row in rows] == [1, 2, 4, 5]
+        assert rows[1].data == {"email": "b@example.com"}
+        assert rows[2].error is not None and rows[2].data is None
+
+class TestDbPool:
+    """Test connection pool metrics and pool exhaustion"""
+
+    def test_pool_records_checkout_wait_and_timeouts(self, monkeypatch):
+        """Wait time is recorded when a connection is checked out; an exhausted pool counts a timeout"""
+        stats = user_database.PoolStats()
+        monkeypatch.setattr(user_database, "pool_stats", stats)
+        pool = user_database.TimedQueuePool(MagicMock, pool_size=1, max_overflow=0, timeout=0.05)
+
+        async def scenario():
+            connection = await greenlet_spawn(pool.connect)
+            with pytest.raises(SQLAlchemyTimeoutError):
+                await greenlet_spawn(pool.connect)
+            connection.close()
+
+        asyncio.run(scenario())
+        assert (stats.checkouts, stats.timeouts) == (1, 1)
+
+    def test_login_releases_connection_before_hashing_and_pool_timeout_is_503(self):
+        """Login ends its read transaction before bcrypt; a pool timeout during a query answers 503"""
+        calls = []
+
+        class FakeSession:
+            def __init__(self, fail):
+                self.fail = fail
+
+            async def execute(self, stmt):
+                calls.append("execute")
+                if self.fail:
+                    raise SQLAlchemyTimeoutError("QueuePool limit reached")
+                return SimpleNamespace(scalar_one_or_none=lambda: None)
+
+            async def rollback(self):
+                calls.append("rollback")
+
+        client = TestClient(user_main.app)
+        form = {"username": "a@example.com", "password": "password1"}
+        try:
+            user_main.app.dependency_overrides[user_database.get_db] = lambda: FakeSession(fail=False)
+            assert client.post("/auth/login", data=form).status_code == 401
+            assert calls == ["execute", "rollback"]
+
+            user_main.app.dependency_overrides[user_database.get_db] = lambda: FakeSession(fail=True)
+            response = client.post("/auth/login", data=form)
+        finally:
+            user_main.app.dependency_overrides.clear()
+        assert response.status_code == 503
+        assert response.headers["Retry-After"] == "1"
+
+class TestInternalBatch:
+    """Test the internal batch user lookup"""
+
+    def test_requires_service_token(self, monkeypatch):
+        """No token or a user token is rejected; a service token from /auth/token is accepted"""
+        async def lookup(db, ids, emails):
+            return [user_schemas.UserSummary(id="u1", username="a", email="a@example.com", user_type="PASSENGER",
+                                             is_active=True)]
+
+        monkeypatch.setattr(user_crud, "get_users_by_ids_or_emails", lookup)
+        monkeypatch.setattr(user_main, "EXPECTED_TRIPSVC_CLIENT_ID", "tripservice")
+        monkeypatch.setattr(user_main, "EXPECTED_TRIPSVC_CLIENT_SECRET", "trip-secret")
+        client = TestClient(user_main.app)
+        body = {"ids": ["u1"]}
+        user_token = create_user_access_token(email="a@example.com", user_id="u1", user_type="PASSENGER")
+        service_token = client.post(
+            "/auth/token", data={"username": "tripservice", "password": "trip-secret"}
+        ).json()["access_token"]
+
+        try:
+            user_main.app.dependency_overrides[user_database.get_db] = lambda: None
+            assert client.post("/users/internal/batch", json=body).status_code == 401
+            assert client.post(
+                "/users/internal/batch", json=body, headers={"Authorization": f"Bearer {user_token}"}
+            ).status_code == 401
+            response = client.post(
+                "/users/internal/batch", json=body, headers={"Authorization": f"Bearer {service_token}"}
+            )
+        finally:
+            user_main.app.dependency_overrides.clear()
+        assert response.status_code == 200
+        assert response.json()[0]["email"] == "a@example.com"
+        # The same token still targets DriverService's internal API
+        assert "driverservice" in jwt.get_unverified_claims(service_token)["aud"]
+
+class TestBulkImport:
+    """Test bulk user import"""
+
+    def test_rows_with_mixed_optional_fields_keep_their_values(self, monkeypatch):
+        """Every row of the multi-row INSERT carries the same columns, so no optional value is dropped"""
+        class FakeSession:
+            def __init__(self):
+                self.statements = []
+
+            async def execute(self, stmt):
+                self.statements.append(stmt)
+                return SimpleNamespace(all=lambda: [])
+
+            async def commit(self):
+                pass
+
+            async def rollback(self):
+                raise AssertionError("bulk insert failed")
+
+        async def fast_hash(password):
+            return f"hashed-{password}"
+
+        monkeypatch.setattr(user_crud, "get_password_hash_async", fast_hash)
+        passenger = user_models.UserTypeEnum.PASSENGER
+        rows = [
+            (1, user_schemas.UserCreate(username="a", email="a@example.com", password="password1", user_type=passenger)),
+            (2, user_schemas.UserCreate(username="b", email="b@example.com", password="password2", user_type=passenger,
+                                        phone="0901000002", full_name="Nguyen Van B")),
+            (3, user_schemas.UserCreate(username="c", email="c@example.com", password="password3", user_type=passenger,
+                                        phone="0901000003")),
+        ]
+        session = FakeSession()
+        asyncio.run(user_crud.bulk_create_users(session, rows))
+
+        params = session.statements[0].compile(dialect=postgresql.dialect()).params
+        assert params["phone_m1"] == "0901000002" and params["full_name_m1"] == "Nguyen Van B"
+        assert params["phone_m2"] == "0901000003" and params["full_name_m2"] is None
+        assert params["phone_m0"] is None and params["password_m2"] == "hashed-password3"
+
 # Note: API endpoint tests removed to avoid database dependencies
 # Use smoke_test.py for integration tests after deployment
 